@@ -1,18 +1,27 @@
 import logging
 
 from letta_client import LlmConfig, ChildToolRule
-from app.services.letta_service import lc
+from app.utils.async_letta import get_async_letta
 from app.utils.system_prompt_text import system_prompt_text
 
-def create_background_agent(user_name: str, user_number: str, human_block_id: str, main_agent_id: str):
+def background_agent_identity(user_name: str, user_number: str) -> dict:
     """
-    Cria um agente de background e retorna o agente.
+    Nome, descrição e tags do agente (também aplicados ao personalizar um agente do pool).
+    """
+    return {
+        "name": f"{user_number}_background",
+        "description": f"Agente auxiliar do usuário, responsável por ser o assistente pessoal do usuário chamado {user_name}",
+        "tags": [user_number, "background"],
+    }
+
+async def create_background_agent(user_name: str, user_number: str, human_block_id: str, main_agent_id: str, node: str = None):
+    """
+    Cria um agente de background no servidor Letta `node` (padrão: o nó padrão) e retorna o agente.
     """
     try:
-        agent = lc.agents.create(
+        agent = await get_async_letta(node).agents.create(
           agent_type="memgpt_agent",
-          name=f"{user_number}_background",
-          description=f"Agente auxiliar do usuário, responsável por ser o assistente pessoal do usuário chamado {user_name}",
+          **background_agent_identity(user_name, user_number),
           context_window_limit=2000000,
           include_base_tools=True,
           tools=[
@@ -37,10 +46,6 @@ def create_background_agent(user_name: str, user_number: str, human_block_id: st
           #   ChildToolRule(tool_name="delete_event", children=["send_message"]),
           #   ChildToolRule(tool_name="list_events_for_week", children=["send_message"]), 
           #   ],
-          tags=[
-            user_number, 
-            "background"
-          ],
           llm_config=LlmConfig(
             model= "gemini-1.5-flash",
             model_endpoint_type= "google_ai",
@@ -0,0 +1,30 @@
+import logging
+
+from app.utils.async_letta import get_async_letta
+
+HUMAN_BLOCK_LIMIT = 10000
+
+
+def human_block_value(user_name: str, user_number: str) -> str:
+    return f"""\
+- Nome completo do usuário: {user_name}
+- Primeiro nome do usuário: {user_name.split()[0]}
+- Número de telefone do usuário: {user_number}
+\
+"""
+
+
+async def create_human_block(user_name: str, user_number: str, node: str = None):
+    """
+    Cria o bloco "human" compartilhado pelos agentes do usuário no servidor Letta `node` (padrão: o nó padrão) e retorna o bloco.
+    """
+    try:
+        return await get_async_letta(node).blocks.create(
+            label="human",
+            name=f"{user_number}_human",
+            limit=HUMAN_BLOCK_LIMIT,
+            value=human_block_value(user_name, user_number),
+        )
+    except Exception as e:
+        logging.error(f"Erro ao criar o bloco humano do usuário {user_number}: {e}")
+        return None
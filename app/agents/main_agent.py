@@ -1,18 +1,27 @@
 import logging
 
 from letta_client import LlmConfig, ChildToolRule
-from app.services.letta_service import lc
+from app.utils.async_letta import get_async_letta
 from app.utils.system_prompt_text import system_prompt_text
 
-def create_main_agent(user_name: str, user_number: str, human_block_id: str):
+def main_agent_identity(user_name: str, user_number: str) -> dict:
     """
-    Cria um agente principal e retorna o agente.
+    Nome, descrição e tags do agente (também aplicados ao personalizar um agente do pool).
+    """
+    return {
+        "name": f"{user_number}_main",
+        "description": f"Agente principal do usuário, responsável por ser o assistente pessoal do usuário chamado {user_name}",
+        "tags": [user_number, "main"],
+    }
+
+async def create_main_agent(user_name: str, user_number: str, human_block_id: str, node: str = None):
+    """
+    Cria um agente principal no servidor Letta `node` (padrão: o nó padrão) e retorna o agente.
     """
     try:
-        agent = lc.agents.create(
+        agent = await get_async_letta(node).agents.create(
           agent_type="memgpt_agent",
-          name=f"{user_number}_main",
-          description=f"Agente principal do usuário, responsável por ser o assistente pessoal do usuário chamado {user_name}",
+          **main_agent_identity(user_name, user_number),
           context_window_limit=2000000,
           include_base_tools=True,
           tools=[
@@ -42,10 +51,6 @@ def create_main_agent(user_name: str, user_number: str, human_block_id: str):
             ChildToolRule(tool_name="delete_event", children=["send_message"]),
             ChildToolRule(tool_name="list_events_for_week", children=["send_message"]),            
             ],
-          tags=[
-            user_number, 
-            "main"
-          ],
           llm_config=LlmConfig(
             model= "gemini-1.5-flash",
             model_endpoint_type= "google_ai",
@@ -1,18 +1,32 @@
 import logging
 
 from letta_client import LlmConfig, ChildToolRule, TerminalToolRule
-from app.services.letta_service import lc
+from app.utils.async_letta import get_async_letta
+from app.agents.human_block import HUMAN_BLOCK_LIMIT, human_block_value
 from app.utils.system_prompt_text import system_prompt_text
 
-def create_onboarding_agent(user_name: str, user_number: str):
+def onboarding_agent_identity(user_name: str, user_number: str) -> dict:
     """
-    Cria um agente de onboarding e retorna o agente.
+    Nome, descrição e tags do agente (também aplicados ao personalizar um agente do pool).
     """
+    return {
+        "name": f"{user_number}_onboarding",
+        "description": f"Agente que faz as configurações iniciais do sistema para o usuário chamado {user_name}",
+        "tags": [user_number, "worker", "onboarding"],
+    }
+
+async def create_onboarding_agent(user_name: str, user_number: str, human_block_id: str = None, node: str = None):
+    """
+    Cria um agente de onboarding no servidor Letta `node` (padrão: o nó padrão) e retorna o agente.
+    Com `human_block_id`, usa o bloco "human" compartilhado em vez de criar um próprio.
+    """
+    human_blocks = [] if human_block_id else [
+        {"label": "human", "limit": HUMAN_BLOCK_LIMIT, "value": human_block_value(user_name, user_number)}
+    ]
     try:
-        agent = lc.agents.create(
+        agent = await get_async_letta(node).agents.create(
           agent_type="memgpt_agent",
-          name=f"{user_number}_onboarding",
-          description=f"Agente que faz as configurações iniciais do sistema para o usuário chamado {user_name}",
+          **onboarding_agent_identity(user_name, user_number),
           context_window_limit=2000000,
           include_base_tools=True,
           tools=[
@@ -31,11 +45,6 @@ def create_onboarding_agent(user_name: str, user_number: str):
             TerminalToolRule(tool_name="start_whatsapp_integration"),
             TerminalToolRule(tool_name="start_google_integration"),
             ],
-          tags=[
-            user_number, 
-            "worker", 
-            "onboarding"
-          ],
           llm_config=LlmConfig(
             model= "gemini-1.5-flash",
             model_endpoint_type= "google_ai",
@@ -47,17 +56,8 @@ def create_onboarding_agent(user_name: str, user_number: str):
           ),
           embedding="letta/letta-free",
           system=system_prompt_text,
-          memory_blocks=[
-                {
-                    "label": "human",
-                    "limit": 10000,
-                    "value": f"""\
-- Nome completo do usuário: {user_name}
-- Primeiro nome do usuário: {user_name.split()[0]}
-- Número de telefone do usuário: {user_number}
-\
-"""
-                },
+          block_ids=[human_block_id] if human_block_id else [],
+          memory_blocks=human_blocks + [
                 {
                     "label": "persona",
                     "limit": 5000,
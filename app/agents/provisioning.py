@@ -0,0 +1,188 @@
+import os
+import time
+import uuid
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from app.agents.human_block import create_human_block, human_block_value
+from app.agents.onboarding_agent import create_onboarding_agent, onboarding_agent_identity
+from app.agents.main_agent import create_main_agent, main_agent_identity
+from app.agents.background_agent import create_background_agent, background_agent_identity
+from app.services.agent_directory import role_of
+from app.services.letta_router import letta_router
+from app.services.wpp_token_manager import RELEASE_LOCK_SCRIPT
+from app.utils.async_letta import get_async_letta
+from app.utils.redis_connection import get_async_redis
+
+# Etapas da criação de um conjunto de agentes → etapas de que cada uma depende.
+# O bloco "human" é compartilhado; o agente background precisa do ID do principal, e
+# a persona do principal recebe o ID do background.
+AGENT_SET_GRAPH: Dict[str, Tuple[str, ...]] = {
+    "human_block": (),
+    "onboarding_agent": ("human_block",),
+    "main_agent": ("human_block",),
+    "background_agent": ("main_agent",),
+    "main_persona": ("main_agent", "background_agent"),
+}
+
+# Papel do agente (tag) → etapa do `AGENT_SET_GRAPH` que o cria.
+ROLE_STEPS = {"onboarding": "onboarding_agent", "main": "main_agent", "background": "background_agent"}
+
+Handler = Callable[[dict], Awaitable]
+
+# Um provisionamento (ou migração) por usuário de cada vez (ex.: duas mensagens seguidas de um usuário novo).
+PROVISION_LOCK_TTL = int(os.getenv("AGENT_PROVISION_LOCK_TTL", "120"))
+
+
+async def run_graph(graph: Dict[str, Tuple[str, ...]], handlers: Dict[str, Handler], done: dict, on_step: Optional[Callable[[str, float], Awaitable]] = None):
+    """
+    Executa as etapas do grafo, cada uma assim que as etapas de que depende
+    terminam. `done` guarda o resultado de cada etapa (as que já estão nele são
+    puladas, o que permite retomar) e `on_step` é chamado com a duração de cada
+    etapa concluída. O grafo deve estar em ordem topológica.
+    """
+    tasks: Dict[str, asyncio.Task] = {}
+
+    async def run(step: str):
+        await asyncio.gather(*(tasks[dependency] for dependency in graph[step]))
+        if step in done:
+            return
+        started_at = time.monotonic()
+        done[step] = await handlers[step](done)
+        if on_step:
+            await on_step(step, time.monotonic() - started_at)
+
+    for step in graph:
+        tasks[step] = asyncio.create_task(run(step))
+    try:
+        await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        raise
+    return done
+
+
+@asynccontextmanager
+async def provisioning_lock(user_id: str, ttl: int = PROVISION_LOCK_TTL):
+    """
+    Serializa o provisionamento (e a migração) dos agentes do usuário entre
+    processos. Quem espera encontra, ao entrar, os agentes criados pelo outro
+    (`find_agent_set`) e não duplica nada.
+    """
+    redis = get_async_redis()
+    key, lock_id = f"agents:provision:lock:{user_id}", str(uuid.uuid4())
+    deadline = time.monotonic() + ttl
+    while not await redis.set(key, lock_id, nx=True, ex=ttl):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Tempo esgotado aguardando o provisionamento do usuário {user_id}.")
+        await asyncio.sleep(0.5)
+    try:
+        yield
+    finally:
+        await redis.eval(RELEASE_LOCK_SCRIPT, 1, key, lock_id)
+
+
+def agent_set_handlers(user_name: str, user_number: str, node: str = None) -> Dict[str, Handler]:
+    """
+    Etapas do `AGENT_SET_GRAPH` para o usuário (ou para a identidade provisória do
+    pool), no servidor Letta `node`. Cada agente criado é registrado no `letta_router`.
+    """
+    node = node or letta_router.default_node
+
+    async def human_block(done: dict) -> str:
+        block = await create_human_block(user_name=user_name, user_number=user_number, node=node)
+        if not block:
+            raise RuntimeError("Erro ao criar o bloco humano.")
+        return block.id
+
+    async def onboarding_agent(done: dict) -> str:
+        agent = await create_onboarding_agent(user_name=user_name, user_number=user_number, human_block_id=done["human_block"], node=node)
+        if not agent:
+            raise RuntimeError("Erro ao criar o agente de onboarding.")
+        await letta_router.assign_agents(node, [agent.id])
+        return agent.id
+
+    async def main_agent(done: dict) -> str:
+        agent = await create_main_agent(user_name=user_name, user_number=user_number, human_block_id=done["human_block"], node=node)
+        if not agent:
+            raise RuntimeError("Erro ao criar o agente principal.")
+        await letta_router.assign_agents(node, [agent.id])
+        return agent.id
+
+    async def background_agent(done: dict) -> str:
+        agent = await create_background_agent(user_name=user_name, user_number=user_number, human_block_id=done["human_block"], main_agent_id=done["main_agent"], node=node)
+        if not agent:
+            raise RuntimeError("Erro ao criar o agente background.")
+        await letta_router.assign_agents(node, [agent.id])
+        return agent.id
+
+    async def main_persona(done: dict) -> bool:
+        letta = get_async_letta(node)
+        persona_block = await letta.agents.core_memory.retrieve_block(
+            agent_id=done["main_agent"],
+            block_label="persona",
+        )
+        line = f"\n- O agente background tem ID: {done['background_agent']}"
+        if line.strip() not in persona_block.value:
+            await letta.agents.core_memory.modify_block(
+                agent_id=done["main_agent"],
+                block_label="persona",
+                value=persona_block.value + line,
+            )
+        return True
+
+    return {
+        "human_block": human_block,
+        "onboarding_agent": onboarding_agent,
+        "main_agent": main_agent,
+        "background_agent": background_agent,
+        "main_persona": main_persona,
+    }
+
+
+def created_order(agent, linked: Iterable[str] = ()) -> tuple:
+    """
+    Chave de ordenação entre agentes do mesmo papel: primeiro os gravados no
+    usuário (`linked`), depois o mais antigo, que é o que as buscas por tag
+    usavam antes do índice de agentes (e, portanto, o que tem o histórico).
+    """
+    created_at = agent.created_at.timestamp() if agent.created_at else float("inf")
+    return (agent.id not in set(linked), created_at)
+
+
+async def find_agent_set(user_number: str, linked: Iterable[str] = (), node: str = None) -> dict:
+    """
+    Agentes que o usuário já tem no servidor Letta `node`, no formato das etapas
+    do `AGENT_SET_GRAPH`, para reaproveitá-los em vez de criar duplicatas.
+    Com mais de um agente no mesmo papel, vale a ordem de `created_order`.
+    """
+    letta = get_async_letta(node)
+    linked = [agent_id for agent_id in linked if agent_id]
+    by_role: Dict[str, list] = {}
+    for agent in await letta.agents.list(tags=[user_number]):
+        if user_number in (agent.tags or []):
+            by_role.setdefault(role_of(agent.tags), []).append(agent)
+
+    found = {}
+    for role, step in ROLE_STEPS.items():
+        if by_role.get(role):
+            found[step] = min(by_role[role], key=lambda agent: created_order(agent, linked)).id
+    if found:
+        found["human_block"] = (await letta.agents.core_memory.retrieve_block(next(iter(found.values())), "human")).id
+    return found
+
+
+async def personalize_agent_set(agents: dict, user_name: str, user_number: str, node: str = None):
+    """
+    Aplica a identidade do usuário a um conjunto criado com outra (pool), no
+    servidor Letta `node`: bloco "human", nomes, descrições e tags dos três agentes.
+    """
+    letta = get_async_letta(node)
+    await asyncio.gather(
+        letta.blocks.modify(agents["human_block"], name=f"{user_number}_human", value=human_block_value(user_name, user_number)),
+        letta.agents.modify(agents["onboarding_agent"], **onboarding_agent_identity(user_name, user_number)),
+        letta.agents.modify(agents["main_agent"], **main_agent_identity(user_name, user_number)),
+        letta.agents.modify(agents["background_agent"], **background_agent_identity(user_name, user_number)),
+    )
@@ -1,5 +1,13 @@
+import os
+import secrets
+from typing import Optional
+
+from dotenv import load_dotenv
+from fastapi import Header, HTTPException
 from passlib.context import CryptContext
 
+load_dotenv()
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 def verify_password(plain_password, hashed_password):
@@ -7,3 +15,12 @@ def verify_password(plain_password, hashed_password):
 
 def hash_password(password):
     return pwd_context.hash(password)
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """
+    Dependência das rotas de administração: exige o cabeçalho X-Admin-Token igual a
+    ADMIN_API_TOKEN. Sem ADMIN_API_TOKEN configurado, as rotas ficam bloqueadas.
+    """
+    admin_token = os.getenv("ADMIN_API_TOKEN")
+    if not admin_token or not x_admin_token or not secrets.compare_digest(x_admin_token, admin_token):
+        raise HTTPException(status_code=401, detail="Token de administração inválido.")
@@ -1,21 +1,35 @@
 import os
-import asyncio
-from app.agents.background_agent import create_background_agent
-from app.agents.main_agent import create_main_agent
-from app.agents.onboarding_agent import create_onboarding_agent
+import time
+import uuid
+import logging
+from app.agents.provisioning import AGENT_SET_GRAPH, agent_set_handlers, find_agent_set, provisioning_lock, run_graph
 from app.models.user import User
 from app.services.flow_repository import FlowRepository
 from app.schemas.user import UserBase
-from app.services.letta_service import get_human_block_id
+from app.services.agent_directory import agent_directory
+from app.services.agent_pool import agent_pool
+from app.services.letta_router import letta_router
 from app.services.user_service import UserRepository
-from app.services.whatsapp_service import WhatsAppService
-from app.utils.celery_imports import lc
+from app.services.outbound_queue import async_queued_wpp
+from app.services.wpp_token_manager import RELEASE_LOCK_SCRIPT
+from app.utils.redis_connection import get_async_redis
+
+# Provisionamento dos agentes do usuário: o conjunto de agentes (`AGENT_SET_GRAPH`),
+# a personalização (só quando o conjunto vem do pool) e o registro no banco e no índice.
+PROVISIONING_GRAPH = {
+    **AGENT_SET_GRAPH,
+    "personalize": tuple(AGENT_SET_GRAPH),
+    "register": ("personalize",),
+}
+
+# Tempo máximo de uma execução do flow; depois disso outra mensagem pode retomá-lo.
+FLOW_RUNNING_TTL = int(os.getenv("AGENT_FLOW_RUNNING_TTL", "300"))
 
 class CreateAgentsFlow:
     FLOW_NAME = "create_agents"
 
     def __init__(self, user_id: str, data: dict = None):
-        self.steps = [self.step_one, self.step_two, self.step_three, self.step_four]
+        self.steps = [self.step_one]
         self.data = data or {}
         self.current_step = 0
         self.is_running = False
@@ -23,7 +37,6 @@ class CreateAgentsFlow:
         self.user_id = user_id
         self.flow_repo = FlowRepository()
         self.user_repo = UserRepository()
-        self.background_agent_id = None
         
     async def get_user(self) -> User:
         user_repo = UserRepository()
@@ -118,6 +131,22 @@ class CreateAgentsFlow:
         await self.save_state()
         return await self.advance_flow()
 
+    async def run_once(self) -> dict:
+        """
+        Reinicia o flow, a menos que ele já esteja rodando em algum processo (flag
+        `SET NX` por usuário). Mensagens seguidas de um usuário sem agentes não
+        disparam provisionamentos paralelos: só a primeira executa o flow.
+        """
+        redis = get_async_redis()
+        key, run_id = f"agents:flow:running:{self.user_id}", str(uuid.uuid4())
+        if not await redis.set(key, run_id, nx=True, ex=FLOW_RUNNING_TTL):
+            return {"message": "Flow is already running."}
+        try:
+            await self.load_state()
+            return await self.restart()
+        finally:
+            await redis.eval(RELEASE_LOCK_SCRIPT, 1, key, run_id)
+
     async def handle_message(self, msg: str):
         msg = msg.lower()
         if msg in ["start", "iniciar"]:
@@ -130,8 +159,7 @@ class CreateAgentsFlow:
             return await self.restart()
         else:
             user = await self.get_user()
-            wpp = WhatsAppService(session_name="principal", token=os.getenv("PRINCIPAL_WPP_SESSION_TOKEN"))
-            wpp.send_message(user.phone, "Comando inválido. Use 'iniciar', 'continuar', 'cancelar' ou 'reiniciar'.")
+            await async_queued_wpp.send_message(user.phone, "Comando inválido. Use 'iniciar', 'continuar', 'cancelar' ou 'reiniciar'.")
             return {"error": "Invalid command. Use 'start', 'continue', 'stop', or 'restart'."}
 
     async def execute_current_step(self):
@@ -144,58 +172,89 @@ class CreateAgentsFlow:
 
     async def step_one(self):
         user = await self.get_user()
-        
-        onboarding_agent = create_onboarding_agent(user_name=user.name, user_number=user.phone)
-        human_block_id = get_human_block_id(onboarding_agent.id)
-        main_agent = create_main_agent(user_name=user.name, user_number=user.phone, human_block_id=human_block_id)
-        background_agent = create_background_agent(user_name=user.name, user_number=user.phone, human_block_id=human_block_id, main_agent_id=main_agent.id)
-        self.background_agent_id = background_agent.id
-        user_main_agent_id_update = UserBase(id_main_agent=main_agent.id)
-        await self.user_repo.update_user_by_id(user.id, user_main_agent_id_update)
-        await asyncio.sleep(1)
+        await self.provision(user)
         auto_continue = True
         message = f"Step 1 completed"
         return {"message": message, "auto_continue": auto_continue}
 
-    async def step_two(self):
-        user = await self.get_user()
-        
-        main_agent_id = user.id_main_agent
-        
-        persona_block = lc.agents.core_memory.retrieve_block(
-            agent_id=main_agent_id,
-            block_label="persona",
-        )
-        
-        old_content = persona_block.value
-        
-        new_content = old_content + f"""\n- O agente background tem ID: {self.background_agent_id}"""
-        
-        lc.agents.core_memory.modify_block(
-            agent_id=main_agent_id,
-            block_label="persona",
-            value=new_content,
-        )
-        
-        await asyncio.sleep(1)  
-        auto_continue = True
-        message = f"Step 2 completed"
-        return {"message": message, "auto_continue": auto_continue}
+    async def provision(self, user: User):
+        """
+        Executa o grafo de provisionamento (`PROVISIONING_GRAPH`): cada etapa começa
+        assim que as etapas de que depende terminam, então os agentes independentes
+        são criados em paralelo. Se houver estoque no `agent_pool`, o conjunto de
+        agentes é retirado de lá e só personalizado. Agentes que o usuário já tem são
+        reaproveitados (um por papel), então repetir o flow não cria duplicatas. O resultado e a duração de cada
+        etapa ficam no estado do flow (`data["provisioning"]` e `data["timings"]`),
+        e uma nova execução do flow retoma a partir das etapas que faltam.
+        Os agentes ficam no servidor Letta do usuário (`letta_router`), gravado em `data["letta_node"]`.
+        """
+        async with provisioning_lock(user.id):
+            await self._provision(user)
 
-    async def step_three(self):
-        # user = await self.get_user()
-        
-        
-        await asyncio.sleep(1)
-        auto_continue = True
-        message = f"Step 3 completed"
-        return {"message": message, "auto_continue": auto_continue}
+    async def _provision(self, user: User):
+        done = self.data.setdefault("provisioning", {})
+        timings = self.data.setdefault("timings", {})
+        started_at = time.monotonic()
+        node = self.data.get("letta_node") or user.letta_node or await letta_router.node_for_user(user.phone)
+        self.data["letta_node"] = node
 
-    async def step_four(self):
-        # user = await self.get_user()
-        
-        
-        message = f"Step 4 completed"
-        await asyncio.sleep(1)
-        auto_continue = True
-        return {"message": message, "auto_continue": auto_continue}
+        if not done:
+            linked = [user.id_onboarding_agent, user.id_main_agent, user.id_background_agent]
+            existing = await find_agent_set(user.phone, linked=linked, node=node)
+            if existing:
+                # Agentes que já existem são reaproveitados; só os papéis que faltam são criados.
+                done.update(existing)
+                done["personalize"] = True
+                timings["existing"] = round(time.monotonic() - started_at, 3)
+            else:
+                await agent_directory.invalidate_async(phone=user.phone, agent_ids=linked)
+                claimed = await agent_pool.claim(node)
+                if claimed:
+                    done.update(claimed)
+                    timings["pool_claim"] = round(time.monotonic() - started_at, 3)
+                else:
+                    # Agentes criados já com a identidade do usuário.
+                    done["personalize"] = True
+            await self.save_state()
+
+        async def checkpoint(step: str, seconds: float):
+            timings[step] = round(seconds, 3)
+            await self.save_state()
+            logging.info(f"Provisionamento do usuário {user.id}: {step} em {seconds:.2f} s.")
+
+        handlers = {
+            **agent_set_handlers(user.name, user.phone, node=node),
+            "personalize": lambda done: self.provision_personalize(user, done, node),
+            "register": lambda done: self.provision_register(user, done, node),
+        }
+        try:
+            await run_graph(PROVISIONING_GRAPH, handlers, done, on_step=checkpoint)
+        finally:
+            await self.save_state()
+
+        timings["total"] = round(time.monotonic() - started_at, 3)
+        await self.save_state()
+        logging.info(f"Agentes do usuário {user.id} provisionados em {timings['total']:.2f} s: {timings}.")
+
+    async def provision_personalize(self, user: User, done: dict, node: str) -> bool:
+        await agent_pool.personalize(done, user_name=user.name, user_number=user.phone, node=node)
+        return True
+
+    async def provision_register(self, user: User, done: dict, node: str) -> bool:
+        user_agents_update = UserBase(
+            id_main_agent=done["main_agent"],
+            id_onboarding_agent=done["onboarding_agent"],
+            id_background_agent=done["background_agent"],
+            letta_node=node,
+        )
+        await self.user_repo.update_user_by_id(user.id, user_agents_update)
+        await letta_router.assign_user(user.phone, node)
+        await letta_router.assign_agents(node, [done["onboarding_agent"], done["main_agent"], done["background_agent"]])
+        await agent_directory.register_async(
+            user.phone,
+            user_id=user.id,
+            onboarding=done["onboarding_agent"],
+            main=done["main_agent"],
+            background=done["background_agent"],
+        )
+        return True
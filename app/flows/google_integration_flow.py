@@ -6,7 +6,7 @@ from urllib.parse import urlencode
 from app.models.user import User
 from app.services.flow_repository import FlowRepository
 from app.schemas.user import UserBase
-from app.services.letta_service import get_onboarding_agent_id, send_user_message_to_agent
+from app.services.letta_service import get_onboarding_agent_id_async, send_user_message_to_agent
 from app.services.short_links import create_short_url
 from app.services.user_service import UserRepository
 from google_auth_oauthlib.flow import Flow
@@ -14,7 +14,7 @@ from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 
-from app.services.whatsapp_service import WhatsAppService
+from app.services.outbound_queue import async_queued_wpp
 from app.utils.state_utils_jwt import generate_state
 
 class GoogleIntegrationFlow:
@@ -33,7 +33,7 @@ class GoogleIntegrationFlow:
         self.flow_completed = None
         self.user_id = user_id
         self.flow_repo = FlowRepository()
-        self.wpp = WhatsAppService(session_name="principal", token=os.getenv("PRINCIPAL_WPP_SESSION_TOKEN"))
+        self.wpp = async_queued_wpp
 
     async def get_user(self) -> User:
         user_repo = UserRepository()
@@ -119,8 +119,8 @@ class GoogleIntegrationFlow:
         self.flow_completed = False
         await self.save_state()
         user = await self.get_user()
-        onboarding_agent_id = get_onboarding_agent_id(user.phone)
-        self.wpp.send_message(user.phone, "```Você cancelou a integração com o Google Calendar.```")
+        onboarding_agent_id = await get_onboarding_agent_id_async(user.phone)
+        await self.wpp.send_message(user.phone, "```Você cancelou a integração com o Google Calendar.```")
         send_user_message_to_agent(onboarding_agent_id, "SYSTEM MESSAGE: O usuário cancelou a integração com o Google Calendar. Pergunte a ele se deseja tentar novamente.")
         user_repo = UserRepository()
         await user_repo.set_user_integration_running(user.phone, None)
@@ -146,7 +146,7 @@ class GoogleIntegrationFlow:
             return await self.restart()
         else:
             user = await self.get_user()
-            self.wpp.send_message(user.phone, "```Comando inválido. Use 'iniciar', 'continuar', 'cancelar' ou 'reiniciar'.```")
+            await self.wpp.send_message(user.phone, "```Comando inválido. Use 'iniciar', 'continuar', 'cancelar' ou 'reiniciar'.```")
             return {"error": "Invalid command. Use 'start', 'continue', 'stop', or 'restart'."}
 
     async def execute_current_step(self):
@@ -161,7 +161,7 @@ class GoogleIntegrationFlow:
         user = await self.get_user()
         user_first_name = user.name.split()[0]
         
-        self.wpp.send_message(
+        await self.wpp.send_message(
             user.phone, 
             f"*{user_first_name}*, estamos iniciando a integração com sua conta do Google, enquanto geramos o link de autorização, por favor aguarde um momento."
         )
@@ -170,7 +170,7 @@ class GoogleIntegrationFlow:
         authorization_url = self.get_authorization_url(state)
         shorted_link = create_short_url(authorization_url) 
 
-        self.wpp.send_message(
+        await self.wpp.send_message(
             user.phone, 
             f"*{user_first_name}*, para integrarmos o Google, preciso que você autorize o acesso. Clique no link abaixo para continuar:\n\n{shorted_link}\n\nApós autorizar, volte aqui e aguarde a confirmação."
         )
@@ -217,22 +217,22 @@ class GoogleIntegrationFlow:
         credentials_json = self.data.get("credentials")
         if not credentials_json:
             message = "Credenciais não encontradas. Recomeçando o fluxo."
-            self.wpp.send_message(user.phone, "```Credenciais não encontradas. Recomeçando o fluxo.```")
+            await self.wpp.send_message(user.phone, "```Credenciais não encontradas. Recomeçando o fluxo.```")
             self.restart()
             return {"message": message, "auto_continue": False}
 
         credentials = Credentials.from_authorized_user_info(json.loads(credentials_json))
         user_repo = UserRepository()
-        onboarding_agent_id = get_onboarding_agent_id(user.phone)
+        onboarding_agent_id = await get_onboarding_agent_id_async(user.phone)
         # Aqui, você pode construir o serviço Calendar para verificar se está funcionando
         try:
             build('calendar', 'v3', credentials=credentials)
-            self.wpp.send_message(user.phone, "```Sua integração foi realizada com sucesso!``` ✅")
+            await self.wpp.send_message(user.phone, "```Sua integração foi realizada com sucesso!``` ✅")
             user_update = UserBase(google_calendar_integration=True, email_integration=True, apple_calendar_integration=True)
             await user_repo.update_user_by_id(user.id, user_update)
             send_user_message_to_agent(onboarding_agent_id, "SYSTEM MESSAGE: Integração do Google realizada com sucesso!")
         except Exception as e:
-            self.wpp.send_message(user.phone, "```Algo deu errado na sua integração com o Google.``` ❌")
+            await self.wpp.send_message(user.phone, "```Algo deu errado na sua integração com o Google.``` ❌")
             send_user_message_to_agent(onboarding_agent_id, "SYSTEM MESSAGE: Integração do Google falhou!. Você deve perguntar ao usuário se ele quer tentar novamente.")
             self.stop()
 
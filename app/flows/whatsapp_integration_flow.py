@@ -1,11 +1,61 @@
 import os
+import time
+import uuid
 import asyncio
+import logging
+from typing import List
 from app.models.user import User
 from app.services.flow_repository import FlowRepository
 from app.schemas.user import UserBase
-from app.services.letta_service import get_onboarding_agent_id, send_user_message_to_agent
+from app.services.letta_service import get_onboarding_agent_id_async, send_user_message_to_agent
 from app.services.user_service import UserRepository
-from app.services.whatsapp_service import WhatsAppService
+from app.services.whatsapp_service import AsyncWhatsAppService
+from app.services.outbound_queue import async_queued_wpp
+from app.services.session_events import CONNECTED_STATUSES, FAILED_STATUSES, session_events
+from app.services.session_router import session_router
+from app.utils.redis_connection import get_async_redis
+
+# Tempo máximo para o primeiro QR Code e para o usuário escanear (incluindo QR Codes renovados).
+QR_CODE_TIMEOUT = float(os.getenv("WPP_QR_CODE_TIMEOUT", "30"))
+CONNECTION_TIMEOUT = float(os.getenv("WPP_CONNECTION_TIMEOUT", "120"))
+
+# Esperas pela conexão pendentes (`<user_id>|<watch_id>` → horário em que podem ser reservadas).
+# Executadas pelo processo de workers (`app.workers.connection_watches`), que as retoma após um reinício.
+CONNECTION_WATCHES_KEY = "wpp:connection_watches"
+CONNECTION_WATCH_LEASE_MS = int(os.getenv("WPP_CONNECTION_WATCH_LEASE_MS", "30000"))
+
+# Reserva as esperas vencidas, empurrando o horário delas para agora + lease (ARGV[1]).
+CLAIM_WATCHES_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, tonumber(ARGV[2]))
+for _, member in ipairs(members) do
+    redis.call('ZADD', KEYS[1], now + tonumber(ARGV[1]), member)
+end
+return members
+"""
+
+
+async def claim_connection_watches(limit: int = 50) -> List[str]:
+    return await get_async_redis().eval(CLAIM_WATCHES_SCRIPT, 1, CONNECTION_WATCHES_KEY, CONNECTION_WATCH_LEASE_MS, limit)
+
+
+async def renew_connection_watch(member: str):
+    await get_async_redis().zadd(CONNECTION_WATCHES_KEY, {member: time.time() * 1000 + CONNECTION_WATCH_LEASE_MS}, xx=True)
+
+
+async def run_connection_watch(member: str):
+    """
+    Executa (ou retoma) a espera `member` reservada por este processo e a retira da lista ao terminar.
+    """
+    user_id, watch_id = member.split("|", 1)
+    try:
+        flow = WhatsappIntegrationFlow(user_id)
+        await flow.load_state()
+        if flow.is_running and flow.data.get("connection_watch") == watch_id:
+            await flow._watch_connection(await flow.get_user(), watch_id)
+    finally:
+        await get_async_redis().zrem(CONNECTION_WATCHES_KEY, member)
 
 class WhatsappIntegrationFlow:
     FLOW_NAME = "whatsapp_integration"
@@ -18,7 +68,7 @@ class WhatsappIntegrationFlow:
         self.flow_completed = None
         self.user_id = user_id
         self.flow_repo = FlowRepository()
-        self.wpp = WhatsAppService(session_name="principal", token=os.getenv("PRINCIPAL_WPP_SESSION_TOKEN"))
+        self.wpp = async_queued_wpp
         
     async def get_user(self) -> User:
         user_repo = UserRepository()
@@ -55,6 +105,7 @@ class WhatsappIntegrationFlow:
                 "current_step": current_step_result["message"],
             }
         self.data = data or self.data
+        self.data.pop("connection_watch", None)
         self.current_step = 0
         self.is_running = True
         self.flow_completed = False
@@ -102,10 +153,11 @@ class WhatsappIntegrationFlow:
             return {"error": "Flow is not running."}
         self.is_running = False
         self.flow_completed = False
+        self.data.pop("connection_watch", None)
         await self.save_state()
         user = await self.get_user()
-        onboarding_agent_id = get_onboarding_agent_id(user.phone)
-        self.wpp.send_message(user.phone, "```Você cancelou a integração com o Whatsapp.```")
+        onboarding_agent_id = await get_onboarding_agent_id_async(user.phone)
+        await self.wpp.send_message(user.phone, "```Você cancelou a integração com o Whatsapp.```")
         send_user_message_to_agent(onboarding_agent_id, "SYSTEM MESSAGE: O usuário cancelou a integração com o Whatsapp. Pergunte a ele se deseja tentar novamente.")
         user_repo = UserRepository()
         await user_repo.set_user_integration_running(user.phone, None)
@@ -113,6 +165,7 @@ class WhatsappIntegrationFlow:
 
     async def restart(self, data: dict = None):
         self.data = data or self.data
+        self.data.pop("connection_watch", None)
         self.current_step = 0
         self.is_running = True
         self.flow_completed = False
@@ -121,6 +174,8 @@ class WhatsappIntegrationFlow:
 
     async def handle_message(self, msg: str):
         msg = msg.lower()
+        if self.data.get("connection_watch") and msg not in ["stop", "cancel", "cancelar", "restart", "reiniciar"]:
+            return await self.remind_waiting_connection()
         if msg in ["start", "iniciar"]:
             return await self.start()
         elif msg in ["continue", "ok", "continuar"]:
@@ -131,7 +186,7 @@ class WhatsappIntegrationFlow:
             return await self.restart()
         else:
             user = await self.get_user()
-            self.wpp.send_message(user.phone, "```Comando inválido. Use 'iniciar', 'continuar', 'cancelar' ou 'reiniciar'.```")
+            await self.wpp.send_message(user.phone, "```Comando inválido. Use 'iniciar', 'continuar', 'cancelar' ou 'reiniciar'.```")
             return {"error": "Invalid command. Use 'start', 'continue', 'stop', or 'restart'."}
 
     async def execute_current_step(self):
@@ -146,11 +201,11 @@ class WhatsappIntegrationFlow:
         user = await self.get_user()
         user_first_name = user.name.split()[0]
         
-        self.wpp.send_message(
+        await self.wpp.send_message(
             user.phone, 
             f"{user_first_name}, para integrarmos o seu Whatsapp com o nosso sistema, será preciso logar em uma sessão do Whatsapp Web, siga atentamente as instruções abaixo:\n\n1. Abra essa conversa em *outro* dispositivo.\n2. Abra o Whatsapp no seu *celular*.\n3. Vá até as configurações do Whatsapp e clique em *Dispositivos Conectados*.\n4. Aponte a câmera do seu celular para o *QR Code* que será exibido nessa conversa.\n5. Aguarde a confirmação da integração."
         )
-        self.wpp.send_message(
+        await self.wpp.send_message(
             user.phone, 
             f"```Para prosseguir, responda 'ok' ou 'continuar', para cancelar, responda 'cancelar'.```"
         )
@@ -165,16 +220,18 @@ class WhatsappIntegrationFlow:
 
         user_repo = UserRepository()
         user_session = f"info_agent_{user.phone}"
-        user_wpp = WhatsAppService(session_name=user_session)
-        whatsapp_token = user_wpp.generate_token()
-        user_update = UserBase(id_session_wpp=user_session, token_wpp=whatsapp_token)
+        user_wpp = AsyncWhatsAppService(session_name=user_session)
+        whatsapp_token = await user_wpp.generate_token()
+        # O servidor WPPConnect da sessão é escolhido no primeiro uso (hash consistente) e gravado no usuário.
+        wpp_node = await session_router.node_for(user_session)
+        user_update = UserBase(id_session_wpp=user_session, token_wpp=whatsapp_token, wpp_node=wpp_node)
         await user_repo.update_user_by_id(user.id, user_update)
         
-        self.wpp.send_message(
+        await self.wpp.send_message(
             user.phone, 
             f"Na próxima etapa, *você deve ser rápido*, uma vez que o código QR gerado, *expira* em segundos, por favor, garanta que já consegue escanear o código com seu celular, antes de prosseguir."
         )
-        self.wpp.send_message(
+        await self.wpp.send_message(
             user.phone, 
             f"```Para prosseguir, responda 'ok' ou 'continuar', para cancelar, responda 'cancelar'.```"
         )
@@ -187,59 +244,124 @@ class WhatsappIntegrationFlow:
     async def step_three(self):
         user = await self.get_user()
         
-        self.wpp.send_message(user.phone, "Aguarde um momento, estou gerando o QR Code para você.")
-        user_wpp = WhatsAppService(session_name=user.id_session_wpp, token=user.token_wpp)
-        response = user_wpp.start_session()
-        await asyncio.sleep(3)
-        attempt = 0
-        while response.get("status") != "QRCODE" and attempt < 10:
-            await asyncio.sleep(2)
-            response = user_wpp.start_session()
-            attempt += 1
-        if response.get("status") == "QRCODE":
-            qr_code = response.get("qrcode")
-        else:
-            print("Error getting QR Code")
+        await self.wpp.send_message(user.phone, "Aguarde um momento, estou gerando o QR Code para você.")
+        user_wpp = AsyncWhatsAppService(session_name=user.id_session_wpp, token=user.token_wpp)
+        requested_at = time.time()
+        # Inscreve antes do start-session: o QR Code chega pelo evento `qrcode` do webhook.
+        async with session_events.subscribe(user.id_session_wpp, since=requested_at) as events:
+            response = await user_wpp.start_session()
+            qr_code = response.get("qrcode") if response.get("status") == "QRCODE" else None
+            if not qr_code:
+                event = await events.wait_for({"qrcode"}, QR_CODE_TIMEOUT)
+                qr_code = event.get("qrcode") if event else None
+        if not qr_code:
+            raise TimeoutError(f"QR Code da sessão {user.id_session_wpp} não recebido em {QR_CODE_TIMEOUT}s.")
         
         try:
-            self.wpp.send_image(phone=user.phone, base64_str=qr_code, caption="Escaneie o QR Code para prosseguir com a integração.", filename="qr_code.png")
+            await self.wpp.send_image(phone=user.phone, base64_str=qr_code, caption="Escaneie o QR Code para prosseguir com a integração.", filename="qr_code.png")
         except Exception as e:
             print(f"Error sending QR Code image: {str(e)}")
             raise
         
-        await asyncio.sleep(1)
-        auto_continue = True
-        message = f"Step 3 completed: QR-Code was sent for user {user.name}"
+        self.data["qr_requested_at"] = requested_at
+        self.data["last_qrcode"] = qr_code
+        self.data["connection_deadline"] = time.time() + CONNECTION_TIMEOUT
+        self.data.pop("connected", None)
+        # A conexão é aguardada em segundo plano; o flow segue para a etapa 4 quando ela terminar.
+        await self.watch_connection()
+        auto_continue = False
+        message = f"Step 3 completed: QR-Code was sent for user {user.name}, waiting for the connection in background"
         return {"message": message, "auto_continue": auto_continue}
 
+    async def watch_connection(self):
+        """
+        Agenda a espera pela conexão no processo de workers (fora da requisição e do
+        shard do stream). A espera é durável: se o processo reiniciar, outro a retoma
+        até o prazo gravado (`connection_deadline`). O estado é salvo antes de a
+        espera ser publicada, para o worker encontrar o `connection_watch` dela.
+        """
+        watch_id = uuid.uuid4().hex
+        self.data["connection_watch"] = watch_id
+        await self.save_state()
+        await get_async_redis().zadd(CONNECTION_WATCHES_KEY, {f"{self.user_id}|{watch_id}": 0})
+
+    async def _watch_connection(self, user: User, watch_id: str):
+        """
+        Aguarda o resultado da conexão e retoma o flow a partir do estado salvo,
+        desde que ele não tenha sido cancelado ou reiniciado nesse meio-tempo.
+        """
+        try:
+            connected = await self.wait_for_connection(user)
+        except Exception as e:
+            logging.error(f"Erro ao aguardar a conexão da sessão {user.id_session_wpp}: {e}")
+            connected = False
+
+        flow = WhatsappIntegrationFlow(self.user_id)
+        await flow.load_state()
+        if not flow.is_running or flow.data.get("connection_watch") != watch_id:
+            return
+        flow.data.pop("connection_watch", None)
+        flow.data["connected"] = connected
+        await flow.advance_flow()
+
+    async def remind_waiting_connection(self):
+        """
+        Mensagem recebida enquanto a conexão é aguardada. Se o prazo já passou e a
+        espera ainda não terminou (ex.: workers parados), ela é reagendada e só
+        confirma o status.
+        """
+        user = await self.get_user()
+        if time.time() >= self.data.get("connection_deadline", 0):
+            await self.watch_connection()
+            return {"message": "Connection check rescheduled."}
+        await self.wpp.send_message(user.phone, "```Aguardando a leitura do QR Code. Para cancelar, responda 'cancelar'.```")
+        return {"message": "Waiting for the connection."}
+
+    async def wait_for_connection(self, user: User) -> bool:
+        """
+        Aguarda os eventos da sessão até a conexão, a falha ou o prazo gravado na
+        etapa 3 (`CONNECTION_TIMEOUT`). Os QR Codes renovados pelo WPPConnect são
+        reenviados ao usuário assim que chegam.
+        """
+        last_qrcode = self.data.get("last_qrcode")
+        deadline = self.data.get("connection_deadline", time.time() + CONNECTION_TIMEOUT)
+        async with session_events.subscribe(user.id_session_wpp, since=self.data.get("qr_requested_at", time.time())) as events:
+            while (remaining := deadline - time.time()) > 0:
+                event = await events.next(remaining)
+                if not event:
+                    break
+                if event["event"] == "qrcode" and event.get("qrcode") and event["qrcode"] != last_qrcode:
+                    last_qrcode = event["qrcode"]
+                    await self.wpp.send_image(phone=user.phone, base64_str=last_qrcode, caption="O QR Code anterior expirou, escaneie este novo QR Code.", filename="qr_code.png")
+                elif event["event"] == "status-find" and event.get("status") in CONNECTED_STATUSES:
+                    return True
+                elif event["event"] == "status-find" and event.get("status") in FAILED_STATUSES:
+                    return False
+
+        # Sem evento conclusivo: confirma uma vez com o WPPConnect antes de desistir.
+        user_wpp = AsyncWhatsAppService(session_name=user.id_session_wpp, token=user.token_wpp)
+        return (await user_wpp.status_session()).get("message") == "Connected"
+
     async def step_four(self):
         user = await self.get_user()
-        user_wpp = WhatsAppService(session_name=user.id_session_wpp, token=user.token_wpp)
         user_repo = UserRepository()
-        attempt = 0
-        status = None
-        onboarding_agent_id = get_onboarding_agent_id(user.phone)
-        while attempt < 15 and status != "Connected":
-            await asyncio.sleep(2)
-            status = user_wpp.status_session().get("message")
-            attempt += 1
+        onboarding_agent_id = await get_onboarding_agent_id_async(user.phone)
+        # Resultado gravado pela espera em segundo plano (`_watch_connection`).
+        connected = self.data.get("connected", False)
         
-        if status == "Connected":
-            self.wpp.send_message(user.phone, "```Sua integração foi realizada com sucesso!``` ✅")
+        if connected:
+            await self.wpp.send_message(user.phone, "```Sua integração foi realizada com sucesso!``` ✅")
             user_update = UserBase(whatsapp_integration=True)
             await user_repo.update_user_by_id(user.id, user_update)
-            await asyncio.sleep(2)
             send_user_message_to_agent(onboarding_agent_id, "SYSTEM MESSAGE: Integração do Whatsapp realizada com sucesso!")
             message = f"Step 4 completed: Integration completed for user {user.name}"
         else:
-            self.wpp.send_message(user.phone, "```Algo deu errado na sua integração, o QR-Code pode ter expirado.``` ❌")
-            await asyncio.sleep(2)
+            await self.wpp.send_message(user.phone, "```Algo deu errado na sua integração, o QR-Code pode ter expirado.``` ❌")
             send_user_message_to_agent(onboarding_agent_id, "SYSTEM MESSAGE: Integração do Whatsapp falhou!. Você deve perguntar ao usuário se ele quer tentar novamente. Informe a ele que o motivo pode ter sido a expiração do QR-Code, enfatize o fato de que ele deve ser rápido.")
             message = f"Step 4 completed: Something went wrong and the integration is not completed for user {user.name}"
         
         user_update = UserBase(integration_is_running=None)
         await user_repo.update_user_by_id(user.id, user_update)
         
-        await asyncio.sleep(1)
         auto_continue = True
         return {"message": message, "auto_continue": auto_continue}
@@ -1,15 +1,46 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.responses import HTMLResponse
 from app.routers import user_router
-from app.routers import webhook, tools, google_callback, short_links
+from app.routers import webhook, tools, google_callback, short_links, metrics, ingestion_filters, wpp_nodes, agents
+from app.utils.archival_memory_manager import archival_buffer
+from app.services.whatsapp_service import close_async_http_client
+from app.utils.async_letta import close_async_letta
+from app.services.media_pipeline import media_pipeline
+from app.services.session_rebalancer import warm_assignments
+from app.services.letta_migration import warm_letta_assignments
 
 
-app = FastAPI(title="Luximus API", version="0.1.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Atribuições de sessões aos servidores WPPConnect que estiverem só no banco (ex.: Redis limpo).
+    try:
+        await warm_assignments()
+    except Exception as e:
+        print(f"Erro ao carregar as atribuições das sessões do WhatsApp: {e}")
+    # Servidor Letta dos usuários com agentes (os criados antes da divisão ficam no nó padrão).
+    try:
+        await warm_letta_assignments()
+    except Exception as e:
+        print(f"Erro ao carregar as atribuições dos servidores Letta: {e}")
+    yield
+    # Grava o que ainda estiver no buffer da memória arquivística.
+    await media_pipeline.close()
+    await archival_buffer.close()
+    await close_async_http_client()
+    await close_async_letta()
+
+
+app = FastAPI(title="Luximus API", version="0.1.0", lifespan=lifespan)
 
 app.include_router(webhook.router)
 app.include_router(tools.router)
 app.include_router(google_callback.router)
 app.include_router(short_links.router)
+app.include_router(metrics.router)
+app.include_router(ingestion_filters.router)
+app.include_router(wpp_nodes.router)
+app.include_router(agents.router)
 
 @app.get("/")
 def read_root():
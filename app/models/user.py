@@ -15,8 +15,12 @@ class User(Base):
     integration_is_running = Column(String(255), nullable=True)
     cpf = Column(String(11), unique=True, nullable=True)
     id_main_agent = Column(String(255), nullable=True) 
+    id_onboarding_agent = Column(String(255), nullable=True)
+    id_background_agent = Column(String(255), nullable=True)
+    letta_node = Column(String(64), nullable=True)
     id_session_wpp = Column(String(255), nullable=True)
     token_wpp = Column(String(255), nullable=True)
+    wpp_node = Column(String(64), nullable=True)
     whatsapp_integration = Column(Boolean, default=False, nullable=False)
     google_calendar_integration = Column(Boolean, default=False, nullable=False)
     apple_calendar_integration = Column(Boolean, default=False, nullable=False)
@@ -0,0 +1,49 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+
+from app.core.security import require_admin
+from app.services.agent_reconciler import agent_reconciler
+from app.services.letta_migration import enqueue_migration, migration_status
+from app.services.letta_router import letta_router
+from app.services.user_service import UserRepository
+
+router = APIRouter(prefix="/agents", tags=["Agents"])
+
+@router.post("/reconcile", dependencies=[Depends(require_admin)])
+async def reconcile_agents(dry_run: bool = Query(True, description="Só lista as ações, sem apagar nem religar agentes")):
+    """
+    Compara os agentes do Letta com os usuários: apaga órfãos e duplicatas e religa ao usuário o agente que ficou.
+    """
+    return await agent_reconciler.reconcile(dry_run=dry_run)
+
+@router.get("/nodes")
+async def list_letta_nodes():
+    """
+    Servidores Letta configurados e quantos usuários e agentes estão em cada um.
+    """
+    return await letta_router.stats()
+
+@router.post("/{user_id}/migrate", status_code=202, dependencies=[Depends(require_admin)])
+async def migrate_user_agents(
+    user_id: str,
+    node: str = Query(..., description="Servidor Letta de destino"),
+    delete_source: bool = Query(True, description="Apaga os agentes do servidor de origem depois da cópia"),
+):
+    """
+    Agenda a migração dos agentes do usuário para outro servidor Letta (core memory e memória arquivística).
+    O andamento fica em `GET /agents/migrations/{job_id}`.
+    """
+    if node not in letta_router.nodes:
+        raise HTTPException(status_code=404, detail=f"Nó {node} não configurado.")
+    if not await UserRepository().get_user_by_id(user_id):
+        raise HTTPException(status_code=404, detail=f"Usuário {user_id} não encontrado.")
+    return await enqueue_migration(user_id, node, delete_source=delete_source)
+
+@router.get("/migrations/{job_id}", dependencies=[Depends(require_admin)])
+async def get_migration(job_id: str):
+    """
+    Estado de uma migração agendada: queued, running, done ou failed.
+    """
+    job = await migration_status(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Migração {job_id} não encontrada.")
+    return job
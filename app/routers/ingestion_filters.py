@@ -0,0 +1,29 @@
+from typing import List
+from fastapi import APIRouter, Body, Depends, HTTPException
+
+from app.core.security import require_admin
+from app.services.ingestion_filters import ingestion_filters
+
+router = APIRouter(prefix="/ingestion-filters", tags=["IngestionFilters"])
+
+@router.get("/{phone}", dependencies=[Depends(require_admin)])
+async def get_user_filters(phone: str):
+    """
+    Lista as regras de descarte da sessão pessoal do usuário.
+    """
+    rules = await ingestion_filters.get_user_rules(phone)
+    return {"phone": phone, "rules": [rule.to_dict() for rule in rules]}
+
+@router.put("/{phone}", dependencies=[Depends(require_admin)])
+async def set_user_filters(
+    phone: str,
+    rules: List[dict] = Body(..., description="Regras, ex.: [{\"name\": \"grupo_mutado\", \"group_ids\": [\"1203630@g.us\"]}]")
+):
+    """
+    Substitui as regras de descarte da sessão pessoal do usuário.
+    """
+    try:
+        compiled = await ingestion_filters.set_user_rules(phone, rules)
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Regra inválida: {e}")
+    return {"phone": phone, "rules": [rule.to_dict() for rule in compiled]}
@@ -0,0 +1,138 @@
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, Query
+
+from app.core.security import require_admin
+
+from app.services.webhook_stream import WebhookEventStream
+from app.services.webhook_dedup import webhook_deduplicator
+from app.utils.archival_memory_manager import archival_buffer
+from app.services.ingestion_filters import ingestion_filters
+from app.services.rate_limiter import webhook_rate_limiter
+from app.services.outbound_queue import outbound_queue
+from app.services.wpp_token_manager import wpp_tokens
+from app.services.media_pipeline import media_pipeline
+from app.services.session_events import session_events
+from app.services.session_health import session_health
+from app.services.agent_directory import agent_directory
+from app.services.run_poller import run_poller
+from app.services.agent_pool import agent_pool
+from app.services.agent_reconciler import agent_reconciler
+from app.services.agent_mailbox import agent_mailbox
+
+router = APIRouter(prefix="/metrics", tags=["Metrics"], dependencies=[Depends(require_admin)])
+
+@router.get("/webhook-shards")
+async def webhook_shards():
+    """
+    Lag por shard do stream de eventos do webhook, para dimensionar o pool de workers.
+    """
+    stream = WebhookEventStream()
+    shards = await stream.shard_metrics()
+    return {
+        "shard_count": stream.shard_count,
+        "total_lag": sum(shard["lag"] for shard in shards),
+        "total_pending": sum(shard["pending"] for shard in shards),
+        "owned_shards": sum(1 for shard in shards if shard["owner"]),
+        "shards": shards
+    }
+
+@router.get("/webhook-dedup")
+async def webhook_dedup():
+    """
+    Contadores de deduplicação de eventos do webhook (por processo).
+    """
+    return webhook_deduplicator.stats()
+
+@router.get("/archival-buffer")
+async def archival_buffer_stats():
+    """
+    Estado do buffer de inserções na memória arquivística (por processo).
+    """
+    return archival_buffer.stats()
+
+@router.get("/ingestion-filters")
+async def ingestion_filter_stats():
+    """
+    Descartes por regra do filtro de ingestão (por processo).
+    """
+    return ingestion_filters.stats()
+
+@router.get("/rate-limits")
+async def rate_limits(key: Optional[List[str]] = Query(None)):
+    """
+    Estado dos token buckets do controle de admissão do webhook (global e por remetente/sessão).
+    """
+    return await webhook_rate_limiter.bucket_state(keys=key)
+
+@router.get("/outbound-queue")
+async def outbound_queue_stats():
+    """
+    Destinatários aguardando envio, dead letter e contadores da fila de envio do WhatsApp.
+    """
+    return await outbound_queue.stats()
+
+@router.get("/wpp-tokens")
+async def wpp_token_stats():
+    """
+    Renovações de tokens das sessões do WPPConnect (por processo).
+    """
+    return wpp_tokens.stats()
+
+@router.get("/media-pipeline")
+async def media_pipeline_stats():
+    """
+    Downloads de mídia: fila, armazenadas, deduplicadas e descartadas (por processo).
+    """
+    return await media_pipeline.stats()
+
+@router.get("/session-events")
+async def session_event_stats():
+    """
+    Eventos de QR Code e status de sessão publicados no pub/sub (por processo).
+    """
+    return session_events.stats()
+
+@router.get("/session-health")
+async def session_health_summary():
+    """
+    Sessões pessoais do WhatsApp agrupadas em healthy, degraded e dead (última verificação do monitor).
+    """
+    return await session_health.summary()
+
+@router.get("/agent-directory")
+async def agent_directory_stats():
+    """
+    Acertos no cache local e no Redis e consultas ao Letta do índice de agentes (por processo).
+    """
+    return agent_directory.stats()
+
+@router.get("/run-poller")
+async def run_poller_stats():
+    """
+    Runs do Letta em acompanhamento (pendentes e vencidas) e contadores do worker de runs.
+    """
+    return await run_poller.stats()
+
+@router.get("/agent-pool")
+async def agent_pool_stats():
+    """
+    Tamanho alvo e estoque do pool de agentes pré-criados, e conjuntos retirados e criados (por processo).
+    """
+    return await agent_pool.stats()
+
+@router.get("/agent-reconciler")
+async def agent_reconciler_report():
+    """
+    Relatório da última reconciliação de agentes (órfãos, duplicatas, apagados e religados).
+    """
+    return await agent_reconciler.last_report() or {}
+
+@router.get("/agent-mailbox")
+async def agent_mailbox_stats(agent_id: Optional[str] = Query(None, description="Agente específico")):
+    """
+    Agentes com mensagens aguardando a run atual (fila e espera); com `agent_id`, os contadores do agente.
+    """
+    if agent_id:
+        return await agent_mailbox.agent_stats(agent_id)
+    return await agent_mailbox.stats()
@@ -6,7 +6,7 @@ from fastapi import APIRouter, Body, HTTPException, Query, Request
 
 from app.flows.google_integration_flow import GoogleIntegrationFlow
 from app.services.google_service import GoogleService
-from app.services.letta_service import get_phone_tag
+from app.services.agent_directory import agent_directory
 from app.services.user_service import UserRepository
 from app.flows.whatsapp_integration_flow import WhatsappIntegrationFlow
 import logging
@@ -30,11 +30,15 @@ def validate_phone(phone: str) -> None:
         
 async def get_user_by_agent_id(agent_id: str):
     """
-    Recupera o usuário associado a um agente com base nas tags.
+    Recupera o usuário associado a um agente (índice em cache, ver `agent_directory`).
     """
     try:
-        phone = get_phone_tag(agent_id)
-        user = await user_repo.get_user_by_phone(phone)
+        info = await agent_directory.agent_info_async(agent_id)
+        if info.get("user_id"):
+            return await user_repo.get_user_by_id(info["user_id"])
+        user = await user_repo.get_user_by_phone(info.get("phone"))
+        if user:
+            await agent_directory.set_user_id_async(agent_id, user.id)
         return user
     except Exception as e:
         logger.error(f"Erro ao recuperar usuário {agent_id}: {e}")
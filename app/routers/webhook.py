@@ -1,8 +1,11 @@
-import json
+import math
+import msgspec
 from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import JSONResponse
 
-from app.services.webhook_service import WebhookService
-from app.utils.integration_manager import whatsapp_session_status_manager
+from app.services.session_events import SESSION_EVENTS, publish_session_event
+from app.services.webhook_ingestion import admit_event, claim_event, dispatch_event
+from app.utils.webhook_parser import PayloadTooLarge, decode_event, decode_header, is_ignorable, read_body_capped
 
 router = APIRouter(prefix="/webhook", tags=["Webhook"])
 
@@ -12,23 +15,49 @@ async def webhook_handler(request: Request):
     Rota para receber eventos e processar apenas mensagens (onmessage).
     """
     try:
-        body = await request.body()
+        body = await read_body_capped(request)
         if not body:
             raise HTTPException(status_code=400, detail="O corpo da requisição está vazio.")
 
-        payload = json.loads(body.decode("utf-8"))
-        
-        if payload.get('event') == 'onmessage':
-            data = await WebhookService.process_onmessage_event(payload)
-            return {"status": "success", "event": "onmessage", "data": data}
-        
-        if payload.get('event') == 'status-find':
-            await whatsapp_session_status_manager(payload.get('session'), payload.get('status'))
-            return {"status": "success", "event": "status-find"}
+        # Decide pelo cabeçalho (event/type/session) antes de decodificar o payload inteiro.
+        header = decode_header(body)
+        if is_ignorable(header):
+            return {"status": "ignored", "message": "Evento não processado."}
 
-        return {"status": "ignored", "message": "Evento não processado."}
+        payload = decode_event(body, header.event)
 
-    except json.JSONDecodeError:
+        # QR Code e status da sessão vão direto para o pub/sub (flows aguardando), sem cota.
+        if header.event in SESSION_EVENTS:
+            await publish_session_event(payload)
+            if header.event == "qrcode":
+                return {"status": "published", "event": "qrcode"}
+
+        # Reentregas são descartadas antes do controle de admissão, sem consumir cota.
+        duplicate, dedup_key = await claim_event(payload)
+        if duplicate:
+            return {"status": "duplicate", "event": header.event}
+
+        # Eventos acima da cota são adiados (202) ou descartados (429), conforme a política.
+        rejected = await admit_event(payload, dedup_key)
+        if rejected:
+            if rejected["status"] == "deferred":
+                return JSONResponse(status_code=202, content=rejected)
+            retry_after = str(max(1, math.ceil(rejected["retry_after_ms"] / 1000)))
+            return JSONResponse(status_code=429, content=rejected, headers={"Retry-After": retry_after})
+
+        result = await dispatch_event(payload, dedup_key)
+        if result.get("status") == "accepted":
+            return JSONResponse(status_code=202, content=result)
+        return result
+
+    except PayloadTooLarge as e:
+        # Um 4xx faria o WPPConnect reenviar o mesmo corpo; 413 só para eventos que seriam processados.
+        if e.header and is_ignorable(e.header):
+            return {"status": "ignored", "message": "Evento não processado."}
+        raise HTTPException(status_code=413, detail=str(e))
+    except msgspec.ValidationError as e:
+        raise HTTPException(status_code=400, detail=f"Payload inválido: {e}")
+    except msgspec.DecodeError:
         raise HTTPException(status_code=400, detail="Formato de JSON inválido.")
     
 # @router.post("/")
@@ -40,4 +69,4 @@ async def webhook_handler(request: Request):
 #         return 
 
 #     except json.JSONDecodeError:
-#         raise HTTPException(status_code=400, detail="Formato de JSON inválido.")
\ No newline at end of file
+#         raise HTTPException(status_code=400, detail="Formato de JSON inválido.")
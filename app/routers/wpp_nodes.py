@@ -0,0 +1,46 @@
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
+
+from app.core.security import require_admin
+from app.services.session_router import session_router
+from app.services.session_rebalancer import rebalance
+
+router = APIRouter(prefix="/wpp-nodes", tags=["WppNodes"])
+
+@router.get("/", dependencies=[Depends(require_admin)])
+async def list_nodes():
+    """
+    Servidores WPPConnect configurados, sessões atribuídas a cada um e nós em drenagem.
+    """
+    return await session_router.stats()
+
+@router.post("/{node}/drain", dependencies=[Depends(require_admin)])
+async def drain_node(node: str, move: bool = Query(True, description="Move as sessões do nó imediatamente")):
+    """
+    Coloca o nó em drenagem (não recebe sessões novas) e, por padrão, move as sessões dele.
+    """
+    if node not in session_router.nodes:
+        raise HTTPException(status_code=404, detail=f"Nó {node} não configurado.")
+    await session_router.drain(node)
+    result = await rebalance(node=node) if move else None
+    return {"node": node, "draining": True, "rebalance": result}
+
+@router.post("/{node}/undrain", dependencies=[Depends(require_admin)])
+async def undrain_node(node: str):
+    """
+    Tira o nó da drenagem. As sessões só voltam para ele com um rebalanceamento.
+    """
+    if node not in session_router.nodes:
+        raise HTTPException(status_code=404, detail=f"Nó {node} não configurado.")
+    await session_router.undrain(node)
+    return {"node": node, "draining": False}
+
+@router.post("/rebalance", dependencies=[Depends(require_admin)])
+async def rebalance_nodes(
+    node: Optional[str] = Query(None, description="Limita às sessões que saem ou vão para o nó"),
+    dry_run: bool = Query(False, description="Só lista as mudanças"),
+):
+    """
+    Move cada sessão para o nó indicado pelo anel de hash consistente.
+    """
+    return await rebalance(node=node, dry_run=dry_run)
@@ -10,8 +10,12 @@ class UserBase(BaseModel):
     cpf: Optional[str] = Field(None, pattern=r'^\d{11}$', description="CPF com 11 dígitos")  # CPF validado por regex
     integration_is_running: Optional[str] = Field(None, description="Indica se uma integração está em execução")
     id_main_agent: Optional[str] = Field(None, description="Identificador do agente principal")
+    id_onboarding_agent: Optional[str] = Field(None, description="Identificador do agente de onboarding")
+    id_background_agent: Optional[str] = Field(None, description="Identificador do agente background")
+    letta_node: Optional[str] = Field(None, max_length=64, description="Servidor Letta dos agentes do usuário")
     id_session_wpp: Optional[str] = Field(None, description="Identificador da sessão do WhatsApp")
     token_wpp: Optional[str] = Field(None, max_length=255, description="Token do WhatsApp")
+    wpp_node: Optional[str] = Field(None, max_length=64, description="Servidor WPPConnect da sessão do WhatsApp")
     whatsapp_integration: Optional[bool] = Field(False, description="Indica integração com o WhatsApp")
     google_calendar_integration: Optional[bool] = Field(False, description="Indica integração com o Google Calendar")
     apple_calendar_integration: Optional[bool] = Field(False, description="Indica integração com o Apple Calendar")
@@ -0,0 +1,52 @@
+from typing import Any, Dict, Optional, Union
+
+import msgspec
+
+
+class EventHeader(msgspec.Struct):
+    """Campos usados para decidir se o evento é processado, antes do decode completo."""
+    event: Optional[str] = None
+    type: Optional[str] = None
+    session: Optional[str] = None
+
+
+class Sender(msgspec.Struct):
+    id: str
+    pushname: Optional[str] = None
+    isMe: bool = False
+
+
+class OnMessageEvent(msgspec.Struct):
+    """Evento `onmessage` do WPPConnect (somente os campos usados pelo sistema)."""
+    event: str
+    session: str
+    sender: Sender
+    id: Union[str, Dict[str, Any], None] = None
+    type: Optional[str] = None
+    body: Optional[str] = None
+    t: Optional[int] = None
+    notifyName: Optional[str] = None
+    from_: Optional[str] = msgspec.field(default=None, name="from")
+    to: Optional[str] = None
+    isGroupMsg: bool = False
+    fromMe: bool = False
+    # Mensagens de mídia
+    mimetype: Optional[str] = None
+    caption: Optional[str] = None
+    filename: Optional[str] = None
+    size: Optional[int] = None
+
+
+class StatusFindEvent(msgspec.Struct):
+    """Evento `status-find` do WPPConnect."""
+    event: str
+    session: str
+    status: Optional[str] = None
+
+
+class QrCodeEvent(msgspec.Struct):
+    """Evento `qrcode` do WPPConnect (QR Code gerado ou renovado)."""
+    event: str
+    session: str
+    qrcode: Optional[str] = None
+    urlcode: Optional[str] = None
@@ -0,0 +1,322 @@
+import os
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+
+from dotenv import load_dotenv
+
+from app.services.letta_router import letta_router
+from app.utils.redis_connection import get_async_redis, get_sync_redis
+
+load_dotenv()
+
+# Papéis dos agentes de cada usuário (tags do Letta).
+AGENT_ROLES = ("onboarding", "main", "background")
+
+
+def role_of(tags: Iterable[str]) -> Optional[str]:
+    tags = set(tags or ())
+    return next((role for role in AGENT_ROLES if role in tags), None)
+
+
+def phone_of(tags: Iterable[str]) -> Optional[str]:
+    return next((tag for tag in tags or () if re.search(r'\d+', tag)), None)
+
+
+class LocalTTLCache:
+    """
+    LRU em memória com TTL por entrada (thread-safe, usado também nos workers do Celery).
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._data.get(key)
+            if not item:
+                return None
+            if item[1] <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[0]
+
+    def set(self, key: str, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class AgentDirectory:
+    """
+    Índice agente ↔ usuário, para não consultar o Letta a cada mensagem.
+
+    - agente → telefone, papel (onboarding/main/background), tags e user_id
+      (`agent:dir:<agent_id>`);
+    - telefone → IDs dos agentes de onboarding, principal e background
+      (`agent:dir:phone:<telefone>`).
+
+    Dois níveis: LRU em memória (`AGENT_DIRECTORY_LOCAL_SIZE` entradas por
+    `AGENT_DIRECTORY_LOCAL_TTL` segundos) e hashes no Redis
+    (`AGENT_DIRECTORY_TTL`). Em caso de falta nos dois, o Letta é consultado e
+    o resultado é gravado. O índice é preenchido na criação dos agentes
+    (`register`) e invalidado no reprovisionamento (`invalidate`); os demais
+    processos enxergam a invalidação quando a entrada local expira.
+
+    Os métodos com sufixo `_async` usam o Redis e o cliente Letta assíncronos
+    e são os que devem ser chamados no event loop.
+    """
+
+    def __init__(self):
+        self.ttl = int(os.getenv("AGENT_DIRECTORY_TTL", "86400"))
+        local_ttl = float(os.getenv("AGENT_DIRECTORY_LOCAL_TTL", "60"))
+        local_size = int(os.getenv("AGENT_DIRECTORY_LOCAL_SIZE", "10000"))
+        self.local_ttl = local_ttl
+        self._agents = LocalTTLCache(local_size, local_ttl)
+        self._phones = LocalTTLCache(local_size, local_ttl)
+        self.counters = {"local_hits": 0, "redis_hits": 0, "letta_lookups": 0, "registered": 0, "invalidated": 0}
+
+    @staticmethod
+    def _agent_key(agent_id: str) -> str:
+        return f"agent:dir:{agent_id}"
+
+    @staticmethod
+    def _phone_key(phone: str) -> str:
+        return f"agent:dir:phone:{phone}"
+
+    def _agent_mapping(self, info: dict) -> dict:
+        return {key: value or "" for key, value in info.items()}
+
+    @staticmethod
+    def _info_from_agent(agent) -> dict:
+        return {"phone": phone_of(agent.tags), "role": role_of(agent.tags), "tags": ",".join(agent.tags or []), "user_id": None}
+
+    @staticmethod
+    def _agents_from_list(found) -> Dict[str, Optional[str]]:
+        agents = {role: None for role in AGENT_ROLES}
+        for agent in found:
+            role = role_of(agent.tags)
+            if role and not agents[role]:
+                agents[role] = agent.id
+        return agents
+
+    @staticmethod
+    def _registration(phone: str, user_id: str, agents: Dict[str, Optional[str]]) -> Dict[str, dict]:
+        infos = {}
+        for role, agent_id in agents.items():
+            if agent_id:
+                tags = [phone, "worker", role] if role == "onboarding" else [phone, role]
+                infos[agent_id] = {"phone": phone, "role": role, "tags": ",".join(tags), "user_id": user_id}
+        return infos
+
+    def _write_registration(self, pipe, phone: str, agents: Dict[str, Optional[str]], infos: Dict[str, dict]):
+        pipe.hset(self._phone_key(phone), mapping={role: agent_id or "" for role, agent_id in agents.items()})
+        pipe.expire(self._phone_key(phone), self.ttl)
+        for agent_id, info in infos.items():
+            pipe.hset(self._agent_key(agent_id), mapping=self._agent_mapping(info))
+            pipe.expire(self._agent_key(agent_id), self.ttl)
+
+    def _remember_registration(self, phone: str, agents: Dict[str, Optional[str]], infos: Dict[str, dict]):
+        for agent_id, info in infos.items():
+            self._agents.set(agent_id, info)
+        self._phones.set(phone, agents)
+        self.counters["registered"] += 1
+
+    def _invalidation(self, phone: Optional[str], agent_ids: Iterable[str], cached: Dict[str, Optional[str]]) -> list:
+        agent_ids = {agent_id for agent_id in agent_ids if agent_id}
+        agent_ids.update(agent_id for agent_id in cached.values() if agent_id)
+        for agent_id in agent_ids:
+            self._agents.pop(agent_id)
+        if phone:
+            self._phones.pop(phone)
+        self.counters["invalidated"] += 1
+        return [self._agent_key(agent_id) for agent_id in agent_ids] + ([self._phone_key(phone)] if phone else [])
+
+    def _local_agent(self, agent_id: str) -> Optional[dict]:
+        info = self._agents.get(agent_id)
+        if info is not None:
+            self.counters["local_hits"] += 1
+        return info
+
+    def _local_phone(self, phone: str) -> Optional[Dict[str, Optional[str]]]:
+        agents = self._phones.get(phone)
+        if agents is not None:
+            self.counters["local_hits"] += 1
+        return agents
+
+    def _from_redis_agent(self, agent_id: str, data: dict) -> Optional[dict]:
+        if not data:
+            return None
+        self.counters["redis_hits"] += 1
+        info = {key: value or None for key, value in data.items()}
+        self._agents.set(agent_id, info)
+        return info
+
+    def _from_redis_phone(self, phone: str, data: dict) -> Optional[Dict[str, Optional[str]]]:
+        if not data:
+            return None
+        self.counters["redis_hits"] += 1
+        agents = {role: data.get(role) or None for role in AGENT_ROLES}
+        self._phones.set(phone, agents)
+        return agents
+
+    # Versão síncrona (tasks do Celery)
+
+    def agent_info(self, agent_id: str) -> dict:
+        """
+        {"phone", "role", "tags", "user_id"} do agente ({} se ele não existir).
+        """
+        info = self._local_agent(agent_id) or self._from_redis_agent(agent_id, get_sync_redis().hgetall(self._agent_key(agent_id)))
+        if info is not None:
+            return info
+
+        self.counters["letta_lookups"] += 1
+        try:
+            agent = letta_router.client_for_agent_sync(agent_id).agents.retrieve(agent_id)
+        except Exception as e:
+            logging.error(f"Erro ao recuperar agente {agent_id}: {e}")
+            return {}
+        info = self._info_from_agent(agent)
+        self._store_agent(agent_id, info)
+        return info
+
+    def _store_agent(self, agent_id: str, info: dict):
+        redis = get_sync_redis()
+        redis.hset(self._agent_key(agent_id), mapping=self._agent_mapping(info))
+        redis.expire(self._agent_key(agent_id), self.ttl)
+        self._agents.set(agent_id, info)
+
+    def agents_for_phone(self, phone: str) -> Dict[str, Optional[str]]:
+        """
+        {"onboarding", "main", "background"} → ID do agente do usuário (None se não existir).
+        """
+        agents = self._local_phone(phone) or self._from_redis_phone(phone, get_sync_redis().hgetall(self._phone_key(phone)))
+        if agents is not None:
+            return agents
+
+        # Uma única listagem pelo telefone traz os três agentes.
+        self.counters["letta_lookups"] += 1
+        try:
+            agents = self._agents_from_list(letta_router.client_for_user_sync(phone).agents.list(tags=[phone]))
+        except Exception as e:
+            logging.error(f"Erro ao buscar os agentes do usuário {phone}: {e}")
+            return {role: None for role in AGENT_ROLES}
+        if any(agents.values()):
+            self.register(phone, **agents)
+        return agents
+
+    def agent_id(self, phone: str, role: str) -> Optional[str]:
+        return self.agents_for_phone(phone).get(role)
+
+    def register(self, phone: str, user_id: str = None, onboarding: str = None, main: str = None, background: str = None):
+        """
+        Grava os agentes do usuário nos dois sentidos (chamado na criação dos agentes).
+        """
+        agents = {"onboarding": onboarding, "main": main, "background": background}
+        infos = self._registration(phone, user_id, agents)
+        with get_sync_redis().pipeline(transaction=False) as pipe:
+            self._write_registration(pipe, phone, agents, infos)
+            pipe.execute()
+        self._remember_registration(phone, agents, infos)
+
+    def set_user_id(self, agent_id: str, user_id: str):
+        """
+        Completa o user_id de um agente descoberto pelo Letta.
+        """
+        info = self.agent_info(agent_id)
+        if info:
+            self._store_agent(agent_id, {**info, "user_id": user_id})
+
+    def invalidate(self, phone: str = None, agent_ids: Iterable[str] = ()):
+        """
+        Remove as entradas do usuário e dos agentes (reprovisionamento).
+        """
+        cached = {role: value or None for role, value in get_sync_redis().hgetall(self._phone_key(phone)).items()} if phone else {}
+        keys = self._invalidation(phone, agent_ids, cached)
+        if keys:
+            get_sync_redis().delete(*keys)
+
+    # Versão assíncrona (FastAPI, flows e workers)
+
+    async def agent_info_async(self, agent_id: str) -> dict:
+        info = self._local_agent(agent_id) or self._from_redis_agent(agent_id, await get_async_redis().hgetall(self._agent_key(agent_id)))
+        if info is not None:
+            return info
+
+        self.counters["letta_lookups"] += 1
+        try:
+            letta = await letta_router.client_for_agent(agent_id)
+            agent = await letta.agents.retrieve(agent_id)
+        except Exception as e:
+            logging.error(f"Erro ao recuperar agente {agent_id}: {e}")
+            return {}
+        info = self._info_from_agent(agent)
+        await self._store_agent_async(agent_id, info)
+        return info
+
+    async def _store_agent_async(self, agent_id: str, info: dict):
+        redis = get_async_redis()
+        await redis.hset(self._agent_key(agent_id), mapping=self._agent_mapping(info))
+        await redis.expire(self._agent_key(agent_id), self.ttl)
+        self._agents.set(agent_id, info)
+
+    async def agents_for_phone_async(self, phone: str) -> Dict[str, Optional[str]]:
+        agents = self._local_phone(phone) or self._from_redis_phone(phone, await get_async_redis().hgetall(self._phone_key(phone)))
+        if agents is not None:
+            return agents
+
+        self.counters["letta_lookups"] += 1
+        try:
+            letta = await letta_router.client_for_user(phone)
+            agents = self._agents_from_list(await letta.agents.list(tags=[phone]))
+        except Exception as e:
+            logging.error(f"Erro ao buscar os agentes do usuário {phone}: {e}")
+            return {role: None for role in AGENT_ROLES}
+        if any(agents.values()):
+            await self.register_async(phone, **agents)
+        return agents
+
+    async def agent_id_async(self, phone: str, role: str) -> Optional[str]:
+        return (await self.agents_for_phone_async(phone)).get(role)
+
+    async def register_async(self, phone: str, user_id: str = None, onboarding: str = None, main: str = None, background: str = None):
+        agents = {"onboarding": onboarding, "main": main, "background": background}
+        infos = self._registration(phone, user_id, agents)
+        async with get_async_redis().pipeline(transaction=False) as pipe:
+            self._write_registration(pipe, phone, agents, infos)
+            await pipe.execute()
+        self._remember_registration(phone, agents, infos)
+
+    async def set_user_id_async(self, agent_id: str, user_id: str):
+        info = await self.agent_info_async(agent_id)
+        if info:
+            await self._store_agent_async(agent_id, {**info, "user_id": user_id})
+
+    async def invalidate_async(self, phone: str = None, agent_ids: Iterable[str] = ()):
+        redis = get_async_redis()
+        cached = {role: value or None for role, value in (await redis.hgetall(self._phone_key(phone))).items()} if phone else {}
+        keys = self._invalidation(phone, agent_ids, cached)
+        if keys:
+            await redis.delete(*keys)
+
+    def stats(self) -> dict:
+        return {**self.counters, "local_agents": len(self._agents), "local_phones": len(self._phones), "pid": os.getpid()}
+
+
+agent_directory = AgentDirectory()
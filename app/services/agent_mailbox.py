@@ -0,0 +1,298 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from app.services.message_coalescer import MessageCoalescer
+from app.utils.redis_connection import get_async_redis, get_sync_redis
+
+load_dotenv()
+
+# Mensagens com este prefixo (avisos das integrações e do monitor de sessões) vão na frente.
+SYSTEM_PREFIX = "SYSTEM MESSAGE"
+# Deslocamento do score das mensagens de sistema: ficam antes de qualquer mensagem do usuário.
+SYSTEM_PRIORITY = 10 ** 10
+
+# Coloca a mensagem na caixa e tenta pegar a vez do agente.
+# Com a vez, retira e retorna a caixa inteira; sem ela, retorna nil (a mensagem aguarda).
+SUBMIT_SCRIPT = """
+redis.call('ZADD', KEYS[2], ARGV[4], ARGV[3])
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    local items = redis.call('ZRANGE', KEYS[2], 0, -1)
+    redis.call('DEL', KEYS[2])
+    redis.call('SREM', KEYS[3], ARGV[5])
+    return items
+end
+redis.call('EXPIRE', KEYS[2], ARGV[7])
+local depth = redis.call('ZCARD', KEYS[2])
+redis.call('HINCRBY', KEYS[4], 'queued', 1)
+if depth > tonumber(redis.call('HGET', KEYS[4], 'max_depth') or '0') then
+    redis.call('HSET', KEYS[4], 'max_depth', depth)
+end
+redis.call('EXPIRE', KEYS[4], ARGV[6])
+redis.call('SADD', KEYS[3], ARGV[5])
+return false
+"""
+
+# Fim da run de quem tem a vez: retorna as mensagens que aguardavam (mantendo a
+# vez) ou, sem nenhuma, libera a vez e retorna {}. Se a vez é de outro, retorna nil.
+COMPLETE_SCRIPT = """
+local holder = redis.call('GET', KEYS[1])
+if holder and holder ~= ARGV[1] then
+    return false
+end
+redis.call('SREM', KEYS[3], ARGV[3])
+local items = redis.call('ZRANGE', KEYS[2], 0, -1)
+if #items == 0 then
+    redis.call('DEL', KEYS[1])
+    return {}
+end
+redis.call('DEL', KEYS[2])
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return items
+"""
+
+# Renova a vez se ela ainda for de ARGV[1] (runs longas e envios refeitos). Retorna 1 se renovou.
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Caixa de um agente sem vez (quem a tinha morreu antes de passá-la adiante): pega a
+# vez e retira a caixa inteira. Com a vez ocupada, retorna nil; sem mensagens, {}.
+SWEEP_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return false
+end
+redis.call('SREM', KEYS[3], ARGV[3])
+local items = redis.call('ZRANGE', KEYS[2], 0, -1)
+if #items == 0 then
+    return {}
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('DEL', KEYS[2])
+return items
+"""
+
+# Grava ARGV[1] no campo ARGV[2] do hash se for maior que o valor atual.
+SET_MAX_SCRIPT = """
+if tonumber(redis.call('HGET', KEYS[1], ARGV[2]) or '0') < tonumber(ARGV[1]) then
+    redis.call('HSET', KEYS[1], ARGV[2], ARGV[1])
+end
+"""
+
+
+def is_system_message(message: str) -> bool:
+    return (message or "").lstrip().startswith(SYSTEM_PREFIX)
+
+
+class AgentMailbox:
+    """
+    Caixa de entrada por agente: uma run do Letta por agente de cada vez.
+
+    Quem envia a mensagem pega a vez do agente (`mailbox:<agent_id>:lease`,
+    com TTL curto, de `AGENT_MAILBOX_LEASE_TTL` segundos, renovado a cada
+    consulta da run, a cada envio refeito e, durante o streaming, por um
+    heartbeat; só expira se quem a tinha morreu). Enquanto a vez estiver ocupada, as mensagens novas
+    aguardam no zset `mailbox:<agent_id>:queue`. No fim da run (stream
+    encerrado ou run concluída no `run_poller`), as mensagens que aguardavam
+    são retiradas de uma vez e enviadas como uma única mensagem
+    (`MessageCoalescer.merge_messages`), com as de sistema (`SYSTEM_PREFIX`)
+    na frente; sem mensagens, a vez é liberada. O envio dessas mensagens vai
+    para uma nova task (`send_message_task`, com a mesma vez), que o refaz
+    após `AGENT_MAILBOX_RETRY_DELAY` segundos se falhar.
+
+    Se quem tinha a vez morre antes de passá-la adiante, o worker da caixa
+    (`sweep`, a cada `AGENT_MAILBOX_SWEEP_INTERVAL` segundos) pega a vez dos
+    agentes de `mailbox:agents` sem vez e envia as mensagens que aguardavam.
+    A fila só expira após `AGENT_MAILBOX_QUEUE_TTL` segundos sem mensagens novas.
+
+    Por agente, `mailbox:<agent_id>:stats` guarda quantas mensagens aguardaram,
+    a maior fila, quantas foram entregues em quantas runs e o tempo de espera
+    (total, máximo e último). `mailbox:agents` lista os agentes com fila.
+    """
+
+    AGENTS_KEY = "mailbox:agents"
+
+    def __init__(self):
+        self.enabled = os.getenv("AGENT_MAILBOX_ENABLED", "true").lower() == "true"
+        self.lease_ttl = int(os.getenv("AGENT_MAILBOX_LEASE_TTL", "120"))
+        self.queue_ttl = int(os.getenv("AGENT_MAILBOX_QUEUE_TTL", "86400"))
+        self.sweep_interval = float(os.getenv("AGENT_MAILBOX_SWEEP_INTERVAL", "15"))
+        self.stats_ttl = int(os.getenv("AGENT_MAILBOX_STATS_TTL", "604800"))
+        self.retry_delay = float(os.getenv("AGENT_MAILBOX_RETRY_DELAY", "5"))
+
+    @staticmethod
+    def _keys(agent_id: str) -> List[str]:
+        return [f"mailbox:{agent_id}:lease", f"mailbox:{agent_id}:queue"]
+
+    @staticmethod
+    def _stats_key(agent_id: str) -> str:
+        return f"mailbox:{agent_id}:stats"
+
+    @staticmethod
+    def _item(message: str, timestamp: Optional[float]) -> Tuple[str, float]:
+        timestamp = timestamp or time.time()
+        score = timestamp - SYSTEM_PRIORITY if is_system_message(message) else timestamp
+        return json.dumps({"id": uuid.uuid4().hex, "message": message, "timestamp": timestamp}), score
+
+    def _submit_args(self, agent_id: str, lease: str, message: str, timestamp: Optional[float]) -> list:
+        item, score = self._item(message, timestamp)
+        return [
+            SUBMIT_SCRIPT, 4, *self._keys(agent_id), self.AGENTS_KEY, self._stats_key(agent_id),
+            lease, self.lease_ttl, item, score, agent_id, self.stats_ttl, self.queue_ttl,
+        ]
+
+    def _complete_args(self, agent_id: str, lease: str) -> list:
+        return [COMPLETE_SCRIPT, 3, *self._keys(agent_id), self.AGENTS_KEY, lease, self.lease_ttl, agent_id]
+
+    @staticmethod
+    def fold(items: List[dict]) -> str:
+        """
+        Une as mensagens retiradas da caixa (as de sistema já vêm na frente).
+        """
+        return MessageCoalescer.merge_messages(items)
+
+    def _delivery(self, items: List[dict]) -> dict:
+        now = time.time()
+        waits = [max(0, int((now - item["timestamp"]) * 1000)) for item in items]
+        return {"delivered": len(items), "wait_ms_total": sum(waits), "wait_ms_max": max(waits), "last_wait_ms": waits[-1]}
+
+    # Versão síncrona (tasks do Celery)
+
+    def submit(self, agent_id: str, message: str, timestamp: Optional[float] = None) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Entrega a mensagem à caixa do agente. Retorna (vez, mensagem a enviar) se
+        o agente estava livre, ou (None, None) se a mensagem ficou aguardando a run atual.
+        """
+        lease = uuid.uuid4().hex
+        raw = get_sync_redis().eval(*self._submit_args(agent_id, lease, message, timestamp))
+        if raw is None:
+            return None, None
+        return lease, self._take(agent_id, raw)
+
+    def complete(self, agent_id: str, lease: str) -> Optional[str]:
+        """
+        Fim da run de quem tem a vez: retorna a próxima mensagem (as que aguardavam,
+        unidas), ou None se a caixa estava vazia e a vez foi liberada.
+        """
+        raw = get_sync_redis().eval(*self._complete_args(agent_id, lease))
+        return self._take(agent_id, raw) if raw else None
+
+    def renew(self, agent_id: str, lease: str) -> bool:
+        """
+        Renova a vez; False se ela expirou (ou já é de outro).
+        """
+        return bool(get_sync_redis().eval(RENEW_SCRIPT, 1, self._keys(agent_id)[0], lease, self.lease_ttl))
+
+    @contextmanager
+    def heartbeat(self, agent_id: str, lease: Optional[str]):
+        """
+        Renova a vez a cada terço do TTL enquanto o bloco roda (ex.: resposta em streaming).
+        """
+        if not lease:
+            yield
+            return
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.lease_ttl / 3):
+                try:
+                    if not self.renew(agent_id, lease):
+                        logging.warning(f"A vez do agente {agent_id} expirou durante o envio.")
+                        return
+                except Exception as e:
+                    logging.warning(f"Erro ao renovar a vez do agente {agent_id}: {e}")
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+
+    def _take(self, agent_id: str, raw: List[str]) -> str:
+        items = [json.loads(item) for item in raw]
+        self._record(get_sync_redis().pipeline(transaction=False), agent_id, items).execute()
+        return self.fold(items)
+
+    def _record(self, pipe, agent_id: str, items: List[dict]):
+        delivery = self._delivery(items)
+        key = self._stats_key(agent_id)
+        pipe.hincrby(key, "runs", 1)
+        pipe.hincrby(key, "delivered", delivery["delivered"])
+        pipe.hincrby(key, "wait_ms_total", delivery["wait_ms_total"])
+        pipe.hset(key, "last_wait_ms", delivery["last_wait_ms"])
+        pipe.eval(SET_MAX_SCRIPT, 1, key, delivery["wait_ms_max"], "wait_ms_max")
+        pipe.expire(key, self.stats_ttl)
+        return pipe
+
+    # Versão assíncrona (worker de runs e métricas)
+
+    async def renew_async(self, agent_id: str, lease: str) -> bool:
+        return bool(await get_async_redis().eval(RENEW_SCRIPT, 1, self._keys(agent_id)[0], lease, self.lease_ttl))
+
+    async def complete_async(self, agent_id: str, lease: str) -> Optional[str]:
+        raw = await get_async_redis().eval(*self._complete_args(agent_id, lease))
+        if not raw:
+            return None
+        items = [json.loads(item) for item in raw]
+        await self._record(get_async_redis().pipeline(transaction=False), agent_id, items).execute()
+        return self.fold(items)
+
+    async def sweep(self) -> List[Tuple[str, str, str]]:
+        """
+        Pega a vez dos agentes com mensagens aguardando e sem vez (quem a tinha
+        morreu) e retorna (agente, vez, mensagem a enviar) de cada um.
+        """
+        redis = get_async_redis()
+        taken = []
+        for agent_id in await redis.smembers(self.AGENTS_KEY):
+            lease = uuid.uuid4().hex
+            raw = await redis.eval(SWEEP_SCRIPT, 3, *self._keys(agent_id), self.AGENTS_KEY, lease, self.lease_ttl, agent_id)
+            if not raw:
+                continue
+            items = [json.loads(item) for item in raw]
+            await self._record(redis.pipeline(transaction=False), agent_id, items).execute()
+            taken.append((agent_id, lease, self.fold(items)))
+        return taken
+
+    async def agent_stats(self, agent_id: str) -> dict:
+        redis = get_async_redis()
+        lease_key, queue_key = self._keys(agent_id)
+        stats = {key: int(value) for key, value in (await redis.hgetall(self._stats_key(agent_id))).items()}
+        queued = [json.loads(item)["timestamp"] for item in await redis.zrange(queue_key, 0, -1)]
+        runs = stats.get("runs") or 0
+        return {
+            "agent_id": agent_id,
+            "busy": bool(await redis.exists(lease_key)),
+            "depth": len(queued),
+            "oldest_wait_ms": max(0, int((time.time() - min(queued)) * 1000)) if queued else 0,
+            "avg_wait_ms": (stats.get("wait_ms_total") or 0) // max(1, stats.get("delivered") or 0),
+            "avg_folded": round((stats.get("delivered") or 0) / runs, 2) if runs else 0,
+            **stats,
+        }
+
+    async def stats(self, limit: int = 50) -> dict:
+        """
+        Agentes com mensagens aguardando, dos de maior fila para os de menor.
+        """
+        agents = [await self.agent_stats(agent_id) for agent_id in await get_async_redis().smembers(self.AGENTS_KEY)]
+        agents.sort(key=lambda item: (item["depth"], item["oldest_wait_ms"]), reverse=True)
+        return {
+            "enabled": self.enabled,
+            "agents_waiting": len(agents),
+            "queued_messages": sum(item["depth"] for item in agents),
+            "agents": agents[:limit],
+        }
+
+
+agent_mailbox = AgentMailbox()
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import random
+import string
+import asyncio
+import logging
+from typing import Optional
+
+from dotenv import load_dotenv
+
+from app.agents.provisioning import AGENT_SET_GRAPH, agent_set_handlers, personalize_agent_set, run_graph
+from app.services.letta_router import letta_router
+from app.utils.redis_connection import get_async_redis
+
+load_dotenv()
+
+# Identidade provisória dos agentes do pool (a "tag de telefone" não tem dígitos,
+# então o índice de agentes nunca a confunde com um usuário).
+POOL_USER_NAME = "Usuário"
+POOL_TAG_PREFIX = "pool-"
+
+# Reserva atomicamente as vagas que faltam no pool do nó, contando os conjuntos
+# em criação, para que dois processos não criem a mesma vaga.
+# KEYS: [1] pool do nó, [2] contador de conjuntos em criação. ARGV: [1] tamanho alvo, [2] TTL do contador (s)
+RESERVE_SCRIPT = """
+local pending = tonumber(redis.call('GET', KEYS[2]) or '0')
+local missing = tonumber(ARGV[1]) - redis.call('LLEN', KEYS[1]) - pending
+if missing <= 0 then
+    return 0
+end
+redis.call('INCRBY', KEYS[2], missing)
+redis.call('EXPIRE', KEYS[2], tonumber(ARGV[2]))
+return missing
+"""
+
+
+class AgentPool:
+    """
+    Estoque de conjuntos de agentes (bloco "human", onboarding, principal e
+    background) já criados e sem usuário, para que o cadastro não espere a
+    criação dos agentes.
+
+    Há um estoque por servidor Letta: a lista `agents:pool` (nó padrão) ou
+    `agents:pool:<nó>`, com o JSON dos IDs. No cadastro, um conjunto do nó do
+    usuário é retirado com LPOP (atômico: dois cadastros nunca pegam o mesmo) e
+    personalizado com `personalize_agent_set`. O worker de reposição, um processo
+    por vez, recria conjuntos até `AGENT_POOL_SIZE` em cada nó, no máximo
+    `AGENT_POOL_REPLENISH_CONCURRENCY` em paralelo. As vagas são reservadas com
+    `INCRBY` em `agents:pool:pending:<nó>` antes da criação e liberadas ao final,
+    então uma reposição que passa do ciclo não faz outra criar conjuntos a mais.
+    Reservas de um processo que caiu expiram em `AGENT_POOL_RESERVATION_TTL` segundos.
+    """
+
+    POOL_KEY = "agents:pool"
+    LOCK_KEY = "agents:pool:lock"
+    CLAIMED_KEY = "agents:pool:claimed"
+
+    def __init__(self):
+        self.size = int(os.getenv("AGENT_POOL_SIZE", "3"))
+        self.interval = float(os.getenv("AGENT_POOL_INTERVAL", "15"))
+        self.concurrency = int(os.getenv("AGENT_POOL_REPLENISH_CONCURRENCY", "2"))
+        self.reservation_ttl = int(os.getenv("AGENT_POOL_RESERVATION_TTL", "900"))
+        self.counters = {"claimed": 0, "misses": 0, "created": 0, "errors": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def pool_key(self, node: str = None) -> str:
+        node = node or letta_router.default_node
+        return self.POOL_KEY if node == letta_router.default_node else f"{self.POOL_KEY}:{node}"
+
+    def pending_key(self, node: str = None) -> str:
+        return f"{self.POOL_KEY}:pending:{node or letta_router.default_node}"
+
+    async def claim(self, node: str = None) -> Optional[dict]:
+        """
+        Retira um conjunto do pool do nó ({"human_block", "onboarding_agent", "main_agent",
+        "background_agent", "main_persona"}), ou None se o pool está vazio.
+        """
+        if not self.enabled:
+            return None
+        raw = await get_async_redis().lpop(self.pool_key(node))
+        if not raw:
+            self.counters["misses"] += 1
+            return None
+        self.counters["claimed"] += 1
+        agents = json.loads(raw)
+        agents.pop("created_at", None)
+        # Retirados recentemente: a reconciliação não os apaga enquanto são personalizados.
+        await get_async_redis().zadd(self.CLAIMED_KEY, {agent_id: time.time() for key, agent_id in agents.items() if key.endswith("_agent")})
+        return agents
+
+    async def recently_claimed(self, since: float) -> list:
+        """
+        IDs dos agentes retirados do pool depois de `since` (os mais antigos são descartados).
+        """
+        redis = get_async_redis()
+        await redis.zremrangebyscore(self.CLAIMED_KEY, "-inf", since)
+        return await redis.zrangebyscore(self.CLAIMED_KEY, since, "+inf")
+
+    async def personalize(self, agents: dict, user_name: str, user_number: str, node: str = None):
+        await personalize_agent_set(agents, user_name, user_number, node=node)
+
+    async def create_set(self, node: str = None) -> dict:
+        placeholder = POOL_TAG_PREFIX + "".join(random.choices(string.ascii_lowercase, k=12))
+        agents = await run_graph(AGENT_SET_GRAPH, agent_set_handlers(POOL_USER_NAME, placeholder, node=node), {})
+        await get_async_redis().rpush(self.pool_key(node), json.dumps({**agents, "created_at": time.time()}))
+        self.counters["created"] += 1
+        return agents
+
+    async def acquire_replenish(self) -> bool:
+        """
+        Garante que só um processo reponha o pool por ciclo.
+        """
+        return bool(await get_async_redis().set(self.LOCK_KEY, os.getpid(), nx=True, ex=max(1, int(self.interval))))
+
+    async def replenish(self) -> int:
+        """
+        Cria os conjuntos que faltam para o pool de cada nó chegar a `AGENT_POOL_SIZE`. Retorna quantos foram criados.
+        """
+        redis = get_async_redis()
+        missing = []
+        for node in letta_router.nodes:
+            reserved = await redis.eval(RESERVE_SCRIPT, 2, self.pool_key(node), self.pending_key(node), self.size, self.reservation_ttl)
+            missing.extend([node] * int(reserved))
+        if not missing:
+            return 0
+
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def create(node: str) -> bool:
+            async with slots:
+                try:
+                    await self.create_set(node)
+                    return True
+                except Exception as e:
+                    self.counters["errors"] += 1
+                    logging.error(f"Erro ao criar conjunto de agentes do pool no nó {node}: {e}")
+                    return False
+                finally:
+                    # A reserva pode ter expirado durante a criação: o contador nunca fica negativo.
+                    if await redis.decr(self.pending_key(node)) <= 0:
+                        await redis.delete(self.pending_key(node))
+
+        return sum(await asyncio.gather(*(create(node) for node in missing)))
+
+    async def stats(self) -> dict:
+        redis = get_async_redis()
+        nodes = {}
+        for node in letta_router.nodes:
+            oldest = await redis.lindex(self.pool_key(node), 0)
+            nodes[node] = {
+                "stock": await redis.llen(self.pool_key(node)),
+                "pending": int(await redis.get(self.pending_key(node)) or 0),
+                "oldest_created_at": json.loads(oldest).get("created_at") if oldest else None,
+            }
+        return {
+            **self.counters,
+            "target": self.size,
+            "stock": sum(item["stock"] for item in nodes.values()),
+            "nodes": nodes,
+            "pid": os.getpid(),
+        }
+
+
+agent_pool = AgentPool()
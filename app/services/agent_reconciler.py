@@ -0,0 +1,275 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Dict, List, Optional, Set
+
+from dotenv import load_dotenv
+
+from app.agents.provisioning import created_order
+from app.schemas.user import UserBase
+from app.services.agent_directory import agent_directory, phone_of, role_of
+from app.services.agent_pool import POOL_TAG_PREFIX, agent_pool
+from app.services.letta_router import letta_router
+from app.services.user_service import UserRepository
+from app.utils.async_letta import get_async_letta
+from app.utils.redis_connection import get_async_redis
+
+load_dotenv()
+
+# Quantas ações entram no relatório (o total fica nos contadores).
+REPORT_ACTIONS_LIMIT = 200
+
+
+class RateBudget:
+    """
+    Espaça as chamadas ao Letta para no máximo `rate` por segundo, entre todas as corrotinas.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            wait = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class AgentReconciler:
+    """
+    Compara os agentes do Letta com a tabela `users` e corrige as divergências
+    deixadas por provisionamentos repetidos ou interrompidos.
+
+    Os agentes de todos os servidores Letta são listados em páginas de
+    `AGENT_RECONCILE_PAGE_SIZE` e agrupados por telefone e papel (tags), então
+    sobras de uma migração interrompida em outro nó também são encontradas.
+    Para cada grupo:
+
+    - sem usuário com o telefone: todos são órfãos e são apagados;
+    - com usuário: fica o agente gravado no usuário ou, se ele não estiver no
+      grupo, o mais antigo (`created_order`), que é religado ao usuário; os
+      demais são duplicatas e são apagados.
+
+    Agentes do pool que não estão mais no pool do nó também são órfãos. O estoque
+    do pool é lido antes da listagem, e cada agente é consultado de novo logo
+    antes de ser apagado: se as tags mudaram (ex.: um conjunto do pool retirado e
+    personalizado durante a listagem), ele é mantido. O bloco "human" de um
+    agente apagado também é apagado quando nenhum outro agente o usa.
+    Nada criado há menos de `AGENT_RECONCILE_GRACE` segundos é apagado (pode ser
+    um provisionamento em andamento). As ações rodam em paralelo
+    (`AGENT_RECONCILE_CONCURRENCY`) e todas as chamadas ao Letta, inclusive a
+    listagem, respeitam o limite de `AGENT_RECONCILE_RATE` por segundo.
+    """
+
+    LOCK_KEY = "agents:reconcile:lock"
+    REPORT_KEY = "agents:reconcile:last"
+
+    def __init__(self):
+        self.enabled = os.getenv("AGENT_RECONCILE_ENABLED", "true").lower() == "true"
+        self.interval = float(os.getenv("AGENT_RECONCILE_INTERVAL", "21600"))
+        self.page_size = int(os.getenv("AGENT_RECONCILE_PAGE_SIZE", "100"))
+        self.rate = float(os.getenv("AGENT_RECONCILE_RATE", "5"))
+        self.concurrency = int(os.getenv("AGENT_RECONCILE_CONCURRENCY", "4"))
+        self.grace = float(os.getenv("AGENT_RECONCILE_GRACE", "3600"))
+
+    async def list_agents(self, budget: RateBudget, node: str = None) -> list:
+        letta = get_async_letta(node)
+        agents, after = [], None
+        while True:
+            await budget.acquire()
+            page = await letta.agents.list(limit=self.page_size, after=after)
+            agents.extend(page)
+            if len(page) < self.page_size:
+                return agents
+            after = page[-1].id
+
+    def _settled(self, agent, now: float) -> bool:
+        return agent.created_at is not None and now - agent.created_at.timestamp() >= self.grace
+
+    def plan(self, agents: list, users: Dict[str, object], pooled: Set[str], now: float) -> dict:
+        """
+        Ações para os agentes listados: {"delete": [(agent_id, phone, motivo)], "relink": [(user, papel, agent_id)]}.
+        `users` é telefone → usuário e `pooled`, os IDs dos agentes em estoque no pool.
+        """
+        deletes, relinks = [], []
+        groups: Dict[tuple, list] = defaultdict(list)
+        for agent in agents:
+            tags = agent.tags or []
+            if any(tag.startswith(POOL_TAG_PREFIX) for tag in tags):
+                if agent.id not in pooled and self._settled(agent, now):
+                    deletes.append((agent.id, None, "pool_orphan"))
+                continue
+            phone, role = phone_of(tags), role_of(tags)
+            if phone and role:
+                groups[(phone, role)].append(agent)
+
+        for (phone, role), group in groups.items():
+            user = users.get(phone)
+            if user is None:
+                deletes.extend((agent.id, phone, "orphan") for agent in group if self._settled(agent, now))
+                continue
+
+            linked = getattr(user, f"id_{role}_agent", None)
+            keep = min(group, key=lambda agent: created_order(agent, [linked]))
+            if keep.id != linked:
+                relinks.append((user, role, keep.id))
+            deletes.extend((agent.id, phone, "duplicate") for agent in group if agent.id != keep.id and self._settled(agent, now))
+        return {"delete": deletes, "relink": relinks}
+
+    async def _users_by_phone(self, phones: List[str]) -> Dict[str, object]:
+        users = {}
+        for start in range(0, len(phones), 500):
+            for user in await UserRepository().get_users_by_phones(phones[start:start + 500]):
+                users[user.phone] = user
+        return users
+
+    async def _pooled(self) -> Set[str]:
+        """
+        Agentes em estoque no pool e os retirados há menos de `AGENT_RECONCILE_GRACE` segundos.
+        """
+        pooled = set(await agent_pool.recently_claimed(time.time() - self.grace))
+        for node in letta_router.nodes:
+            for raw in await get_async_redis().lrange(agent_pool.pool_key(node), 0, -1):
+                pooled.update(value for key, value in json.loads(raw).items() if key.endswith("_agent"))
+        return pooled
+
+    @staticmethod
+    def _still_deletable(agent, phone: Optional[str], reason: str, pooled: Set[str]) -> bool:
+        """
+        Confere, com o agente consultado de novo, se o motivo da remoção ainda vale.
+        """
+        tags = agent.tags or []
+        if reason == "pool_orphan":
+            return any(tag.startswith(POOL_TAG_PREFIX) for tag in tags) and agent.id not in pooled
+        return phone_of(tags) == phone
+
+    @staticmethod
+    def _human_block_id(agent) -> Optional[str]:
+        memory = getattr(agent, "memory", None)
+        return next((block.id for block in (memory.blocks if memory else []) if block.label == "human"), None)
+
+    async def reconcile(self, dry_run: bool = False) -> dict:
+        budget = RateBudget(self.rate)
+        # O estoque do pool é lido antes da listagem: um conjunto retirado durante ela continua protegido.
+        pooled = await self._pooled()
+        agents, node_of = [], {}
+        for node in letta_router.nodes:
+            for agent in await self.list_agents(budget, node):
+                agents.append(agent)
+                node_of[agent.id] = node
+        phones = sorted({phone for phone in (phone_of(agent.tags or []) for agent in agents) if phone})
+        plan = self.plan(agents, await self._users_by_phone(phones), pooled, time.time())
+
+        report = {
+            "agents": len(agents),
+            "nodes": {node: sum(1 for value in node_of.values() if value == node) for node in letta_router.nodes},
+            "orphans": sum(1 for _, _, reason in plan["delete"] if reason != "duplicate"),
+            "duplicates": sum(1 for _, _, reason in plan["delete"] if reason == "duplicate"),
+            "relinks": len(plan["relink"]),
+            "deleted": 0,
+            "skipped": 0,
+            "blocks_deleted": 0,
+            "relinked": 0,
+            "errors": 0,
+            "dry_run": dry_run,
+            "finished_at": time.time(),
+            "actions": (
+                [{"action": "delete", "agent_id": agent_id, "phone": phone, "reason": reason} for agent_id, phone, reason in plan["delete"]]
+                + [{"action": "relink", "user_id": user.id, "role": role, "agent_id": agent_id} for user, role, agent_id in plan["relink"]]
+            )[:REPORT_ACTIONS_LIMIT],
+        }
+        if dry_run:
+            return report
+
+        slots = asyncio.Semaphore(self.concurrency)
+        deleted: List[str] = []
+        touched_phones: Set[str] = set()
+        human_blocks: Set[tuple] = set()
+
+        async def relink(user, role: str, agent_id: str):
+            async with slots:
+                try:
+                    await UserRepository().update_user_by_id(user.id, UserBase(**{f"id_{role}_agent": agent_id}))
+                    touched_phones.add(user.phone)
+                    report["relinked"] += 1
+                except Exception as e:
+                    report["errors"] += 1
+                    logging.error(f"Erro ao religar o agente {agent_id} ao usuário {user.id}: {e}")
+
+        async def delete(agent_id: str, phone: Optional[str], reason: str, pooled: Set[str]):
+            async with slots:
+                letta = get_async_letta(node_of[agent_id])
+                try:
+                    await budget.acquire()
+                    agent = await letta.agents.retrieve(agent_id)
+                    if not self._still_deletable(agent, phone, reason, pooled):
+                        report["skipped"] += 1
+                        logging.info(f"Agente {agent_id} mudou desde a listagem e não foi apagado ({reason}).")
+                        return
+                    await budget.acquire()
+                    await letta.agents.delete(agent_id)
+                    deleted.append(agent_id)
+                    block_id = self._human_block_id(agent)
+                    if block_id:
+                        human_blocks.add((node_of[agent_id], block_id))
+                    if phone:
+                        touched_phones.add(phone)
+                    report["deleted"] += 1
+                except Exception as e:
+                    report["errors"] += 1
+                    logging.error(f"Erro ao apagar o agente {agent_id}: {e}")
+
+        async def delete_block(node: str, block_id: str):
+            async with slots:
+                letta = get_async_letta(node)
+                try:
+                    await budget.acquire()
+                    if await letta.blocks.list_agents_for_block(block_id):
+                        return
+                    await budget.acquire()
+                    await letta.blocks.delete(block_id)
+                    report["blocks_deleted"] += 1
+                except Exception as e:
+                    report["errors"] += 1
+                    logging.error(f"Erro ao apagar o bloco {block_id}: {e}")
+
+        # Religa antes de apagar: o usuário nunca fica apontando para um agente apagado.
+        await asyncio.gather(*(relink(*item) for item in plan["relink"]))
+        # Estoque relido antes de apagar: um conjunto devolvido ao pool nesse meio-tempo é mantido.
+        pooled_now = pooled | await self._pooled()
+        await asyncio.gather(*(delete(agent_id, phone, reason, pooled_now) for agent_id, phone, reason in plan["delete"]))
+        # Blocos "human" que ficaram sem agente (os três agentes do usuário compartilham o mesmo).
+        await asyncio.gather(*(delete_block(node, block_id) for node, block_id in human_blocks))
+
+        if plan["delete"]:
+            await agent_directory.invalidate_async(agent_ids=deleted)
+            await letta_router.unassign_agents(deleted)
+        for phone in touched_phones:
+            await agent_directory.invalidate_async(phone=phone)
+        await get_async_redis().set(self.REPORT_KEY, json.dumps(report))
+        logging.info(
+            f"Reconciliação de agentes: {report['deleted']} apagados, {report['skipped']} mantidos, "
+            f"{report['blocks_deleted']} blocos apagados, {report['relinked']} religados, "
+            f"{report['errors']} erros, {report['agents']} agentes."
+        )
+        return report
+
+    async def acquire_run(self) -> bool:
+        """
+        Garante que só um processo rode a reconciliação por intervalo.
+        """
+        return bool(await get_async_redis().set(self.LOCK_KEY, os.getpid(), nx=True, ex=max(1, int(self.interval))))
+
+    async def last_report(self) -> Optional[dict]:
+        raw = await get_async_redis().get(self.REPORT_KEY)
+        return json.loads(raw) if raw else None
+
+
+agent_reconciler = AgentReconciler()
@@ -3,19 +3,22 @@ import json
 import asyncio
 import base64
 import datetime
+import tempfile
+import uuid
 from typing import List, Optional
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
-from email import encoders
 
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload
 
 from app.services.user_service import UserRepository
+from app.utils.base64_stream import iter_file_base64
 
 
 def auto_refresh(func):
@@ -105,6 +108,36 @@ class GoogleService:
 
     # Métodos do Gmail
 
+    @staticmethod
+    def _write_mime_message(target, to: str, subject: str, body: str, attachments: List[str]):
+        """
+        Escreve a mensagem MIME com anexos em `target`. Os cabeçalhos vêm do
+        pacote email; o conteúdo de cada anexo é codificado em base64 a partir
+        de um mmap do arquivo, direto no destino.
+        """
+        message = MIMEMultipart()
+        message['to'] = to
+        message['subject'] = subject
+        message.attach(MIMEText(body, 'plain'))
+
+        placeholders = {}
+        for file_path in attachments:
+            placeholder = uuid.uuid4().hex
+            placeholders[placeholder] = file_path
+            part = MIMEBase('application', 'octet-stream')
+            part.set_payload(placeholder)
+            part['Content-Transfer-Encoding'] = 'base64'
+            part.add_header('Content-Disposition', f'attachment; filename="{os.path.basename(file_path)}"')
+            message.attach(part)
+
+        skeleton = message.as_bytes()
+        for placeholder, file_path in placeholders.items():
+            before, skeleton = skeleton.split(placeholder.encode(), 1)
+            target.write(before)
+            for chunk in iter_file_base64(file_path, mime_lines=True):
+                target.write(chunk)
+        target.write(skeleton)
+
     @auto_refresh
     def send_email(self, to: str, subject: str, body: str, attachments: Optional[List[str]] = None) -> Optional[str]:
         """
@@ -129,26 +162,21 @@ class GoogleService:
         """
         try:
             if attachments:
-                message = MIMEMultipart()
-                message['to'] = to
-                message['subject'] = subject
-                message.attach(MIMEText(body, 'plain'))
-
-                for file_path in attachments:
-                    part = MIMEBase('application', 'octet-stream')
-                    with open(file_path, 'rb') as file:
-                        part.set_payload(file.read())
-                    encoders.encode_base64(part)
-                    part.add_header('Content-Disposition', f'attachment; filename="{os.path.basename(file_path)}"')
-                    message.attach(part)
+                # Anexos: a mensagem é montada em um arquivo temporário, com o base64
+                # dos arquivos gerado em streaming, e enviada por upload (memória constante).
+                with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as raw_file:
+                    self._write_mime_message(raw_file, to, subject, body, attachments)
+                    raw_file.seek(0)
+                    media = MediaIoBaseUpload(raw_file, mimetype="message/rfc822", chunksize=1024 * 1024, resumable=True)
+                    sent_message = self.gmail_service.users().messages().send(userId='me', body={}, media_body=media).execute()
             else:
                 message = MIMEText(body)
                 message['to'] = to
                 message['subject'] = subject
 
-            raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-            send_message = {'raw': raw_message}
-            sent_message = self.gmail_service.users().messages().send(userId='me', body=send_message).execute()
+                raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
+                send_message = {'raw': raw_message}
+                sent_message = self.gmail_service.users().messages().send(userId='me', body=send_message).execute()
             print(f"Message Id: {sent_message['id']}")
             return sent_message['id']
         except HttpError as error:
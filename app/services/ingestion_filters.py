@@ -0,0 +1,195 @@
+import os
+import re
+import json
+import time
+import logging
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from app.utils.redis_connection import get_async_redis
+
+load_dotenv()
+
+Predicate = Callable[[dict], bool]
+
+
+@dataclass
+class FilterRule:
+    """
+    Regra de descarte de mensagens. A mensagem é descartada quando TODAS as
+    condições definidas na regra são atendidas (condições None são ignoradas).
+
+    scope: "background" (sessões pessoais conectadas), "principal" ou "all".
+    """
+    name: str
+    scope: str = "background"
+    senders: Optional[List[str]] = None
+    group_ids: Optional[List[str]] = None
+    chat_ids: Optional[List[str]] = None
+    types: Optional[List[str]] = None
+    from_me: Optional[bool] = None
+    is_group: Optional[bool] = None
+    min_length: Optional[int] = None
+    max_length: Optional[int] = None
+    pattern: Optional[str] = None
+    predicate: Predicate = field(default=None, repr=False, compare=False)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "FilterRule":
+        fields = {key: value for key, value in data.items() if key in cls.__dataclass_fields__ and key != "predicate"}
+        return cls(**fields).compile()
+
+    def to_dict(self) -> dict:
+        return {
+            key: getattr(self, key)
+            for key in self.__dataclass_fields__
+            if key != "predicate" and getattr(self, key) is not None
+        }
+
+    def compile(self) -> "FilterRule":
+        """
+        Pré-compila as condições em uma lista de funções (sets e regex prontos).
+        """
+        checks: List[Predicate] = []
+
+        if self.senders is not None:
+            senders = frozenset(normalize_number(sender) for sender in self.senders)
+            checks.append(lambda p: normalize_number((p.get("sender") or {}).get("id", "")) in senders)
+        if self.group_ids is not None:
+            group_ids = frozenset(self.group_ids)
+            checks.append(lambda p: bool(p.get("isGroupMsg")) and p.get("from") in group_ids)
+        if self.chat_ids is not None:
+            chat_ids = frozenset(self.chat_ids)
+            checks.append(lambda p: p.get("from") in chat_ids)
+        if self.types is not None:
+            types = frozenset(self.types)
+            checks.append(lambda p: p.get("type") in types)
+        if self.from_me is not None:
+            from_me = self.from_me
+            checks.append(lambda p: bool(p.get("fromMe")) == from_me)
+        if self.is_group is not None:
+            is_group = self.is_group
+            checks.append(lambda p: bool(p.get("isGroupMsg")) == is_group)
+        if self.min_length is not None:
+            min_length = self.min_length
+            checks.append(lambda p: len(p.get("body") or "") < min_length)
+        if self.max_length is not None:
+            max_length = self.max_length
+            checks.append(lambda p: len(p.get("body") or "") > max_length)
+        if self.pattern is not None:
+            try:
+                regex = re.compile(self.pattern, re.IGNORECASE)
+            except re.error as e:
+                raise ValueError(f"Regex inválida na regra {self.name}: {e}")
+            checks.append(lambda p: bool(regex.search(p.get("body") or "")))
+
+        if not checks:
+            raise ValueError(f"A regra {self.name} não tem nenhuma condição.")
+
+        self.predicate = lambda p: all(check(p) for check in checks)
+        return self
+
+
+def normalize_number(value: str) -> str:
+    return (value or "").split("@")[0]
+
+
+def default_rules() -> List[dict]:
+    """
+    Regras globais padrão, substituíveis pela variável INGESTION_FILTER_RULES (JSON).
+    """
+    rules = [
+        {"name": "status_broadcast", "scope": "all", "chat_ids": ["status@broadcast"]},
+        {"name": "own_messages", "scope": "background", "from_me": True},
+    ]
+    main_number = os.getenv("MAIN_WHATSAPP_NUMBER")
+    if main_number:
+        rules.append({"name": "main_whatsapp_number", "scope": "background", "senders": [main_number]})
+    return rules
+
+
+class IngestionFilterEngine:
+    """
+    Avalia as regras de descarte antes de qualquer consulta ao banco ou ao Letta.
+
+    As regras globais ficam em memória. As regras de cada usuário (aplicadas à
+    sessão pessoal conectada dele, `info_agent_<phone>`) ficam no Redis em
+    `ingestion_filters:<phone>` e são mantidas em cache no processo por
+    `INGESTION_FILTER_CACHE_TTL` segundos. Cada descarte incrementa o contador da regra.
+    """
+
+    def __init__(self):
+        self.cache_ttl = float(os.getenv("INGESTION_FILTER_CACHE_TTL", "60"))
+        raw_rules = os.getenv("INGESTION_FILTER_RULES")
+        self.global_rules = [FilterRule.from_dict(rule) for rule in (json.loads(raw_rules) if raw_rules else default_rules())]
+        self._user_rules: Dict[str, Tuple[List[FilterRule], float]] = {}
+        self.drop_counters: Counter = Counter()
+        self.evaluated = 0
+
+    @staticmethod
+    def _redis_key(phone: str) -> str:
+        return f"ingestion_filters:{phone}"
+
+    @staticmethod
+    def session_owner(session: str) -> Optional[str]:
+        match = re.search(r"\d+", session or "")
+        return match.group() if match else None
+
+    async def get_user_rules(self, phone: str) -> List[FilterRule]:
+        cached = self._user_rules.get(phone)
+        if cached and time.monotonic() - cached[1] < self.cache_ttl:
+            return cached[0]
+
+        rules = []
+        try:
+            raw = await get_async_redis().get(self._redis_key(phone))
+            rules = [FilterRule.from_dict(rule) for rule in json.loads(raw)] if raw else []
+        except Exception as e:
+            logging.error(f"Erro ao carregar as regras de filtro do usuário {phone}: {e}")
+        self._user_rules[phone] = (rules, time.monotonic())
+        return rules
+
+    async def set_user_rules(self, phone: str, rules: List[dict]) -> List[FilterRule]:
+        """
+        Valida, salva e atualiza o cache das regras do usuário.
+        """
+        compiled = [FilterRule.from_dict({"scope": "background", **rule}) for rule in rules]
+        await get_async_redis().set(self._redis_key(phone), json.dumps([rule.to_dict() for rule in compiled]))
+        self._user_rules[phone] = (compiled, time.monotonic())
+        return compiled
+
+    async def match(self, payload: dict) -> Optional[str]:
+        """
+        Retorna o nome da primeira regra que descarta a mensagem, ou None.
+        """
+        self.evaluated += 1
+        session = payload.get("session")
+        scope = "principal" if session == "principal" else "background"
+
+        for rule in self.global_rules:
+            if rule.scope in (scope, "all") and rule.predicate(payload):
+                self.drop_counters[rule.name] += 1
+                return rule.name
+
+        if scope == "background":
+            owner = self.session_owner(session)
+            for rule in await self.get_user_rules(owner) if owner else []:
+                if rule.predicate(payload):
+                    self.drop_counters[f"user:{rule.name}"] += 1
+                    return rule.name
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "evaluated": self.evaluated,
+            "dropped": sum(self.drop_counters.values()),
+            "rules": dict(self.drop_counters),
+            "global_rules": [rule.to_dict() for rule in self.global_rules],
+            "pid": os.getpid(),
+        }
+
+
+ingestion_filters = IngestionFilterEngine()
@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+from typing import Optional
+
+from dotenv import load_dotenv
+
+from app.agents.provisioning import AGENT_SET_GRAPH, ROLE_STEPS, agent_set_handlers, find_agent_set, provisioning_lock, run_graph
+from app.schemas.user import UserBase
+from app.services.agent_directory import agent_directory
+from app.services.letta_router import letta_router
+from app.services.user_service import UserRepository
+from app.utils.async_letta import get_async_letta
+from app.utils.redis_connection import get_async_redis
+
+load_dotenv()
+
+# Passagens da memória arquivística copiadas por agente e quantas gravações em paralelo.
+MIGRATION_ARCHIVAL_LIMIT = int(os.getenv("LETTA_MIGRATION_ARCHIVAL_LIMIT", "10000"))
+MIGRATION_CONCURRENCY = int(os.getenv("LETTA_MIGRATION_CONCURRENCY", "4"))
+# A migração segura o lock de provisionamento do usuário durante toda a cópia.
+MIGRATION_LOCK_TTL = int(os.getenv("LETTA_MIGRATION_LOCK_TTL", "900"))
+# Espera antes de apagar os agentes de origem: o tempo para os caches locais dos
+# outros processos (`agent_directory` e `letta_router`) deixarem de apontar para eles.
+MIGRATION_SETTLE_SECONDS = float(os.getenv("LETTA_MIGRATION_SETTLE_SECONDS", "0")) or max(agent_directory.local_ttl, letta_router.cache_ttl) + 5
+
+# Fila das migrações (worker) e estado de cada uma.
+MIGRATION_QUEUE_KEY = "letta:migrations:queue"
+# Agentes de origem a apagar (JSON do conjunto e nó → horário), executados pelo mesmo worker.
+MIGRATION_DELETIONS_KEY = "letta:migrations:deletions"
+MIGRATION_JOB_TTL = int(os.getenv("LETTA_MIGRATION_JOB_TTL", "604800"))
+
+
+async def _copy_memory(old: dict, new: dict, source: str, target: str) -> dict:
+    """
+    Copia para os agentes novos o bloco "human", as personas e a memória
+    arquivística dos antigos. Retorna quantas passagens foram copiadas por papel.
+    """
+    src, dst = get_async_letta(source), get_async_letta(target)
+    human = await src.agents.core_memory.retrieve_block(old["main_agent"], "human")
+    await dst.blocks.modify(new["human_block"], value=human.value)
+
+    copied = {}
+    slots = asyncio.Semaphore(MIGRATION_CONCURRENCY)
+
+    async def write(agent_id: str, text: str):
+        async with slots:
+            await dst.agents.archival_memory.create(agent_id=agent_id, text=text)
+
+    for role, step in ROLE_STEPS.items():
+        persona = await src.agents.core_memory.retrieve_block(old[step], "persona")
+        # A persona do principal cita o ID do agente background.
+        value = persona.value.replace(old["background_agent"], new["background_agent"])
+        await dst.agents.core_memory.modify_block(agent_id=new[step], block_label="persona", value=value)
+
+        passages = await src.agents.archival_memory.list(old[step], limit=MIGRATION_ARCHIVAL_LIMIT)
+        if len(passages) >= MIGRATION_ARCHIVAL_LIMIT:
+            logging.warning(f"Memória arquivística do agente {old[step]} truncada em {MIGRATION_ARCHIVAL_LIMIT} passagens na migração.")
+        await asyncio.gather(*(write(new[step], passage.text) for passage in passages if passage.text))
+        copied[role] = len(passages)
+    return copied
+
+
+async def _delete_agents(agents: dict, node: str):
+    """
+    Apaga os agentes e o bloco "human" do conjunto, inclusive de um conjunto criado pela metade.
+    """
+    letta = get_async_letta(node)
+    agent_ids = [agents[step] for step in ROLE_STEPS.values() if agents.get(step)]
+    for agent_id in agent_ids:
+        try:
+            await letta.agents.delete(agent_id)
+        except Exception as e:
+            logging.error(f"Erro ao apagar o agente {agent_id} no nó {node}: {e}")
+    if agents.get("human_block"):
+        try:
+            await letta.blocks.delete(agents["human_block"])
+        except Exception as e:
+            logging.warning(f"Erro ao apagar o bloco {agents['human_block']} no nó {node}: {e}")
+    await letta_router.unassign_agents(agent_ids)
+
+
+
+async def warm_letta_assignments() -> int:
+    """
+    Carrega no Redis o nó Letta dos usuários que estiverem só no banco (ou em nenhum dos dois).
+    """
+    return await letta_router.warm(await UserRepository().get_users_with_agents())
+
+
+async def migrate_user(user_id: str, target: str, delete_source: bool = True) -> dict:
+    """
+    Move os agentes do usuário para o servidor Letta `target`.
+
+    O cliente do Letta não exporta nem importa agentes, então o conjunto é
+    recriado no destino (`AGENT_SET_GRAPH`) e recebe o bloco "human", as
+    personas e a memória arquivística dos agentes antigos; o histórico de
+    mensagens não é copiado. O usuário só passa a usar os agentes novos depois
+    da cópia; se a criação ou a cópia falhar, os agentes novos (mesmo os de um
+    conjunto criado pela metade) são apagados e nada muda. Com `delete_source`,
+    a remoção dos antigos é agendada para depois de
+    `LETTA_MIGRATION_SETTLE_SECONDS`, quando nenhum outro processo os resolve
+    mais pelo cache local (`run_due_deletions`, no worker); sem ela, o
+    reconciliador os trata como duplicatas depois do período de carência.
+
+    Leva minutos: é executada pelo worker (`enqueue_migration`), não na requisição.
+    """
+    if target not in letta_router.nodes:
+        raise ValueError(f"Nó Letta {target} não configurado.")
+
+    async with provisioning_lock(user_id, ttl=MIGRATION_LOCK_TTL):
+        user = await UserRepository().get_user_by_id(user_id)
+        if not user:
+            raise ValueError(f"Usuário {user_id} não encontrado.")
+        source = user.letta_node or await letta_router.node_for_user(user.phone)
+        if source == target:
+            return {"user_id": user.id, "from": source, "to": target, "moved": False}
+
+        linked = [user.id_onboarding_agent, user.id_main_agent, user.id_background_agent]
+        old = await find_agent_set(user.phone, linked=linked, node=source)
+        if not all(step in old for step in ROLE_STEPS.values()):
+            # Sem conjunto completo na origem: o próximo provisionamento cria os agentes no destino.
+            await UserRepository().update_user_by_id(user.id, UserBase(letta_node=target))
+            await letta_router.assign_user(user.phone, target)
+            return {"user_id": user.id, "from": source, "to": target, "moved": False, "agents": len(old)}
+
+        new = {}
+        try:
+            await run_graph(AGENT_SET_GRAPH, agent_set_handlers(user.name, user.phone, node=target), new)
+            copied = await _copy_memory(old, new, source, target)
+            await UserRepository().update_user_by_id(user.id, UserBase(
+                id_onboarding_agent=new["onboarding_agent"],
+                id_main_agent=new["main_agent"],
+                id_background_agent=new["background_agent"],
+                letta_node=target,
+            ))
+        except BaseException:
+            await _delete_agents(new, target)
+            raise
+
+        await letta_router.assign_user(user.phone, target)
+        await agent_directory.invalidate_async(phone=user.phone, agent_ids=[old[step] for step in ROLE_STEPS.values()])
+        await agent_directory.register_async(
+            user.phone,
+            user_id=user.id,
+            onboarding=new["onboarding_agent"],
+            main=new["main_agent"],
+            background=new["background_agent"],
+        )
+
+    # Os agentes de origem só são apagados quando nenhum cache ainda os resolve.
+    delete_at = await schedule_deletion(old, source) if delete_source else None
+
+    logging.info(f"Agentes do usuário {user.id} migrados de {source} para {target}: {copied} passagens copiadas.")
+    return {
+        "user_id": user.id,
+        "from": source,
+        "to": target,
+        "moved": True,
+        "archival_copied": copied,
+        "agents": {role: new[step] for role, step in ROLE_STEPS.items()},
+        "source_deletion_at": delete_at,
+    }
+
+
+async def schedule_deletion(agents: dict, node: str) -> float:
+    """
+    Agenda a remoção do conjunto no nó para daqui a `LETTA_MIGRATION_SETTLE_SECONDS`. Retorna o horário.
+    """
+    delete_at = time.time() + MIGRATION_SETTLE_SECONDS
+    await get_async_redis().zadd(MIGRATION_DELETIONS_KEY, {json.dumps({"agents": agents, "node": node}): delete_at})
+    return delete_at
+
+
+async def run_due_deletions(limit: int = 20) -> int:
+    """
+    Apaga os conjuntos de origem cuja remoção já venceu (ZREM garante que só um worker
+    apaga cada um). Retorna quantos foram apagados.
+    """
+    redis = get_async_redis()
+    members = await redis.zrangebyscore(MIGRATION_DELETIONS_KEY, "-inf", time.time(), start=0, num=limit)
+    deleted = 0
+    for member in members:
+        if not await redis.zrem(MIGRATION_DELETIONS_KEY, member):
+            continue
+        job = json.loads(member)
+        await _delete_agents(job["agents"], job["node"])
+        deleted += 1
+    return deleted
+
+
+def _job_key(job_id: str) -> str:
+    return f"letta:migrations:job:{job_id}"
+
+
+async def _save_job(job: dict):
+    redis = get_async_redis()
+    await redis.set(_job_key(job["job_id"]), json.dumps(job), ex=MIGRATION_JOB_TTL)
+
+
+async def enqueue_migration(user_id: str, target: str, delete_source: bool = True) -> dict:
+    """
+    Agenda a migração dos agentes do usuário para o worker. Retorna o estado do job.
+    """
+    job = {
+        "job_id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "target": target,
+        "delete_source": delete_source,
+        "status": "queued",
+        "queued_at": time.time(),
+    }
+    await _save_job(job)
+    await get_async_redis().rpush(MIGRATION_QUEUE_KEY, job["job_id"])
+    return job
+
+
+async def migration_status(job_id: str) -> Optional[dict]:
+    raw = await get_async_redis().get(_job_key(job_id))
+    return json.loads(raw) if raw else None
+
+
+async def run_next_migration(timeout: int = 1) -> bool:
+    """
+    Executa a próxima migração da fila, se houver. Retorna False se a fila estava vazia.
+    Uma migração interrompida pela queda do worker fica como "running" e não é repetida.
+    """
+    popped = await get_async_redis().blpop(MIGRATION_QUEUE_KEY, timeout=timeout)
+    if not popped:
+        return False
+    job = await migration_status(popped[1])
+    if not job:
+        return True
+
+    job.update(status="running", started_at=time.time())
+    await _save_job(job)
+    try:
+        job["result"] = await migrate_user(job["user_id"], job["target"], delete_source=job["delete_source"])
+        job["status"] = "done"
+    except Exception as e:
+        logging.error(f"Erro na migração {job['job_id']} do usuário {job['user_id']}: {e}")
+        job.update(status="failed", error=str(e))
+    job["finished_at"] = time.time()
+    await _save_job(job)
+    return True
@@ -0,0 +1,254 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, Iterable, Optional, Tuple
+
+from dotenv import load_dotenv
+from letta_client import AsyncLetta, Letta
+
+from app.services.user_service import UserRepository
+from app.utils.async_letta import DEFAULT_LETTA_NODE, LETTA_NODES, get_async_letta
+from app.utils.celery_imports import get_letta
+from app.utils.hash_ring import HashRing
+from app.utils.redis_connection import get_async_redis, get_sync_redis
+
+load_dotenv()
+
+
+class LettaRouter:
+    """
+    Distribui os agentes dos usuários entre os servidores Letta de `LETTA_NODES`
+    com hash consistente pelo telefone.
+
+    Todos os agentes de um usuário (e o bloco "human" compartilhado) ficam no
+    mesmo nó, já que o agente principal conversa com o background. O nó de cada
+    usuário fica no hash `letta:nodes:users` (o primeiro é gravado com HSETNX,
+    então todos os processos concordam) e na coluna `users.letta_node`. Sem
+    registro no Redis (ex.: após limpá-lo), vale o banco: `letta_node` ou, para
+    usuários com agentes criados antes da divisão, o nó padrão; só usuários sem
+    agentes recebem o nó do anel. O de
+    cada agente, em `letta:nodes:agents`, gravado na criação. Um agente sem
+    registro (criado antes da divisão) é procurado nos nós e registrado.
+    Usuários só mudam de nó pela migração (`letta_migration`).
+
+    Com um único nó, tudo vai para ele sem consultar o Redis. As consultas ficam
+    em cache no processo por `LETTA_NODE_CACHE_TTL` segundos.
+    """
+
+    USERS_KEY = "letta:nodes:users"
+    AGENTS_KEY = "letta:nodes:agents"
+
+    def __init__(self):
+        self.nodes = LETTA_NODES
+        self.default_node = DEFAULT_LETTA_NODE
+        self.cache_ttl = float(os.getenv("LETTA_NODE_CACHE_TTL", "300"))
+        self.ring = HashRing(self.nodes, vnodes=int(os.getenv("LETTA_NODE_VNODES", "160")))
+        self._cache: Dict[str, Tuple[str, float]] = {}
+        self.counters = {"probes": 0, "probe_misses": 0}
+
+    @property
+    def sharded(self) -> bool:
+        return len(self.nodes) > 1
+
+    def _cached(self, key: str) -> Optional[str]:
+        if not self.sharded:
+            return self.default_node
+        cached = self._cache.get(key)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        return None
+
+    def _remember(self, key: str, node: str) -> str:
+        self._cache[key] = (node, time.monotonic() + self.cache_ttl)
+        return node
+
+    def forget(self, phone: str = None, agent_ids: Iterable[str] = ()):
+        """
+        Descarta o cache do processo (de um usuário e seus agentes, ou tudo).
+        """
+        if phone is None and not agent_ids:
+            self._cache.clear()
+            return
+        for key in [f"user:{phone}" if phone else None, *(f"agent:{agent_id}" for agent_id in agent_ids)]:
+            if key:
+                self._cache.pop(key, None)
+
+    # Versão assíncrona
+
+    async def node_for_user(self, phone: str) -> str:
+        """
+        Nó dos agentes do usuário; na primeira consulta, atribui o nó do anel.
+        """
+        node = self._cached(f"user:{phone}")
+        if node:
+            return node
+        redis = get_async_redis()
+        node = await redis.hget(self.USERS_KEY, phone)
+        if node not in self.nodes:
+            target = (None if node else await self._stored_node(phone)) or self.ring.node_for(phone)
+            if node:
+                # Nó removido da configuração: os agentes precisam ser migrados.
+                logging.warning(f"Nó Letta {node} do usuário {phone} não está em LETTA_NODES; usando {target}.")
+                await redis.hset(self.USERS_KEY, phone, target)
+            elif not await redis.hsetnx(self.USERS_KEY, phone, target):
+                target = await redis.hget(self.USERS_KEY, phone)
+            node = target
+        return self._remember(f"user:{phone}", node)
+
+    async def _stored_node(self, phone: str) -> Optional[str]:
+        """
+        Nó do usuário segundo o banco, para quem já tem agentes (None para os demais).
+        """
+        user = await UserRepository().get_user_by_phone(phone)
+        if not user or not (user.id_main_agent or user.id_onboarding_agent or user.id_background_agent):
+            return None
+        return user.letta_node if user.letta_node in self.nodes else self.default_node
+
+    async def node_for_agent(self, agent_id: str) -> str:
+        node = self._cached(f"agent:{agent_id}")
+        if node:
+            return node
+        node = await get_async_redis().hget(self.AGENTS_KEY, agent_id)
+        if node not in self.nodes:
+            node = await self._probe(agent_id)
+        return self._remember(f"agent:{agent_id}", node)
+
+    async def _probe(self, agent_id: str) -> str:
+        """
+        Procura o agente em todos os nós (agentes sem registro) e grava o nó encontrado.
+        """
+        self.counters["probes"] += 1
+        nodes = list(self.nodes)
+
+        async def exists(node: str) -> bool:
+            try:
+                await get_async_letta(node).agents.retrieve(agent_id)
+                return True
+            except Exception:
+                return False
+
+        found = await asyncio.gather(*(exists(node) for node in nodes))
+        node = next((node for node, ok in zip(nodes, found) if ok), None)
+        if node is None:
+            self.counters["probe_misses"] += 1
+            return self.default_node
+        await get_async_redis().hset(self.AGENTS_KEY, agent_id, node)
+        return node
+
+    async def client_for_user(self, phone: str) -> AsyncLetta:
+        return get_async_letta(await self.node_for_user(phone))
+
+    async def client_for_agent(self, agent_id: str) -> AsyncLetta:
+        return get_async_letta(await self.node_for_agent(agent_id))
+
+    async def assign_user(self, phone: str, node: str):
+        """
+        Grava o nó do usuário (migração ou carga a partir do banco).
+        """
+        await get_async_redis().hset(self.USERS_KEY, phone, node)
+        self._cache[f"user:{phone}"] = (node, time.monotonic() + self.cache_ttl)
+
+    async def assign_agents(self, node: str, agent_ids: Iterable[str]):
+        """
+        Grava o nó dos agentes (chamado na criação).
+        """
+        mapping = {agent_id: node for agent_id in agent_ids if agent_id}
+        if not mapping:
+            return
+        await get_async_redis().hset(self.AGENTS_KEY, mapping=mapping)
+        for agent_id in mapping:
+            self._remember(f"agent:{agent_id}", node)
+
+    async def unassign_agents(self, agent_ids: Iterable[str]):
+        """
+        Remove o registro de agentes apagados.
+        """
+        agent_ids = [agent_id for agent_id in agent_ids if agent_id]
+        if agent_ids:
+            await get_async_redis().hdel(self.AGENTS_KEY, *agent_ids)
+            self.forget(agent_ids=agent_ids)
+
+    async def warm(self, users) -> int:
+        """
+        Copia para o Redis o nó dos usuários com agentes que ainda não estão lá.
+        Usuários sem `letta_node` (criados antes da divisão) ficam no nó padrão.
+        Retorna quantos foram copiados.
+        """
+        mapping = {
+            user.phone: user.letta_node if user.letta_node in self.nodes else self.default_node
+            for user in users
+            if user.phone and (user.id_main_agent or user.id_onboarding_agent or user.id_background_agent)
+        }
+        if not mapping:
+            return 0
+        async with get_async_redis().pipeline(transaction=False) as pipe:
+            for phone, node in mapping.items():
+                pipe.hsetnx(self.USERS_KEY, phone, node)
+            return sum(await pipe.execute())
+
+    async def stats(self) -> dict:
+        redis = get_async_redis()
+        users = {node: 0 for node in self.nodes}
+        for node in (await redis.hgetall(self.USERS_KEY)).values():
+            users[node] = users.get(node, 0) + 1
+        agents = {node: 0 for node in self.nodes}
+        for node in (await redis.hgetall(self.AGENTS_KEY)).values():
+            agents[node] = agents.get(node, 0) + 1
+        return {
+            **self.counters,
+            "nodes": [
+                {"node": node, "url": self.nodes.get(node), "users": users[node], "agents": agents.get(node, 0), "configured": node in self.nodes}
+                for node in users
+            ],
+            "default_node": self.default_node,
+        }
+
+    # Versão síncrona (tasks do Celery)
+
+    def node_for_user_sync(self, phone: str) -> str:
+        node = self._cached(f"user:{phone}")
+        if node:
+            return node
+        redis = get_sync_redis()
+        node = redis.hget(self.USERS_KEY, phone)
+        if node not in self.nodes:
+            # Tasks do Celery: o repositório de usuários é assíncrono.
+            target = (None if node else asyncio.run(self._stored_node(phone))) or self.ring.node_for(phone)
+            if node:
+                logging.warning(f"Nó Letta {node} do usuário {phone} não está em LETTA_NODES; usando {target}.")
+                redis.hset(self.USERS_KEY, phone, target)
+            elif not redis.hsetnx(self.USERS_KEY, phone, target):
+                target = redis.hget(self.USERS_KEY, phone)
+            node = target
+        return self._remember(f"user:{phone}", node)
+
+    def node_for_agent_sync(self, agent_id: str) -> str:
+        node = self._cached(f"agent:{agent_id}")
+        if node:
+            return node
+        node = get_sync_redis().hget(self.AGENTS_KEY, agent_id)
+        if node not in self.nodes:
+            node = self._probe_agent_sync(agent_id)
+        return self._remember(f"agent:{agent_id}", node)
+
+    def _probe_agent_sync(self, agent_id: str) -> str:
+        self.counters["probes"] += 1
+        for node in self.nodes:
+            try:
+                get_letta(node).agents.retrieve(agent_id)
+            except Exception:
+                continue
+            get_sync_redis().hset(self.AGENTS_KEY, agent_id, node)
+            return node
+        self.counters["probe_misses"] += 1
+        return self.default_node
+
+    def client_for_user_sync(self, phone: str) -> Letta:
+        return get_letta(self.node_for_user_sync(phone))
+
+    def client_for_agent_sync(self, agent_id: str) -> Letta:
+        return get_letta(self.node_for_agent_sync(agent_id))
+
+
+letta_router = LettaRouter()
@@ -1,9 +1,12 @@
 import logging
-import re
 from letta_client import  MessageCreate
-from app.utils.tasks import send_message_task
+from app.utils.tasks import send_message_task, flush_coalesced_messages_task, notify_agents_task
+from app.services.message_coalescer import MessageCoalescer
+from app.services.agent_directory import agent_directory
 
-from app.utils.celery_imports import lc
+from app.services.letta_router import letta_router
+
+coalescer = MessageCoalescer()
 
 def send_user_message_to_agent(agent_id: str, message: str):
     """
@@ -16,10 +19,39 @@ def send_user_message_to_agent(agent_id: str, message: str):
         logging.error(f"Erro ao enfileirar a tarefa: {e}")
         return "Desculpe, ocorreu um erro ao processar sua mensagem."
     
+def notify_agents(agent_ids: list, message: str, batch_size: int = 20):
+    """
+    Envia a mesma mensagem a vários agentes, em tarefas de até `batch_size` agentes.
+    """
+    for start in range(0, len(agent_ids), batch_size):
+        try:
+            notify_agents_task.delay(agent_ids[start:start + batch_size], message)
+        except Exception as e:
+            logging.error(f"Erro ao enfileirar o aviso para {len(agent_ids[start:start + batch_size])} agentes: {e}")
+
+async def send_coalesced_user_message_to_agent(agent_id: str, phone: str, message: str, timestamp: float = None):
+    """
+    Acumula a mensagem do usuário e agenda o envio do lote ao agente ao fim da
+    janela de debounce (ou imediatamente, se o lote estiver cheio).
+    """
+    if not coalescer.enabled:
+        return send_user_message_to_agent(agent_id, message)
+
+    try:
+        size, generation = await coalescer.add(agent_id, phone, message, timestamp)
+        if size >= coalescer.max_batch:
+            flush_coalesced_messages_task.delay(phone)
+        else:
+            flush_coalesced_messages_task.apply_async((phone, generation), countdown=coalescer.window_seconds)
+        return "Sua mensagem está sendo processada. Você será notificado assim que receber uma resposta."
+    except Exception as e:
+        logging.error(f"Erro ao agrupar a mensagem do usuário {phone}: {e}")
+        return send_user_message_to_agent(agent_id, message)
+
 def send_system_message_to_agent(agent_id, message, timeout=30):
     try:
         # Enviar mensagem ao agente
-        lc.agents.messages.create_async(
+        letta_router.client_for_agent_sync(agent_id).agents.messages.create_async(
             agent_id=agent_id,
             messages=[
                 MessageCreate(
@@ -34,40 +66,61 @@ def send_system_message_to_agent(agent_id, message, timeout=30):
 
 def get_onboarding_agent_id(user_number: str):
     """
-    Retorna o ID do agente de onboarding do usuário.
+    Retorna o ID do agente de onboarding do usuário (índice em cache, ver `agent_directory`).
     """
-    try:
-        agents = lc.agents.list(tags=[user_number, "worker", "onboarding"], match_all_tags=True)
-        agent_id = [agent.id for agent in agents]
-        if agent_id:
-            return agent_id[0]
+    agent_id = agent_directory.agent_id(user_number, "onboarding")
+    if not agent_id:
         logging.warning(f"Nenhum agente de onboarding encontrado para o usuário {user_number}.")
-        return None
-    except Exception as e:
-        logging.error(f"Erro ao buscar agente de onboarding para o usuário {user_number}: {e}")
-        return None
+    return agent_id
     
 def get_background_agent_id(user_number: str):
     """
-    Retorna o ID do agente de onboarding do usuário.
+    Retorna o ID do agente background do usuário (índice em cache, ver `agent_directory`).
     """
-    try:
-        agents = lc.agents.list(tags=[user_number, "background"], match_all_tags=True)
-        agent_id = [agent.id for agent in agents]
-        if agent_id:
-            return agent_id[0]
+    agent_id = agent_directory.agent_id(user_number, "background")
+    if not agent_id:
+        logging.warning(f"Nenhum agente background encontrado para o usuário {user_number}.")
+    return agent_id
+
+async def get_onboarding_agent_id_async(user_number: str):
+    """
+    Versão assíncrona de `get_onboarding_agent_id`, para o event loop.
+    """
+    agent_id = await agent_directory.agent_id_async(user_number, "onboarding")
+    if not agent_id:
         logging.warning(f"Nenhum agente de onboarding encontrado para o usuário {user_number}.")
-        return None
-    except Exception as e:
-        logging.error(f"Erro ao buscar agente de onboarding para o usuário {user_number}: {e}")
-        return None
+    return agent_id
+
+async def get_background_agent_id_async(user_number: str):
+    """
+    Versão assíncrona de `get_background_agent_id`, para o event loop.
+    """
+    agent_id = await agent_directory.agent_id_async(user_number, "background")
+    if not agent_id:
+        logging.warning(f"Nenhum agente background encontrado para o usuário {user_number}.")
+    return agent_id
 
 def get_human_block_id(agent_id: str):
     """
     Retorna o ID do bloco humano associado ao agente.
     """
     try:
-        block = lc.agents.core_memory.retrieve_block(agent_id, "human")
+        block = letta_router.client_for_agent_sync(agent_id).agents.core_memory.retrieve_block(agent_id, "human")
+        if block.id:
+            return block.id
+        logging.warning(f"Nenhum bloco humano encontrado para o agente {agent_id}.")
+        return None
+    except Exception as e:
+        logging.error(f"Erro ao buscar bloco humano para o agente {agent_id}: {e}")
+        return None
+    
+async def get_human_block_id_async(agent_id: str):
+    """
+    Versão assíncrona de `get_human_block_id`, para o event loop.
+    """
+    try:
+        letta = await letta_router.client_for_agent(agent_id)
+        block = await letta.agents.core_memory.retrieve_block(agent_id, "human")
         if block.id:
             return block.id
         logging.warning(f"Nenhum bloco humano encontrado para o agente {agent_id}.")
@@ -77,9 +130,4 @@ def get_human_block_id(agent_id: str):
         return None
     
 def get_phone_tag(agent_id: str):
-    agent = lc.agents.retrieve(agent_id)
-    tags = agent.tags
-    for tag in tags:
-        if re.search(r'\d+', tag):
-            return tag
-    return None
\ No newline at end of file
+    return agent_directory.agent_info(agent_id).get("phone")
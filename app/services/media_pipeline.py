@@ -0,0 +1,328 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import tempfile
+from dataclasses import asdict, dataclass
+from typing import List, Optional
+
+from dotenv import load_dotenv
+
+from app.services.whatsapp_service import AsyncWhatsAppService
+from app.utils.archival_memory_manager import background_agent_archival_memory_insert, get_user_by_session
+from app.utils.base64_stream import Base64JsonFieldDecoder
+from app.utils.redis_connection import get_async_redis
+
+load_dotenv()
+
+# Reserva o próximo download: primeiro um em andamento cujo lease venceu (processo que
+# caiu), senão o da frente da fila. O job fica em `KEYS[2]` até agora + lease (ARGV[1]).
+# KEYS: [1] fila, [2] zset dos downloads em andamento
+CLAIM_JOB_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local raw = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now, 'LIMIT', 0, 1)[1]
+if not raw then
+    raw = redis.call('LPOP', KEYS[1])
+end
+if not raw then
+    return false
+end
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[1]), raw)
+return raw
+"""
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+@dataclass
+class MediaRecord:
+    message_id: str
+    session: str
+    type: str
+    mimetype: Optional[str]
+    size: int
+    sha256: str
+    path: str
+    filename: Optional[str] = None
+    caption: Optional[str] = None
+    sender: Optional[str] = None
+    timestamp: Optional[int] = None
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    def describe(self) -> str:
+        """
+        Texto da mídia para a memória arquivística.
+        """
+        name = self.filename or os.path.basename(self.path)
+        text = f"[Mídia recebida: {self.type}] {self.caption or ''}".strip()
+        return (
+            f"{text}\n"
+            f"- Arquivo:           {name} ({self.mimetype or 'tipo desconhecido'}, {self.size / 1024 / 1024:.2f} MB)\n"
+            f"- SHA-256:           {self.sha256}\n"
+            f"- Caminho:           {self.path}"
+        )
+
+
+def message_id_of(payload: dict) -> Optional[str]:
+    message_id = payload.get("id")
+    if isinstance(message_id, dict):
+        message_id = message_id.get("_serialized")
+    return message_id
+
+
+class MediaPipeline:
+    """
+    Download das mídias recebidas nas sessões pessoais conectadas.
+
+    A resposta do `download-media` (JSON com a mídia em base64) é lida em
+    streaming e decodificada em blocos direto para um `SpooledTemporaryFile`
+    (em memória até `MEDIA_SPOOL_MEMORY_BYTES`, depois em disco), calculando o
+    SHA-256 no caminho. Mídias acima de `MEDIA_MAX_BYTES` são abortadas. O
+    arquivo final fica em `MEDIA_STORAGE_DIR/<sha256>.<ext>` (mídias repetidas
+    são gravadas uma vez) e o `MediaRecord` é anexado à memória arquivística.
+
+    Os downloads ficam na fila `media:jobs` do Redis (no máximo
+    `MEDIA_QUEUE_SIZE` mídias; com a fila cheia, a mídia é descartada) e rodam em
+    `MEDIA_WORKERS` tasks por processo. Um download em andamento fica em
+    `media:jobs:inflight` por `MEDIA_JOB_LEASE_MS`; se o processo cair, outro o
+    refaz quando o lease vence.
+
+    Retenção (`sweep`): arquivos com mais de `MEDIA_RETENTION_DAYS` dias são
+    apagados e, se o diretório passar de `MEDIA_MAX_STORAGE_BYTES`, os mais
+    antigos também. O caminho gravado na memória arquivística deixa de existir.
+    """
+
+    JOBS_KEY = "media:jobs"
+    INFLIGHT_KEY = "media:jobs:inflight"
+
+    def __init__(self):
+        self.storage_dir = os.getenv("MEDIA_STORAGE_DIR", "media")
+        self.max_bytes = int(os.getenv("MEDIA_MAX_BYTES", str(64 * 1024 * 1024)))
+        self.spool_bytes = int(os.getenv("MEDIA_SPOOL_MEMORY_BYTES", str(1024 * 1024)))
+        self.chunk_bytes = int(os.getenv("MEDIA_CHUNK_BYTES", str(256 * 1024)))
+        self.worker_count = int(os.getenv("MEDIA_WORKERS", "2"))
+        self.queue_size = int(os.getenv("MEDIA_QUEUE_SIZE", "100"))
+        self.job_lease_ms = int(os.getenv("MEDIA_JOB_LEASE_MS", "600000"))
+        self.poll_seconds = float(os.getenv("MEDIA_POLL_SECONDS", "0.5"))
+        self.retention_days = float(os.getenv("MEDIA_RETENTION_DAYS", "30"))
+        self.max_storage_bytes = int(os.getenv("MEDIA_MAX_STORAGE_BYTES", str(10 * 1024 ** 3)))
+        self.sweep_interval = float(os.getenv("MEDIA_SWEEP_INTERVAL", "3600"))
+        self._workers: List[asyncio.Task] = []
+        self.counters = {
+            "queued": 0, "stored": 0, "deduplicated": 0, "too_large": 0, "failed": 0, "dropped": 0, "bytes": 0,
+            "swept_files": 0, "swept_bytes": 0,
+        }
+
+    def start(self):
+        """
+        Inicia os workers de download deste processo (se ainda não estiverem rodando).
+        """
+        self._workers = [task for task in self._workers if not task.done()]
+        while len(self._workers) < self.worker_count:
+            self._workers.append(asyncio.create_task(self._worker()))
+
+    async def submit(self, payload: dict) -> bool:
+        """
+        Enfileira o download da mídia da mensagem. Retorna False se a fila estiver cheia.
+        """
+        self.start()
+        job = {
+            "message_id": message_id_of(payload),
+            "session": payload.get("session"),
+            "type": payload.get("type"),
+            "mimetype": payload.get("mimetype"),
+            "filename": payload.get("filename"),
+            "caption": payload.get("caption"),
+            "size": payload.get("size"),
+            "sender": (payload.get("sender") or {}).get("id", "").replace("@c.us", ""),
+            "name": payload.get("notifyName"),
+            "is_group": payload.get("isGroupMsg"),
+            "group_id": payload.get("from"),
+            "timestamp": payload.get("t"),
+        }
+        if not job["message_id"]:
+            return False
+        if job["size"] and job["size"] > self.max_bytes:
+            self.counters["too_large"] += 1
+            return False
+        redis = get_async_redis()
+        if await redis.llen(self.JOBS_KEY) >= self.queue_size:
+            self.counters["dropped"] += 1
+            logging.error(f"Fila de mídias cheia, mídia {job['message_id']} descartada.")
+            return False
+        await redis.rpush(self.JOBS_KEY, json.dumps(job))
+        self.counters["queued"] += 1
+        return True
+
+    async def _worker(self):
+        redis = get_async_redis()
+        while True:
+            try:
+                raw = await redis.eval(CLAIM_JOB_SCRIPT, 2, self.JOBS_KEY, self.INFLIGHT_KEY, self.job_lease_ms)
+            except Exception as e:
+                logging.error(f"Erro ao ler a fila de mídias: {e}")
+                raw = None
+            if not raw:
+                await asyncio.sleep(self.poll_seconds)
+                continue
+
+            job = json.loads(raw)
+            try:
+                await self.process(job)
+            except MediaTooLarge as e:
+                self.counters["too_large"] += 1
+                logging.warning(f"Mídia {job['message_id']} ignorada: {e}")
+            except Exception as e:
+                self.counters["failed"] += 1
+                logging.error(f"Erro ao baixar a mídia {job['message_id']} (sessão {job['session']}): {e}")
+            finally:
+                await redis.zrem(self.INFLIGHT_KEY, raw)
+
+    async def process(self, job: dict) -> MediaRecord:
+        user = await get_user_by_session(job["session"])
+        client = AsyncWhatsAppService(session_name=job["session"], token=user.token_wpp if user else None)
+        record = await self.download(
+            client,
+            job["message_id"],
+            media_type=job["type"],
+            mimetype=job["mimetype"],
+            filename=job["filename"],
+            caption=job["caption"],
+            sender=job["sender"],
+            timestamp=job["timestamp"],
+        )
+        await background_agent_archival_memory_insert(
+            session=job["session"],
+            message=record.describe(),
+            origem="WhatsApp",
+            phone=job["sender"],
+            name=job["name"],
+            is_group=job["is_group"],
+            group_id=job["group_id"],
+            timestamp=job["timestamp"],
+        )
+        return record
+
+    async def download(self, client: AsyncWhatsAppService, message_id: str, media_type: str = None,
+                       mimetype: str = None, filename: str = None, caption: str = None,
+                       sender: str = None, timestamp: int = None) -> MediaRecord:
+        """
+        Baixa a mídia em streaming e a grava no armazenamento local.
+        """
+        os.makedirs(self.storage_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes, dir=self.storage_dir)
+        size = 0
+
+        def write(data: bytes):
+            nonlocal size
+            size += len(data)
+            if size > self.max_bytes:
+                raise MediaTooLarge(f"Mídia com mais de {self.max_bytes} bytes.")
+            digest.update(data)
+            spool.write(data)
+
+        decoder = Base64JsonFieldDecoder(write)
+        try:
+            async for chunk in client.download_media_stream(message_id, self.chunk_bytes):
+                await asyncio.to_thread(decoder.feed, chunk)
+            metadata = decoder.close()
+            mimetype = decoder.mimetype or metadata.get("mimetype") or mimetype
+            sha256 = digest.hexdigest()
+            path, created = await asyncio.to_thread(self._store, spool, sha256, mimetype)
+        finally:
+            spool.close()
+
+        self.counters["stored" if created else "deduplicated"] += 1
+        self.counters["bytes"] += size
+        return MediaRecord(
+            message_id=message_id,
+            session=client.session_name,
+            type=media_type,
+            mimetype=mimetype,
+            size=size,
+            sha256=sha256,
+            path=path,
+            filename=filename,
+            caption=caption,
+            sender=sender,
+            timestamp=timestamp,
+        )
+
+    def _store(self, spool, sha256: str, mimetype: Optional[str]):
+        extension = mimetypes.guess_extension((mimetype or "").split(";")[0].strip()) or ""
+        path = os.path.join(self.storage_dir, f"{sha256}{extension}")
+        if os.path.exists(path):
+            return path, False
+        spool.seek(0)
+        partial = f"{path}.{os.getpid()}.part"
+        with open(partial, "wb") as target:
+            shutil.copyfileobj(spool, target, length=1024 * 1024)
+        os.replace(partial, path)
+        return path, True
+
+    def sweep(self) -> dict:
+        """
+        Apaga as mídias além da retenção (idade e tamanho total do diretório).
+        Arquivos da última hora não são apagados pelo limite de tamanho (downloads em andamento).
+        """
+        if not os.path.isdir(self.storage_dir):
+            return {"files": 0, "bytes": 0}
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.storage_dir):
+            if entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+
+        total = sum(size for _, size, _ in files)
+        expire_before = now - self.retention_days * 86400
+        removed, removed_bytes = 0, 0
+        for mtime, size, path in files:
+            too_old = mtime < expire_before
+            over_cap = total > self.max_storage_bytes and mtime < now - 3600
+            if not (too_old or over_cap):
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+            removed_bytes += size
+
+        self.counters["swept_files"] += removed
+        self.counters["swept_bytes"] += removed_bytes
+        return {"files": removed, "bytes": removed_bytes}
+
+    async def close(self):
+        """
+        Encerra os workers (shutdown). Downloads em andamento são cancelados.
+        """
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def stats(self) -> dict:
+        redis = get_async_redis()
+        return {
+            **self.counters,
+            "waiting": await redis.llen(self.JOBS_KEY),
+            "in_progress": await redis.zcard(self.INFLIGHT_KEY),
+            "workers": len(self._workers),
+            "pid": os.getpid(),
+        }
+
+
+media_pipeline = MediaPipeline()
@@ -0,0 +1,108 @@
+import os
+import re
+import json
+import time
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+import pytz
+from dotenv import load_dotenv
+
+from app.utils.redis_connection import get_async_redis
+
+load_dotenv()
+
+brazil_timezone = pytz.timezone("America/Sao_Paulo")
+
+# Início de uma mensagem já unida por `merge_messages` (linhas com o horário).
+STAMPED = re.compile(r"^\[\d{2}:\d{2}:\d{2}\] ")
+
+# Adiciona a mensagem ao lote e avança a geração do debounce.
+# Retorna {tamanho do lote, geração}.
+ADD_SCRIPT = """
+local size = redis.call('RPUSH', KEYS[1], ARGV[1])
+local generation = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[3], ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+redis.call('EXPIRE', KEYS[3], ARGV[3])
+return {size, generation}
+"""
+
+# Retira o lote inteiro de forma atômica. Com ARGV[1] != '' só retira se a geração
+# ainda for a mesma (nenhuma mensagem chegou depois do agendamento do flush).
+POP_SCRIPT = """
+if ARGV[1] ~= '' and redis.call('GET', KEYS[2]) ~= ARGV[1] then
+    return nil
+end
+local items = redis.call('LRANGE', KEYS[1], 0, -1)
+local agent_id = redis.call('GET', KEYS[3])
+redis.call('DEL', KEYS[1], KEYS[3])
+return {agent_id or '', items}
+"""
+
+
+class MessageCoalescer:
+    """
+    Agrupa rajadas de mensagens de um mesmo usuário antes de enviá-las ao agente.
+
+    Cada mensagem entra na lista `coalesce:<phone>` e reinicia a janela de debounce
+    (`COALESCE_WINDOW_SECONDS`). Quando a janela expira sem novas mensagens, ou
+    quando o lote atinge `COALESCE_MAX_BATCH`, as mensagens são unidas, na ordem em
+    que chegaram e com seus horários, em uma única mensagem para o agente.
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv("COALESCE_ENABLED", "true").lower() == "true"
+        self.window_seconds = float(os.getenv("COALESCE_WINDOW_SECONDS", "2.0"))
+        self.max_batch = int(os.getenv("COALESCE_MAX_BATCH", "6"))
+        self.key_ttl = int(os.getenv("COALESCE_KEY_TTL", "300"))
+
+    @staticmethod
+    def _keys(phone: str) -> List[str]:
+        return [f"coalesce:{phone}", f"coalesce:{phone}:generation", f"coalesce:{phone}:agent"]
+
+    async def add(self, agent_id: str, phone: str, message: str, timestamp: Optional[float] = None) -> Tuple[int, int]:
+        """
+        Adiciona a mensagem ao lote do usuário.
+        Retorna o tamanho atual do lote e a geração do debounce.
+        """
+        item = json.dumps({"message": message, "timestamp": timestamp or time.time()})
+        size, generation = await get_async_redis().eval(
+            ADD_SCRIPT, 3, *self._keys(phone), item, agent_id, self.key_ttl
+        )
+        return int(size), int(generation)
+
+    def pop_batch(self, redis_client, phone: str, generation: Optional[int] = None) -> Optional[Tuple[str, List[dict]]]:
+        """
+        Retira o lote do usuário (cliente Redis síncrono, uso nas tasks do Celery).
+        Retorna None se o lote foi renovado por uma mensagem mais nova ou já foi enviado.
+        """
+        result = redis_client.eval(
+            POP_SCRIPT, 3, *self._keys(phone), "" if generation is None else str(generation)
+        )
+        if not result:
+            return None
+        agent_id, items = result
+        if not agent_id or not items:
+            return None
+        return agent_id, [json.loads(item) for item in items]
+
+    @staticmethod
+    def merge_messages(items: List[dict]) -> str:
+        """
+        Une as mensagens do lote preservando a ordem e o horário de cada uma.
+        Mensagens que já são um lote unido (ex.: na caixa do agente) entram como
+        estão, sem um segundo horário na frente.
+        """
+        if len(items) == 1:
+            return items[0]["message"]
+
+        lines = []
+        for item in items:
+            if STAMPED.match(item["message"]):
+                lines.append(item["message"])
+                continue
+            sent_at = datetime.fromtimestamp(item["timestamp"], brazil_timezone)
+            lines.append(f"[{sent_at.strftime('%H:%M:%S')}] {item['message']}")
+        return "\n".join(lines)
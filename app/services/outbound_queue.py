@@ -0,0 +1,363 @@
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+import logging
+from typing import Dict, List
+
+import httpx
+from dotenv import load_dotenv
+
+from app.services.whatsapp_service import HTTP_READ_TIMEOUT, AsyncWhatsAppService, async_wpp
+from app.utils.redis_connection import get_async_redis, get_sync_redis
+
+load_dotenv()
+
+# Métodos do WhatsAppService que podem ser enfileirados.
+QUEUEABLE_METHODS = {
+    "send_message", "send_image", "send_file", "send_reply", "send_voice_base64",
+    # Variantes a partir de arquivo em disco: o arquivo precisa existir até o envio.
+    "send_file_from_path", "send_image_from_path", "send_voice_base64_from_path",
+}
+
+# KEYS: [1] fila do destinatário, [2] zset de destinatários prontos
+# ARGV: [1] mensagem, [2] membro (sessão|telefone)
+ENQUEUE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local size = redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('ZADD', KEYS[2], 'NX', now, ARGV[2])
+return size
+"""
+
+# Reserva até ARGV[1] destinatários prontos, empurrando o horário deles para
+# agora + lease (ARGV[2]) para que nenhum outro worker os pegue enquanto envia,
+# e registra o dono da reserva (ARGV[3]) no hash de reservas.
+# KEYS: [1] zset de prontos, [2] hash de reservas
+CLAIM_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, tonumber(ARGV[1]))
+for _, member in ipairs(members) do
+    redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), member)
+    redis.call('HSET', KEYS[2], member, ARGV[3])
+end
+return members
+"""
+
+# Estende a reserva (agora + ARGV[2]) enquanto o envio está em andamento, se ela ainda for do dono ARGV[3].
+# KEYS: [1] zset de prontos, [2] hash de reservas. ARGV: [1] membro, [2] lease (ms), [3] dono
+RENEW_CLAIM_SCRIPT = """
+if redis.call('HGET', KEYS[2], ARGV[1]) ~= ARGV[3] then
+    return 0
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+redis.call('ZADD', KEYS[1], 'XX', now + tonumber(ARGV[2]), ARGV[1])
+return 1
+"""
+
+# Remove a mensagem da frente da fila (ARGV[3] == '1' move para a dead letter, com a
+# versão atualizada ARGV[6] se houver) e agenda o próximo envio do destinatário para
+# agora + ARGV[2], ou o retira do zset se a fila acabou. Só age se a reserva ainda for
+# do dono ARGV[5] (retorna -1 caso contrário).
+# KEYS: [1] fila, [2] zset de prontos, [3] dead letter, [4] hash de reservas
+# ARGV: [1] membro, [2] espera (ms), [3] dead, [4] limite da dead letter, [5] dono, [6] mensagem atualizada ou ''
+ADVANCE_SCRIPT = """
+if redis.call('HGET', KEYS[4], ARGV[1]) ~= ARGV[5] then
+    return -1
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local head = redis.call('LPOP', KEYS[1])
+if head and ARGV[3] == '1' then
+    if ARGV[6] ~= '' then
+        head = ARGV[6]
+    end
+    redis.call('RPUSH', KEYS[3], head)
+    redis.call('LTRIM', KEYS[3], -tonumber(ARGV[4]), -1)
+end
+redis.call('HDEL', KEYS[4], ARGV[1])
+if redis.call('LLEN', KEYS[1]) > 0 then
+    redis.call('ZADD', KEYS[2], now + tonumber(ARGV[2]), ARGV[1])
+else
+    redis.call('ZREM', KEYS[2], ARGV[1])
+end
+return redis.call('LLEN', KEYS[1])
+"""
+
+# Atualiza a mensagem da frente (tentativas) e reagenda o destinatário para agora + ARGV[2],
+# se a reserva ainda for do dono ARGV[4] (retorna -1 caso contrário).
+# KEYS: [1] fila, [2] zset de prontos, [3] hash de reservas
+# ARGV: [1] membro, [2] espera (ms), [3] mensagem atualizada ou '', [4] dono
+RESCHEDULE_SCRIPT = """
+if redis.call('HGET', KEYS[3], ARGV[1]) ~= ARGV[4] then
+    return -1
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+if ARGV[3] ~= '' and redis.call('LLEN', KEYS[1]) > 0 then
+    redis.call('LSET', KEYS[1], 0, ARGV[3])
+end
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[2]), ARGV[1])
+return 1
+"""
+
+# Intervalo mínimo entre envios da mesma sessão do WhatsApp.
+# Retorna 0 se o envio pode seguir, ou quantos ms faltam.
+SESSION_SLOT_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local next_at = tonumber(redis.call('GET', KEYS[1]))
+if next_at and now < next_at then
+    return next_at - now
+end
+redis.call('SET', KEYS[1], now + tonumber(ARGV[1]), 'PX', math.max(1, tonumber(ARGV[1]) * 2))
+return 0
+"""
+
+
+class OutboundQueue:
+    """
+    Fila de envio de mensagens do WhatsApp no Redis.
+
+    Cada destinatário tem sua fila (`outbound:queue:<sessão>:<telefone>`), enviada
+    em ordem, e os destinatários com mensagens aguardando ficam no zset
+    `outbound:ready` com o horário do próximo envio permitido. O worker reserva
+    vários destinatários de uma vez e envia para eles em paralelo, respeitando o
+    intervalo mínimo por destinatário (`OUTBOUND_RECIPIENT_INTERVAL_MS`) e por
+    sessão (`OUTBOUND_SESSION_INTERVAL_MS`). Só são repetidas, com backoff
+    exponencial e jitter, as falhas em que o WPPConnect certamente não enviou a
+    mensagem: erro de conexão ou recusa explícita (429/503). Um tempo esgotado na
+    leitura ou outro erro do servidor é ambíguo (a mensagem pode ter sido
+    entregue) e, como os demais erros, manda a mensagem direto para
+    `outbound:dead`, assim como esgotar as `OUTBOUND_MAX_ATTEMPTS` tentativas.
+
+    A reserva de um destinatário tem um dono (`outbound:claims`) e dura
+    `OUTBOUND_CLAIM_LEASE_MS` (no mínimo o timeout de leitura do WPPConnect mais
+    uma folga); ela é renovada enquanto o envio está em andamento. Avançar ou
+    reagendar a fila só acontece se a reserva ainda for do worker que enviou.
+    """
+
+    READY_KEY = "outbound:ready"
+    DEAD_KEY = "outbound:dead"
+    CLAIMS_KEY = "outbound:claims"
+
+    def __init__(self):
+        self.recipient_interval_ms = int(os.getenv("OUTBOUND_RECIPIENT_INTERVAL_MS", "1000"))
+        self.session_interval_ms = int(os.getenv("OUTBOUND_SESSION_INTERVAL_MS", "200"))
+        self.max_attempts = int(os.getenv("OUTBOUND_MAX_ATTEMPTS", "6"))
+        self.backoff_base_ms = int(os.getenv("OUTBOUND_BACKOFF_BASE_MS", "1000"))
+        self.backoff_max_ms = int(os.getenv("OUTBOUND_BACKOFF_MAX_MS", "60000"))
+        self.claim_lease_ms = max(int(os.getenv("OUTBOUND_CLAIM_LEASE_MS", "90000")), int(HTTP_READ_TIMEOUT * 1000) + 30000)
+        self.drain_batch = int(os.getenv("OUTBOUND_DRAIN_BATCH", "50"))
+        self.concurrency = int(os.getenv("OUTBOUND_CONCURRENCY", "10"))
+        self.dead_letter_limit = int(os.getenv("OUTBOUND_DEAD_LETTER_LIMIT", "1000"))
+        self.clients: Dict[str, AsyncWhatsAppService] = {"principal": async_wpp}
+        self.counters = {"sent": 0, "retried": 0, "dead": 0, "ambiguous": 0, "throttled": 0, "lost_claims": 0}
+
+    @staticmethod
+    def _member(session: str, phone: str) -> str:
+        return f"{session}|{phone}"
+
+    @staticmethod
+    def _queue_key(member: str) -> str:
+        session, phone = member.split("|", 1)
+        return f"outbound:queue:{session}:{phone}"
+
+    def _build(self, phone: str, method: str, kwargs: dict, session: str) -> tuple:
+        if method not in QUEUEABLE_METHODS:
+            raise ValueError(f"Método {method} não pode ser enfileirado.")
+        member = self._member(session, phone)
+        message = json.dumps({
+            "method": method,
+            "kwargs": {"phone": phone, **kwargs},
+            "attempts": 0,
+            "enqueued_at": time.time(),
+        })
+        return member, message
+
+    def enqueue(self, phone: str, method: str, kwargs: dict, session: str = "principal") -> int:
+        """
+        Enfileira um envio (cliente síncrono, tasks do Celery). Retorna o tamanho da fila do destinatário.
+        """
+        member, message = self._build(phone, method, kwargs, session)
+        return get_sync_redis().eval(ENQUEUE_SCRIPT, 2, self._queue_key(member), self.READY_KEY, message, member)
+
+    async def enqueue_async(self, phone: str, method: str, kwargs: dict, session: str = "principal") -> int:
+        """
+        Enfileira um envio a partir do event loop (FastAPI, flows e workers).
+        """
+        member, message = self._build(phone, method, kwargs, session)
+        return await get_async_redis().eval(ENQUEUE_SCRIPT, 2, self._queue_key(member), self.READY_KEY, message, member)
+
+    def _backoff_ms(self, attempts: int) -> int:
+        delay = min(self.backoff_max_ms, self.backoff_base_ms * 2 ** (attempts - 1))
+        return int(delay / 2 + random.uniform(0, delay / 2))
+
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        """
+        True se o envio certamente não aconteceu: a conexão não foi aberta ou o
+        servidor o recusou explicitamente. Repetir outros erros duplicaria mensagens.
+        """
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code in (429, 503)
+        return isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+    @staticmethod
+    def _is_ambiguous(error: Exception) -> bool:
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code >= 500
+        return isinstance(error, (httpx.ReadTimeout, httpx.ReadError, httpx.WriteTimeout, httpx.RemoteProtocolError))
+
+    async def claim(self, owner: str) -> List[str]:
+        return await get_async_redis().eval(CLAIM_SCRIPT, 2, self.READY_KEY, self.CLAIMS_KEY, self.drain_batch, self.claim_lease_ms, owner)
+
+    async def _advance(self, member: str, owner: str, wait_ms: int, dead: bool = False, message: str = ""):
+        result = await get_async_redis().eval(
+            ADVANCE_SCRIPT, 4, self._queue_key(member), self.READY_KEY, self.DEAD_KEY, self.CLAIMS_KEY,
+            member, wait_ms, "1" if dead else "0", self.dead_letter_limit, owner, message
+        )
+        if result == -1:
+            self.counters["lost_claims"] += 1
+            logging.warning(f"Reserva da fila de envio de {member} perdida; a fila não foi avançada.")
+
+    async def _reschedule(self, member: str, owner: str, wait_ms: int, message: str = ""):
+        result = await get_async_redis().eval(
+            RESCHEDULE_SCRIPT, 3, self._queue_key(member), self.READY_KEY, self.CLAIMS_KEY, member, wait_ms, message, owner
+        )
+        if result == -1:
+            self.counters["lost_claims"] += 1
+            logging.warning(f"Reserva da fila de envio de {member} perdida; a fila não foi reagendada.")
+
+    async def _renew_claim(self, member: str, owner: str):
+        """
+        Renova a reserva a cada terço do lease enquanto o envio não termina.
+        """
+        while True:
+            await asyncio.sleep(self.claim_lease_ms / 3000)
+            renewed = await get_async_redis().eval(RENEW_CLAIM_SCRIPT, 2, self.READY_KEY, self.CLAIMS_KEY, member, self.claim_lease_ms, owner)
+            if not renewed:
+                return
+
+    async def send_next(self, member: str, owner: str):
+        """
+        Envia a mensagem da frente da fila do destinatário reservado por `owner`.
+        """
+        redis = get_async_redis()
+        queue_key = self._queue_key(member)
+        session = member.split("|", 1)[0]
+
+        raw = await redis.lindex(queue_key, 0)
+        if raw is None:
+            await self._advance(member, owner, 0)
+            return
+
+        wait_ms = await redis.eval(SESSION_SLOT_SCRIPT, 1, f"outbound:session:{session}:next", self.session_interval_ms)
+        if wait_ms:
+            self.counters["throttled"] += 1
+            await self._reschedule(member, owner, wait_ms)
+            return
+
+        message = json.loads(raw)
+        renewer = asyncio.create_task(self._renew_claim(member, owner))
+        try:
+            client = self.clients.get(session)
+            if client is None:
+                raise ValueError(f"Sessão {session} sem cliente de envio configurado.")
+            await getattr(client, message["method"])(**message["kwargs"])
+        except Exception as e:
+            message["attempts"] += 1
+            message["last_error"] = str(e)
+            if not self._is_retryable(e) or message["attempts"] >= self.max_attempts:
+                self.counters["dead"] += 1
+                if self._is_ambiguous(e):
+                    # O WPPConnect pode ter entregue a mensagem: não repete para não duplicar.
+                    self.counters["ambiguous"] += 1
+                    message["ambiguous"] = True
+                logging.error(f"Envio para {member} descartado após {message['attempts']} tentativa(s): {e}")
+                await self._advance(member, owner, self.recipient_interval_ms, dead=True, message=json.dumps(message))
+            else:
+                self.counters["retried"] += 1
+                delay = self._backoff_ms(message["attempts"])
+                logging.warning(f"Falha no envio para {member}, nova tentativa em {delay} ms: {e}")
+                await self._reschedule(member, owner, delay, json.dumps(message))
+            return
+        finally:
+            renewer.cancel()
+
+        self.counters["sent"] += 1
+        await self._advance(member, owner, self.recipient_interval_ms)
+
+    async def drain_once(self) -> int:
+        """
+        Reserva um lote de destinatários prontos e envia uma mensagem para cada um,
+        em paralelo. Retorna quantos destinatários foram reservados.
+        """
+        owner = uuid.uuid4().hex
+        members = await self.claim(owner)
+        if not members:
+            return 0
+
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def send(member: str):
+            async with slots:
+                try:
+                    await self.send_next(member, owner)
+                except Exception as e:
+                    logging.error(f"Erro ao processar a fila de envio de {member}: {e}")
+
+        await asyncio.gather(*(send(member) for member in members))
+        return len(members)
+
+    async def stats(self) -> dict:
+        redis = get_async_redis()
+        oldest = await redis.zrange(self.READY_KEY, 0, 0, withscores=True)
+        return {
+            **self.counters,
+            "recipients_waiting": await redis.zcard(self.READY_KEY),
+            "dead_letter": await redis.llen(self.DEAD_KEY),
+            "next_send_at_ms": int(oldest[0][1]) if oldest else None,
+            "pid": os.getpid(),
+        }
+
+
+outbound_queue = OutboundQueue()
+
+
+class QueuedWhatsApp:
+    """
+    Mesma interface de envio do WhatsAppService, mas enfileira as mensagens
+    na `outbound_queue` em vez de enviá-las na hora (tasks do Celery).
+    """
+
+    def __init__(self, session: str = "principal"):
+        self.session = session
+
+    def send_message(self, phone: str, message: str, is_group: bool = False):
+        return outbound_queue.enqueue(phone, "send_message", {"message": message, "is_group": is_group}, self.session)
+
+    def send_image(self, phone: str, base64_str: str, filename: str, caption: str):
+        return outbound_queue.enqueue(phone, "send_image", {"base64_str": base64_str, "filename": filename, "caption": caption}, self.session)
+
+
+class AsyncQueuedWhatsApp(QueuedWhatsApp):
+    """
+    Versão assíncrona do `QueuedWhatsApp`, para o FastAPI e os flows.
+    """
+
+    async def send_message(self, phone: str, message: str, is_group: bool = False):
+        return await outbound_queue.enqueue_async(phone, "send_message", {"message": message, "is_group": is_group}, self.session)
+
+    async def send_image(self, phone: str, base64_str: str, filename: str, caption: str):
+        return await outbound_queue.enqueue_async(phone, "send_image", {"base64_str": base64_str, "filename": filename, "caption": caption}, self.session)
+
+
+queued_wpp = QueuedWhatsApp()
+async_queued_wpp = AsyncQueuedWhatsApp()
+
@@ -0,0 +1,268 @@
+import os
+import json
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+from dotenv import load_dotenv
+
+from app.services.webhook_stream import partition_key
+from app.utils.redis_connection import get_async_redis
+
+load_dotenv()
+
+# Token bucket duplo (remetente/sessão + global) verificado e debitado de forma atômica.
+# KEYS: [1] bucket do remetente/sessão, [2] bucket global
+# ARGV: [1] taxa/s e [2] capacidade do remetente, [3] taxa/s e [4] capacidade global,
+#       [5] reserva global (tokens que precisam sobrar após o débito), [6] custo
+# Retorno: {admitido (0/1), tokens do remetente, tokens globais, espera sugerida em ms}
+TOKEN_BUCKET_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local function refill(key, rate, capacity)
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate / 1000)
+    return tokens
+end
+
+local key_rate, key_capacity = tonumber(ARGV[1]), tonumber(ARGV[2])
+local global_rate, global_capacity = tonumber(ARGV[3]), tonumber(ARGV[4])
+local reserve, cost = tonumber(ARGV[5]), tonumber(ARGV[6])
+
+local key_tokens = refill(KEYS[1], key_rate, key_capacity)
+local global_tokens = refill(KEYS[2], global_rate, global_capacity)
+
+local admitted = 0
+local wait_ms = 0
+if key_tokens >= cost and global_tokens - cost >= reserve then
+    admitted = 1
+    key_tokens = key_tokens - cost
+    global_tokens = global_tokens - cost
+else
+    local key_wait = math.max(0, cost - key_tokens) * 1000 / key_rate
+    local global_wait = math.max(0, cost + reserve - global_tokens) * 1000 / global_rate
+    wait_ms = math.ceil(math.max(key_wait, global_wait))
+end
+
+redis.call('HSET', KEYS[1], 'tokens', key_tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(key_capacity * 1000 / key_rate) * 2)
+redis.call('HSET', KEYS[2], 'tokens', global_tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[2], math.ceil(global_capacity * 1000 / global_rate) * 2)
+
+return {admitted, tostring(key_tokens), tostring(global_tokens), wait_ms}
+"""
+
+# Adia o evento no fim da fila do remetente. Com ARGV[5] == '1', só adia se o remetente
+# já tiver eventos adiados (para manter a ordem); sem fila, retorna 0. Uma fila nova só
+# é criada se o total de adiados estiver abaixo do limite ARGV[3] (senão retorna -1).
+# KEYS: [1] fila do remetente, [2] zset de remetentes, [3] total de adiados
+# ARGV: [1] evento, [2] horário (ms), [3] limite, [4] remetente, [5] só atrás de outros
+DEFER_SCRIPT = """
+local exists = redis.call('EXISTS', KEYS[1]) == 1
+if not exists then
+    if ARGV[5] == '1' then
+        return 0
+    end
+    if tonumber(redis.call('GET', KEYS[3]) or '0') >= tonumber(ARGV[3]) then
+        return -1
+    end
+end
+redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('INCR', KEYS[3])
+if not exists then
+    redis.call('ZADD', KEYS[2], ARGV[2], ARGV[4])
+end
+return 1
+"""
+
+# Reserva até ARGV[2] remetentes vencidos, empurrando o horário deles para agora + lease (ARGV[3]).
+# KEYS: [1] zset de remetentes. ARGV: [1] agora (ms), [2] limite, [3] lease (ms)
+CLAIM_DEFERRED_SCRIPT = """
+local senders = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, sender in ipairs(senders) do
+    redis.call('ZADD', KEYS[1], tonumber(ARGV[1]) + tonumber(ARGV[3]), sender)
+end
+return senders
+"""
+
+# Remove o evento da frente da fila do remetente e agenda o próximo para ARGV[2] (ms),
+# ou tira o remetente do zset se a fila acabou.
+# KEYS: [1] fila do remetente, [2] zset de remetentes, [3] total de adiados. ARGV: [1] remetente, [2] horário
+ADVANCE_DEFERRED_SCRIPT = """
+if redis.call('LPOP', KEYS[1]) then
+    redis.call('DECR', KEYS[3])
+end
+if redis.call('LLEN', KEYS[1]) > 0 then
+    redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+else
+    redis.call('ZREM', KEYS[2], ARGV[1])
+end
+"""
+
+
+@dataclass
+class AdmissionDecision:
+    admitted: bool
+    priority: str
+    policy: str
+    bucket_key: str
+    key_tokens: float
+    global_tokens: float
+    retry_after_ms: int
+
+
+class WebhookRateLimiter:
+    """
+    Controle de admissão do webhook com token buckets no Redis (script Lua, vale
+    entre todos os workers do uvicorn), em dois níveis: por remetente (sessão
+    principal) ou por sessão (sessões pessoais conectadas), e global.
+
+    A sessão `principal` tem prioridade: as sessões background só são admitidas
+    se sobrarem `RATE_LIMIT_BACKGROUND_RESERVE` tokens no bucket global, que
+    ficam reservados para as conversas com o assistente. Eventos acima da cota
+    são descartados ("shed") ou adiados ("defer") conforme a política de cada
+    prioridade; os adiados ficam em uma fila por remetente (a mesma chave de
+    particionamento do stream, `webhook:deferred:<remetente>`) e os remetentes
+    com eventos adiados, no zset `webhook:deferred`, com o horário da próxima
+    tentativa. O worker reprocessa cada fila em ordem quando houver tokens, e,
+    enquanto um remetente tiver eventos adiados, os eventos seguintes dele
+    também são adiados, para não passarem na frente.
+    """
+
+    GLOBAL_KEY = "ratelimit:bucket:global"
+    DEFERRED_KEY = "webhook:deferred"
+    DEFERRED_COUNT_KEY = "webhook:deferred:count"
+
+    def __init__(self):
+        self.enabled = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+        self.principal_rate = float(os.getenv("RATE_LIMIT_PRINCIPAL_RATE", "1"))
+        self.principal_capacity = float(os.getenv("RATE_LIMIT_PRINCIPAL_CAPACITY", "10"))
+        self.background_rate = float(os.getenv("RATE_LIMIT_BACKGROUND_RATE", "5"))
+        self.background_capacity = float(os.getenv("RATE_LIMIT_BACKGROUND_CAPACITY", "50"))
+        self.global_rate = float(os.getenv("RATE_LIMIT_GLOBAL_RATE", "50"))
+        self.global_capacity = float(os.getenv("RATE_LIMIT_GLOBAL_CAPACITY", "200"))
+        self.background_reserve = float(os.getenv("RATE_LIMIT_BACKGROUND_RESERVE", "40"))
+        self.principal_policy = os.getenv("RATE_LIMIT_POLICY_PRINCIPAL", "defer")
+        self.background_policy = os.getenv("RATE_LIMIT_POLICY_BACKGROUND", "shed")
+        self.max_deferred = int(os.getenv("RATE_LIMIT_MAX_DEFERRED", "10000"))
+        self.deferred_claim_ms = int(os.getenv("RATE_LIMIT_DEFERRED_CLAIM_MS", "30000"))
+
+    @staticmethod
+    def bucket_key(payload: dict) -> str:
+        session = payload.get("session") or ""
+        if session == "principal":
+            sender = (payload.get("sender") or {}).get("id") or "unknown"
+            return f"ratelimit:bucket:phone:{sender.split('@')[0]}"
+        return f"ratelimit:bucket:session:{session}"
+
+    async def check(self, payload: dict, cost: float = 1) -> AdmissionDecision:
+        """
+        Verifica e, se houver tokens, debita a cota do evento.
+        """
+        is_principal = payload.get("session") == "principal"
+        priority = "principal" if is_principal else "background"
+        key = self.bucket_key(payload)
+
+        if is_principal:
+            rate, capacity, reserve, policy = self.principal_rate, self.principal_capacity, 0, self.principal_policy
+        else:
+            rate, capacity, reserve, policy = self.background_rate, self.background_capacity, self.background_reserve, self.background_policy
+
+        admitted, key_tokens, global_tokens, wait_ms = await get_async_redis().eval(
+            TOKEN_BUCKET_SCRIPT, 2, key, self.GLOBAL_KEY,
+            rate, capacity, self.global_rate, self.global_capacity, reserve, cost
+        )
+        return AdmissionDecision(
+            admitted=bool(admitted),
+            priority=priority,
+            policy=policy,
+            bucket_key=key,
+            key_tokens=float(key_tokens),
+            global_tokens=float(global_tokens),
+            retry_after_ms=int(wait_ms),
+        )
+
+    def _deferred_key(self, sender: str) -> str:
+        return f"{self.DEFERRED_KEY}:{sender}"
+
+    async def _defer(self, payload: dict, due_at: float, behind: bool) -> int:
+        sender = partition_key(payload)
+        return await get_async_redis().eval(
+            DEFER_SCRIPT, 3, self._deferred_key(sender), self.DEFERRED_KEY, self.DEFERRED_COUNT_KEY,
+            json.dumps(payload), due_at, self.max_deferred, sender, "1" if behind else "0"
+        )
+
+    async def defer(self, payload: dict, retry_after_ms: int) -> bool:
+        """
+        Adia o evento. Retorna False se a fila de adiados estiver cheia.
+        """
+        return await self._defer(payload, time.time() * 1000 + max(retry_after_ms, 100), behind=False) == 1
+
+    async def defer_behind(self, payload: dict) -> bool:
+        """
+        Adia o evento se o remetente já tiver eventos adiados, para não passar na frente
+        deles. Retorna False se não houver (o evento segue o controle de admissão normal).
+        """
+        return await self._defer(payload, 0, behind=True) == 1
+
+    async def claim_due(self, limit: int = 100) -> List[str]:
+        """
+        Reserva os remetentes cuja próxima tentativa já chegou (por `RATE_LIMIT_DEFERRED_CLAIM_MS`).
+        """
+        return await get_async_redis().eval(
+            CLAIM_DEFERRED_SCRIPT, 1, self.DEFERRED_KEY, int(time.time() * 1000), limit, self.deferred_claim_ms
+        )
+
+    async def head(self, sender: str) -> Optional[dict]:
+        raw = await get_async_redis().lindex(self._deferred_key(sender), 0)
+        return json.loads(raw) if raw else None
+
+    async def advance(self, sender: str):
+        """
+        Retira o evento da frente da fila do remetente (já processado) e libera o próximo.
+        """
+        await get_async_redis().eval(
+            ADVANCE_DEFERRED_SCRIPT, 3, self._deferred_key(sender), self.DEFERRED_KEY, self.DEFERRED_COUNT_KEY,
+            sender, int(time.time() * 1000)
+        )
+
+    async def postpone(self, sender: str, retry_after_ms: int):
+        await get_async_redis().zadd(self.DEFERRED_KEY, {sender: time.time() * 1000 + max(retry_after_ms, 100)}, xx=True)
+
+    async def bucket_state(self, keys: Optional[List[str]] = None, limit: int = 100) -> dict:
+        """
+        Estado atual dos buckets: o global e os informados (ou até `limit` encontrados via SCAN).
+        """
+        redis = get_async_redis()
+        if not keys:
+            keys = []
+            async for key in redis.scan_iter(match="ratelimit:bucket:*", count=500):
+                if key != self.GLOBAL_KEY:
+                    keys.append(key)
+                if len(keys) >= limit:
+                    break
+
+        async def read(key: str) -> dict:
+            bucket = await redis.hgetall(key)
+            return {
+                "key": key,
+                "tokens": float(bucket["tokens"]) if bucket.get("tokens") else None,
+                "updated_at_ms": int(bucket["ts"]) if bucket.get("ts") else None,
+            }
+
+        return {
+            "global": {**await read(self.GLOBAL_KEY), "rate": self.global_rate, "capacity": self.global_capacity, "background_reserve": self.background_reserve},
+            "limits": {
+                "principal": {"rate": self.principal_rate, "capacity": self.principal_capacity, "policy": self.principal_policy},
+                "background": {"rate": self.background_rate, "capacity": self.background_capacity, "policy": self.background_policy},
+            },
+            "deferred": int(await redis.get(self.DEFERRED_COUNT_KEY) or 0),
+            "deferred_senders": await redis.zcard(self.DEFERRED_KEY),
+            "buckets": [await read(key) for key in keys],
+        }
+
+
+webhook_rate_limiter = WebhookRateLimiter()
@@ -0,0 +1,238 @@
+import os
+import time
+import logging
+from typing import Dict, Optional
+
+import httpx
+from dotenv import load_dotenv
+from letta_client import MessageCreate, AssistantMessage, ToolCallMessage
+
+from app.services.letta_router import letta_router
+from app.services.outbound_queue import queued_wpp
+from app.services.whatsapp_service import wpp
+
+load_dotenv()
+
+# Tools de integração: o próprio fluxo delas responde ao usuário, então a
+# resposta do agente na mesma execução não é enviada.
+FLAGGED_TOOLS = ("start_whatsapp_integration", "start_google_integration", "verify_integrations_status")
+
+ERROR_MESSAGE = "Erro ao processar a solicitação. Por favor, tente novamente mais tarde."
+SLOW_MESSAGE = "Sua solicitação está demorando mais que o normal, estamos aguardando a finalização."
+
+
+def is_flagged_tool(name: Optional[str]) -> bool:
+    return bool(name) and any(tool in name for tool in FLAGGED_TOOLS)
+
+
+def is_suppressed(messages, role: Optional[str]) -> bool:
+    """
+    Se a resposta de uma run concluída não deve ser enviada ao usuário: agente
+    background ou chamada a uma das `FLAGGED_TOOLS`.
+    """
+    if role == "background":
+        return True
+    return any(isinstance(msg, ToolCallMessage) and is_flagged_tool(msg.tool_call.name) for msg in messages)
+
+
+def text_of(content) -> str:
+    """
+    Texto de uma AssistantMessage (string ou lista de TextContent).
+    """
+    if isinstance(content, str):
+        return content
+    return "".join(getattr(part, "text", None) or "" for part in content or ())
+
+
+def message_id_of(response) -> Optional[str]:
+    """
+    ID da mensagem enviada, na resposta do send-message do WPPConnect.
+    """
+    data = response.get("response") if isinstance(response, dict) else None
+    if isinstance(data, list):
+        data = data[-1] if data else None
+    if not isinstance(data, dict):
+        return None
+    message_id = data.get("id")
+    if isinstance(message_id, dict):
+        message_id = message_id.get("_serialized")
+    return message_id or None
+
+
+class StreamedReply:
+    """
+    Mensagens do WhatsApp de uma resposta em streaming: uma por `send_message`
+    do agente. A primeira versão de cada uma é enviada assim que tem texto
+    suficiente e as seguintes a editam.
+    """
+
+    def __init__(self, streamer: "ReplyStreamer", phone: str):
+        self.streamer = streamer
+        self.phone = phone
+        self.texts: Dict[str, str] = {}
+        # ID da mensagem do Letta → (ID da mensagem no WhatsApp, texto enviado)
+        self.sent: Dict[str, tuple] = {}
+        self.current: Optional[str] = None
+        self.last_edit = 0.0
+
+    @property
+    def delivered(self) -> bool:
+        return bool(self.sent)
+
+    def update(self, message_id: str, text: str, delta: bool):
+        if self.current and message_id != self.current:
+            self.flush(self.current, final=True)
+        self.current = message_id
+        self.texts[message_id] = self.texts.get(message_id, "") + text if delta else text
+        self.flush(message_id, final=False)
+
+    def finish(self):
+        if self.current:
+            self.flush(self.current, final=True)
+
+    def flush(self, message_id: str, final: bool):
+        text = self.texts.get(message_id, "").strip()
+        if not text:
+            return
+        shown = text if final else text + self.streamer.cursor
+        sent = self.sent.get(message_id)
+
+        if sent is None:
+            if final or len(text) >= self.streamer.min_chars:
+                self._send(message_id, text, shown)
+            return
+
+        wpp_id, sent_text = sent
+        if shown == sent_text:
+            return
+        if not final and (
+            time.monotonic() - self.last_edit < self.streamer.edit_interval
+            or len(shown) - len(sent_text) < self.streamer.min_delta
+        ):
+            return
+        if wpp_id is None:
+            # Sem ID para editar: o restante vai em uma nova mensagem, no fim.
+            if final:
+                rest = text[len(sent_text):].strip() if text.startswith(sent_text) else text
+                if rest:
+                    queued_wpp.send_message(self.phone, rest)
+                self.sent[message_id] = (None, text)
+            return
+        self._edit(message_id, wpp_id, text, shown, final)
+
+    def _send(self, message_id: str, text: str, shown: str):
+        try:
+            wpp_id = message_id_of(wpp.send_message(self.phone, shown))
+        except Exception as e:
+            # Fica para a fila de saída, que repete o envio; não haverá edições.
+            logging.warning(f"Erro ao enviar a resposta parcial para {self.phone}: {e}")
+            queued_wpp.send_message(self.phone, text)
+            self.sent[message_id] = (None, text)
+            return
+        self.sent[message_id] = (wpp_id, shown if wpp_id else shown.removesuffix(self.streamer.cursor))
+        self.last_edit = time.monotonic()
+
+    def _edit(self, message_id: str, wpp_id: str, text: str, shown: str, final: bool):
+        try:
+            wpp.edit_message(wpp_id, shown)
+        except Exception as e:
+            logging.warning(f"Erro ao editar a mensagem {wpp_id} de {self.phone}: {e}")
+            if final:
+                # A versão parcial ficaria como resposta: envia o texto completo.
+                queued_wpp.send_message(self.phone, text)
+                self.sent[message_id] = (None, text)
+            return
+        self.sent[message_id] = (wpp_id, shown)
+        self.last_edit = time.monotonic()
+
+
+class ReplyStreamer:
+    """
+    Entrega a resposta do agente enquanto o Letta a gera, em vez de esperar o
+    fim da run e o próximo polling.
+
+    O primeiro trecho de cada `send_message` é enviado quando atinge
+    `LETTA_STREAM_MIN_CHARS` caracteres (ou quando a mensagem termina) e a mesma
+    mensagem do WhatsApp é editada à medida que o texto cresce, no máximo a cada
+    `LETTA_STREAM_EDIT_INTERVAL` segundos e com pelo menos
+    `LETTA_STREAM_MIN_DELTA` caracteres novos. Esse envio é direto (sem a
+    `outbound_queue`), pois é preciso o ID da mensagem para editá-la.
+
+    A supressão continua valendo: agentes background não respondem ao usuário,
+    e a resposta dos agentes de onboarding (que têm as `FLAGGED_TOOLS`, que
+    podem ser chamadas depois do texto) só é enviada no fim do stream, pela
+    fila de saída, se nenhuma delas foi chamada.
+
+    Desligado por padrão (`LETTA_STREAMING_ENABLED`): o stream roda dentro da
+    `send_message_task` e ocupa um worker do Celery durante toda a run, ao
+    contrário do `run_poller`. Ligue apenas com workers do Celery suficientes
+    para as runs simultâneas.
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv("LETTA_STREAMING_ENABLED", "false").lower() == "true"
+        self.stream_tokens = os.getenv("LETTA_STREAM_TOKENS", "true").lower() == "true"
+        self.min_chars = int(os.getenv("LETTA_STREAM_MIN_CHARS", "40"))
+        self.min_delta = int(os.getenv("LETTA_STREAM_MIN_DELTA", "20"))
+        self.edit_interval = float(os.getenv("LETTA_STREAM_EDIT_INTERVAL", "1.5"))
+        self.slow_after = float(os.getenv("LETTA_STREAM_SLOW_AFTER", "30"))
+        self.cursor = os.getenv("LETTA_STREAM_CURSOR", " …")
+
+    def stream_reply(self, agent_id: str, message: str, phone: str, role: Optional[str]) -> bool:
+        """
+        Envia a mensagem ao agente e entrega a resposta em streaming.
+        Retorna False somente se a conexão com o Letta não pôde ser aberta (a
+        mensagem certamente não chegou), para o chamador usar o polling. Outros
+        erros antes do primeiro evento (ex.: tempo esgotado) não são refeitos:
+        o Letta pode já estar processando a mensagem.
+        """
+        live = role not in ("onboarding", "background")
+        reply = StreamedReply(self, phone)
+        held: Dict[str, str] = {}
+        flagged = False
+        slow_notified = False
+        start_time = time.monotonic()
+
+        try:
+            chunks = letta_router.client_for_agent_sync(agent_id).agents.messages.create_stream(
+                agent_id=agent_id,
+                messages=[MessageCreate(role="user", content=message)],
+                stream_tokens=self.stream_tokens,
+            )
+            for chunk in chunks:
+                if isinstance(chunk, ToolCallMessage):
+                    flagged = flagged or is_flagged_tool(chunk.tool_call.name)
+                elif isinstance(chunk, AssistantMessage):
+                    text = text_of(chunk.content)
+                    if live:
+                        reply.update(chunk.id, text, delta=self.stream_tokens)
+                    else:
+                        held[chunk.id] = held.get(chunk.id, "") + text if self.stream_tokens else text
+
+                if (
+                    role != "background" and not slow_notified and not reply.delivered
+                    and time.monotonic() - start_time > self.slow_after
+                ):
+                    queued_wpp.send_message(phone, SLOW_MESSAGE)
+                    slow_notified = True
+        except httpx.ConnectError as e:
+            logging.warning(f"Streaming indisponível para o agente {agent_id}, usando o polling: {e}")
+            return False
+        except Exception as e:
+            logging.error(f"Stream do agente {agent_id} interrompido: {e}")
+            reply.finish()
+            if role != "background" and not reply.delivered:
+                queued_wpp.send_message(phone, ERROR_MESSAGE)
+            return True
+
+        reply.finish()
+        if role == "onboarding" and not flagged:
+            for text in held.values():
+                if text.strip():
+                    queued_wpp.send_message(phone, text.strip())
+        if not reply.delivered and not held:
+            logging.error(f"A resposta do agente {agent_id} não contém 'assistant_message'.")
+        return True
+
+
+reply_streamer = ReplyStreamer()
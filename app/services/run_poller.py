@@ -0,0 +1,300 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+from letta_client import MessageCreate, AssistantMessage
+
+from app.services.agent_directory import agent_directory
+from app.services.agent_mailbox import agent_mailbox
+from app.services.letta_router import letta_router
+from app.services.outbound_queue import CLAIM_SCRIPT, async_queued_wpp
+from app.services.reply_streamer import ERROR_MESSAGE, SLOW_MESSAGE, is_suppressed, text_of
+from app.utils.async_letta import get_async_letta
+from app.utils.celery_app import celery_app
+from app.utils.redis_connection import get_async_redis, get_sync_redis
+
+load_dotenv()
+
+# Status finais de uma run no Letta (os demais seguem em acompanhamento).
+FAILED_STATUSES = ("failed", "cancelled", "expired")
+
+# Task que envia as mensagens da caixa do agente (importar `app.utils.tasks` aqui seria circular).
+SEND_MESSAGE_TASK = "app.utils.tasks.send_message_task"
+
+
+class RunPoller:
+    """
+    Acompanha as runs assíncronas do Letta (`create_async`) até o fim e entrega a
+    resposta ao usuário, sem ocupar um worker do Celery por run.
+
+    Cada run pendente fica no zset `runs:pending`, com o horário da próxima
+    consulta, e seus dados em `runs:<run_id>`. O worker reserva as runs vencidas
+    em lote (como a fila de envio) e, a partir de `RUN_POLL_BATCH_THRESHOLD`
+    runs, consulta todas com uma única `list_active_runs`: só as que saíram da
+    lista de ativas são buscadas uma a uma. O intervalo entre consultas começa em
+    `RUN_POLL_MIN_INTERVAL` e cresce `RUN_POLL_BACKOFF` vezes a cada consulta até
+    `RUN_POLL_MAX_INTERVAL`, de modo que runs longas custam poucas consultas.
+    Cada run é consultada no servidor Letta do agente (`node`, gravado no
+    acompanhamento), e a listagem das ativas é feita por nó.
+
+    Uma run que falha é refeita com a mesma mensagem (nova run), até
+    `RUN_MAX_ATTEMPTS` tentativas; runs acompanhadas por mais de `RUN_MAX_AGE`
+    segundos são abandonadas com uma mensagem de erro.
+
+    Runs com a vez do agente (`lease` do `agent_mailbox`) a renovam a cada
+    consulta e a passam adiante no fim: as mensagens que chegaram durante a
+    run seguem, unidas, para uma nova `send_message_task` com a mesma vez.
+    """
+
+    PENDING_KEY = "runs:pending"
+
+    def __init__(self):
+        self.min_interval = float(os.getenv("RUN_POLL_MIN_INTERVAL", "0.5"))
+        self.max_interval = float(os.getenv("RUN_POLL_MAX_INTERVAL", "10"))
+        self.backoff = float(os.getenv("RUN_POLL_BACKOFF", "1.5"))
+        self.batch_threshold = int(os.getenv("RUN_POLL_BATCH_THRESHOLD", "5"))
+        self.claim_batch = int(os.getenv("RUN_POLL_CLAIM_BATCH", "200"))
+        self.claim_lease_ms = int(os.getenv("RUN_POLL_CLAIM_LEASE_MS", "30000"))
+        self.concurrency = int(os.getenv("RUN_POLL_CONCURRENCY", "20"))
+        self.slow_after = float(os.getenv("RUN_SLOW_NOTICE_AFTER", "30"))
+        self.max_age = float(os.getenv("RUN_MAX_AGE", "1800"))
+        self.max_attempts = int(os.getenv("RUN_MAX_ATTEMPTS", "4"))
+        self.counters = {"polled": 0, "batched": 0, "completed": 0, "retried": 0, "failed": 0, "expired": 0, "mailbox_runs": 0}
+
+    @staticmethod
+    def _run_key(run_id: str) -> str:
+        return f"runs:{run_id}"
+
+    def _mapping(self, agent_id: str, node: str, phone: str, message: str, attempt: int, lease: Optional[str]) -> dict:
+        return {
+            "agent_id": agent_id,
+            "node": node,
+            "phone": phone or "",
+            "message": message or "",
+            "attempt": attempt,
+            "lease": lease or "",
+            "polls": 0,
+            "notified": 0,
+            "created_at": time.time(),
+        }
+
+    def _delay(self, polls: int) -> float:
+        return min(self.max_interval, self.min_interval * self.backoff ** polls)
+
+    def track(self, run_id: str, agent_id: str, phone: str, message: str = "", attempt: int = 1, lease: str = None):
+        """
+        Passa a acompanhar a run (tasks do Celery). `message` é reenviada se a run falhar
+        e `lease` é a vez do agente no `agent_mailbox`, passada adiante no fim da run.
+        """
+        node = letta_router.node_for_agent_sync(agent_id)
+        with get_sync_redis().pipeline(transaction=False) as pipe:
+            pipe.hset(self._run_key(run_id), mapping=self._mapping(agent_id, node, phone, message, attempt, lease))
+            pipe.expire(self._run_key(run_id), int(self.max_age * 2))
+            pipe.zadd(self.PENDING_KEY, {run_id: (time.time() + self.min_interval) * 1000})
+            pipe.execute()
+
+    async def track_async(self, run_id: str, agent_id: str, phone: str, message: str = "", attempt: int = 1, lease: str = None):
+        node = await letta_router.node_for_agent(agent_id)
+        async with get_async_redis().pipeline(transaction=False) as pipe:
+            pipe.hset(self._run_key(run_id), mapping=self._mapping(agent_id, node, phone, message, attempt, lease))
+            pipe.expire(self._run_key(run_id), int(self.max_age * 2))
+            pipe.zadd(self.PENDING_KEY, {run_id: (time.time() + self.min_interval) * 1000})
+            await pipe.execute()
+        if lease:
+            await self._renew(agent_id, lease)
+
+    async def _renew(self, agent_id: str, lease: str):
+        if not await agent_mailbox.renew_async(agent_id, lease):
+            logging.warning(f"A vez do agente {agent_id} expirou durante a run (o agente pode ter outra run em andamento).")
+
+    async def claim(self) -> List[str]:
+        return await get_async_redis().eval(CLAIM_SCRIPT, 1, self.PENDING_KEY, self.claim_batch, self.claim_lease_ms)
+
+    async def _nodes(self, run_ids: List[str]) -> Dict[str, str]:
+        """
+        Servidor Letta de cada run (runs acompanhadas antes da divisão não têm o nó gravado).
+        """
+        async with get_async_redis().pipeline(transaction=False) as pipe:
+            for run_id in run_ids:
+                pipe.hmget(self._run_key(run_id), "node", "agent_id")
+            rows = await pipe.execute()
+        nodes = {}
+        for run_id, (node, agent_id) in zip(run_ids, rows):
+            if node not in letta_router.nodes:
+                node = await letta_router.node_for_agent(agent_id) if agent_id else letta_router.default_node
+            nodes[run_id] = node
+        return nodes
+
+    async def _statuses(self, run_ids: List[str], nodes: Dict[str, str], slots: asyncio.Semaphore) -> Dict[str, Optional[str]]:
+        """
+        Status de cada run (None se a consulta falhou). Com várias runs no mesmo
+        nó, uma listagem das ativas dele evita consultar as que ainda estão rodando.
+        """
+        statuses: Dict[str, Optional[str]] = {}
+        by_node: Dict[str, List[str]] = {}
+        for run_id in run_ids:
+            by_node.setdefault(nodes[run_id], []).append(run_id)
+
+        for node, node_run_ids in by_node.items():
+            if len(node_run_ids) < self.batch_threshold:
+                continue
+            try:
+                active = {run.id: run.status for run in await get_async_letta(node).runs.list_active_runs()}
+                batched = {run_id: active[run_id] for run_id in node_run_ids if run_id in active}
+                statuses.update(batched)
+                self.counters["batched"] += len(batched)
+            except Exception as e:
+                logging.warning(f"Erro ao listar as runs ativas do Letta no nó {node}: {e}")
+
+        async def retrieve(run_id: str):
+            async with slots:
+                try:
+                    statuses[run_id] = (await get_async_letta(nodes[run_id]).runs.retrieve_run(run_id)).status
+                except Exception as e:
+                    logging.warning(f"Erro ao consultar a run {run_id}: {e}")
+                    statuses[run_id] = None
+
+        await asyncio.gather(*(retrieve(run_id) for run_id in run_ids if run_id not in statuses))
+        self.counters["polled"] += len(run_ids)
+        return statuses
+
+    async def poll_once(self) -> int:
+        """
+        Consulta as runs vencidas e trata as que terminaram. Retorna quantas foram reservadas.
+        """
+        run_ids = await self.claim()
+        if not run_ids:
+            return 0
+
+        slots = asyncio.Semaphore(self.concurrency)
+        nodes = await self._nodes(run_ids)
+        statuses = await self._statuses(run_ids, nodes, slots)
+
+        async def handle(run_id: str):
+            async with slots:
+                try:
+                    await self._handle(run_id, statuses.get(run_id), nodes[run_id])
+                except Exception as e:
+                    logging.error(f"Erro ao tratar a run {run_id}: {e}")
+
+        await asyncio.gather(*(handle(run_id) for run_id in run_ids))
+        return len(run_ids)
+
+    async def _handle(self, run_id: str, status: Optional[str], node: str):
+        redis = get_async_redis()
+        data = await redis.hgetall(self._run_key(run_id))
+        if not data or not data.get("phone"):
+            logging.error(f"Telefone do usuário não encontrado para run_id {run_id}.")
+            await self._forget(run_id)
+            await self._pass_turn(data or {})
+            return
+
+        if status == "completed":
+            await self._complete(run_id, data, node)
+        elif status in FAILED_STATUSES:
+            await self._fail(run_id, data)
+        else:
+            await self._reschedule(run_id, data)
+
+    async def _forget(self, run_id: str):
+        async with get_async_redis().pipeline(transaction=False) as pipe:
+            pipe.zrem(self.PENDING_KEY, run_id)
+            pipe.delete(self._run_key(run_id))
+            await pipe.execute()
+
+    async def _reschedule(self, run_id: str, data: dict):
+        phone = data["phone"]
+        elapsed = time.time() - float(data["created_at"])
+        if elapsed > self.max_age:
+            self.counters["expired"] += 1
+            logging.error(f"Run {run_id} do agente {data['agent_id']} abandonada após {int(elapsed)} s.")
+            await async_queued_wpp.send_message(phone, ERROR_MESSAGE)
+            await self._forget(run_id)
+            await self._pass_turn(data)
+            return
+
+        redis = get_async_redis()
+        if elapsed > self.slow_after and data.get("notified") != "1":
+            await async_queued_wpp.send_message(phone, SLOW_MESSAGE)
+            await redis.hset(self._run_key(run_id), "notified", 1)
+
+        polls = await redis.hincrby(self._run_key(run_id), "polls", 1)
+        await redis.zadd(self.PENDING_KEY, {run_id: (time.time() + self._delay(polls)) * 1000}, xx=True)
+        if data.get("lease"):
+            await self._renew(data["agent_id"], data["lease"])
+
+    async def _complete(self, run_id: str, data: dict, node: str):
+        agent_id, phone = data["agent_id"], data["phone"]
+        messages = await get_async_letta(node).runs.list_run_messages(run_id)
+        assistant_message = next((text_of(msg.content) for msg in messages if isinstance(msg, AssistantMessage)), None)
+        role = (await agent_directory.agent_info_async(agent_id)).get("role")
+
+        if assistant_message:
+            if not is_suppressed(messages, role):
+                await async_queued_wpp.send_message(phone, assistant_message)
+        else:
+            logging.error(f"A resposta do agente {agent_id} não contém 'assistant_message'. Estrutura: {messages}")
+
+        self.counters["completed"] += 1
+        await self._forget(run_id)
+        await self._pass_turn(data)
+
+    async def _fail(self, run_id: str, data: dict):
+        """
+        Refaz a run com a mesma mensagem (uma run que falhou não volta a rodar).
+        """
+        agent_id, phone, message = data["agent_id"], data["phone"], data.get("message")
+        attempt = int(data.get("attempt") or 1)
+        await self._forget(run_id)
+
+        if attempt < self.max_attempts and message:
+            await async_queued_wpp.send_message(
+                phone,
+                f"A execução falhou. Tentando novamente (tentativa {attempt + 1}/{self.max_attempts})."
+            )
+            try:
+                letta = await letta_router.client_for_agent(agent_id)
+                response = await letta.agents.messages.create_async(
+                    agent_id=agent_id,
+                    messages=[MessageCreate(role="user", content=message)],
+                )
+                await self.track_async(response.id, agent_id, phone, message, attempt + 1, lease=data.get("lease"))
+                self.counters["retried"] += 1
+                return
+            except Exception as e:
+                logging.error(f"Erro ao reenviar a mensagem ao agente {agent_id}: {e}")
+
+        self.counters["failed"] += 1
+        logging.error(f"Execução final falhou para o agente {agent_id} após {attempt} tentativas.")
+        await async_queued_wpp.send_message(phone, ERROR_MESSAGE)
+        await self._pass_turn(data)
+
+    async def _pass_turn(self, data: dict):
+        """
+        Fim da run com a vez do agente: passa as mensagens que aguardavam na caixa
+        (unidas, com a mesma vez) para uma nova task, que as envia e refaz o envio
+        se falhar, ou libera o agente.
+        """
+        agent_id, lease = data.get("agent_id"), data.get("lease")
+        if not agent_id or not lease:
+            return
+        message = await agent_mailbox.complete_async(agent_id, lease)
+        if message:
+            await asyncio.to_thread(celery_app.send_task, SEND_MESSAGE_TASK, args=[agent_id, message], kwargs={"lease": lease})
+            self.counters["mailbox_runs"] += 1
+
+    async def stats(self) -> dict:
+        redis = get_async_redis()
+        now_ms = time.time() * 1000
+        return {
+            **self.counters,
+            "pending": await redis.zcard(self.PENDING_KEY),
+            "due": await redis.zcount(self.PENDING_KEY, "-inf", now_ms),
+            "pid": os.getpid(),
+        }
+
+
+run_poller = RunPoller()
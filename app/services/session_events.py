@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import logging
+from typing import Optional
+
+from dotenv import load_dotenv
+
+from app.utils.redis_connection import get_async_redis
+
+load_dotenv()
+
+# Eventos do ciclo de vida da sessão repassados pelo webhook do WPPConnect.
+SESSION_EVENTS = {"qrcode", "status-find"}
+# Status do `status-find` que indicam a sessão conectada ou a conexão perdida.
+CONNECTED_STATUSES = {"isLogged", "qrReadSuccess", "inChat", "successChat", "chatsAvailable"}
+FAILED_STATUSES = {"qrReadFail", "autocloseCalled", "browserClose", "desconnectedMobile", "deleteToken", "serverClose"}
+
+
+class SessionSubscription:
+    """
+    Inscrição no canal de eventos de uma sessão. Criada por `SessionEventBus.subscribe`.
+
+    Ao entrar no contexto, a inscrição é feita antes de qualquer leitura, então
+    chamadas feitas dentro do bloco (ex.: `start-session`) não perdem eventos.
+    O último QR Code e o último status gravados depois de `since` são entregues
+    primeiro, cobrindo os eventos que chegaram antes da inscrição.
+    """
+
+    def __init__(self, bus: "SessionEventBus", session: str, since: Optional[float] = None):
+        self.bus = bus
+        self.session = session
+        self.since = since
+        self._pubsub = None
+        self._backlog = []
+
+    async def __aenter__(self) -> "SessionSubscription":
+        redis = get_async_redis()
+        self._pubsub = redis.pubsub()
+        await self._pubsub.subscribe(self.bus.channel(self.session))
+        if self.since is not None:
+            self._backlog = await self.bus.latest_events(self.session, self.since)
+        return self
+
+    async def __aexit__(self, *exc):
+        try:
+            await self._pubsub.unsubscribe()
+        finally:
+            await self._pubsub.aclose()
+
+    async def next(self, timeout: float) -> Optional[dict]:
+        """
+        Próximo evento da sessão, ou None se nada chegar em `timeout` segundos.
+        """
+        if self._backlog:
+            return self._backlog.pop(0)
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining)
+            if message and message.get("type") == "message":
+                return json.loads(message["data"])
+
+    async def wait_for(self, events: set, timeout: float) -> Optional[dict]:
+        """
+        Aguarda o primeiro evento cujo `event` esteja em `events`.
+        """
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            event = await self.next(remaining)
+            if event and event.get("event") in events:
+                return event
+        return None
+
+
+class SessionEventBus:
+    """
+    Eventos `qrcode` e `status-find` do WPPConnect publicados no Redis pub/sub
+    (`wpp:events:<sessão>`), para os flows aguardarem o QR Code e a conexão sem
+    consultar o WPPConnect em loop.
+
+    O último QR Code e o último status de cada sessão também ficam no hash
+    `wpp:session:<sessão>` (TTL `WPP_SESSION_EVENT_TTL`), para quem se inscreve
+    depois do evento.
+    """
+
+    def __init__(self):
+        self.ttl = int(os.getenv("WPP_SESSION_EVENT_TTL", "600"))
+        self.counters = {"qrcode": 0, "status-find": 0}
+
+    @staticmethod
+    def channel(session: str) -> str:
+        return f"wpp:events:{session}"
+
+    @staticmethod
+    def state_key(session: str) -> str:
+        return f"wpp:session:{session}"
+
+    async def publish(self, payload: dict) -> int:
+        """
+        Grava e publica o evento. Retorna quantos inscritos o receberam.
+        """
+        event, session = payload.get("event"), payload.get("session")
+        if event not in SESSION_EVENTS or not session:
+            return 0
+
+        now = time.time()
+        if event == "qrcode":
+            message = {"event": event, "session": session, "qrcode": payload.get("qrcode"), "urlcode": payload.get("urlcode"), "at": now}
+            mapping = {"qrcode": payload.get("qrcode") or "", "urlcode": payload.get("urlcode") or "", "qrcode_at": now}
+        else:
+            message = {"event": event, "session": session, "status": payload.get("status"), "at": now}
+            mapping = {"status": payload.get("status") or "", "status_at": now}
+            if payload.get("status") in CONNECTED_STATUSES:
+                # QR Code lido: o último não vale mais.
+                mapping["qrcode"] = ""
+
+        redis = get_async_redis()
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.hset(self.state_key(session), mapping=mapping)
+            pipe.expire(self.state_key(session), self.ttl)
+            pipe.publish(self.channel(session), json.dumps(message))
+            *_, receivers = await pipe.execute()
+        self.counters[event] += 1
+        return receivers
+
+    async def latest_events(self, session: str, since: float) -> list:
+        """
+        Último QR Code e último status da sessão gravados depois de `since`, em ordem.
+        """
+        state = await get_async_redis().hgetall(self.state_key(session))
+        events = []
+        if state.get("qrcode") and float(state.get("qrcode_at", 0)) >= since:
+            events.append({"event": "qrcode", "session": session, "qrcode": state["qrcode"], "urlcode": state.get("urlcode"), "at": float(state["qrcode_at"])})
+        if state.get("status") and float(state.get("status_at", 0)) >= since:
+            events.append({"event": "status-find", "session": session, "status": state["status"], "at": float(state["status_at"])})
+        return sorted(events, key=lambda event: event["at"])
+
+    def subscribe(self, session: str, since: Optional[float] = None) -> SessionSubscription:
+        return SessionSubscription(self, session, since)
+
+    def stats(self) -> dict:
+        return {**self.counters, "pid": os.getpid()}
+
+
+session_events = SessionEventBus()
+
+
+async def publish_session_event(payload: dict):
+    """
+    Publica o evento de sessão recebido pelo webhook. Falhas não interrompem o webhook.
+    """
+    try:
+        await session_events.publish(payload)
+    except Exception as e:
+        logging.error(f"Erro ao publicar o evento {payload.get('event')} da sessão {payload.get('session')}: {e}")
@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from app.services.letta_service import get_onboarding_agent_id_async, notify_agents
+from app.services.user_service import UserRepository
+from app.services.whatsapp_service import AsyncWhatsAppService
+from app.utils.redis_connection import get_async_redis
+
+load_dotenv()
+
+HEALTHY, DEGRADED, DEAD = "healthy", "degraded", "dead"
+DISCONNECTED_MESSAGE = "SYSTEM MESSAGE: A integração com o WhatsApp do usuário falhou, pergunte-o se ele deseja integrar novamente."
+
+
+@dataclass
+class SessionHealth:
+    session: str
+    user_id: str
+    phone: str
+    status: str
+    failures: int
+    checked_at: float
+    detail: Optional[str] = None
+    errored: bool = False
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self))
+
+
+class SessionHealthMonitor:
+    """
+    Verifica periodicamente as sessões pessoais do WhatsApp (`whatsapp_integration=True`).
+
+    A cada `SESSION_HEALTH_INTERVAL` segundos, as verificações são espalhadas
+    pelos primeiros `SESSION_HEALTH_SPREAD` segundos do ciclo (escalonadas) e
+    rodam com no máximo `SESSION_HEALTH_CONCURRENCY` ao mesmo tempo. Uma sessão
+    conectada é "healthy"; desconectada (status explícito do WPPConnect), fica
+    "degraded" e, depois de `SESSION_HEALTH_DEAD_AFTER` verificações seguidas,
+    "dead". Erros na verificação (tempo esgotado, erro HTTP ou de rede) deixam a
+    sessão "degraded" sem avançar a contagem.
+
+    Ao fim do ciclo, as sessões que morreram têm a integração desligada em um
+    único UPDATE e os agentes de onboarding são avisados em lotes. Se pelo menos
+    `SESSION_HEALTH_BREAKER_RATIO` das verificações do ciclo falharam (ex.:
+    WPPConnect fora do ar), nenhuma sessão é desligada no ciclo: as que
+    morreriam ficam "degraded" e são reavaliadas no próximo. O estado de
+    cada sessão fica no hash `wpp:health`; um lock no Redis garante um ciclo por vez.
+    """
+
+    STATE_KEY = "wpp:health"
+    LOCK_KEY = "wpp:health:lock"
+
+    def __init__(self):
+        self.interval = float(os.getenv("SESSION_HEALTH_INTERVAL", "300"))
+        self.spread = float(os.getenv("SESSION_HEALTH_SPREAD", "60"))
+        self.concurrency = int(os.getenv("SESSION_HEALTH_CONCURRENCY", "10"))
+        self.timeout = float(os.getenv("SESSION_HEALTH_TIMEOUT", "10"))
+        self.dead_after = int(os.getenv("SESSION_HEALTH_DEAD_AFTER", "2"))
+        self.notify_batch = int(os.getenv("SESSION_HEALTH_NOTIFY_BATCH", "20"))
+        self.breaker_ratio = float(os.getenv("SESSION_HEALTH_BREAKER_RATIO", "0.5"))
+        self.counters = {"cycles": 0, "checked": 0, "errors": 0, "marked_dead": 0, "notified": 0, "breaker_trips": 0}
+
+    async def _check(self, user, previous: Optional[SessionHealth]) -> SessionHealth:
+        client = AsyncWhatsAppService(session_name=user.id_session_wpp, token=user.token_wpp)
+        # Uma sessão que já estava morta e voltou a ser integrada recomeça a contagem.
+        base = previous.failures if previous and previous.status != DEAD else 0
+        try:
+            response = await asyncio.wait_for(client.status_session(), timeout=self.timeout)
+        except Exception as e:
+            return SessionHealth(
+                session=user.id_session_wpp,
+                user_id=user.id,
+                phone=user.phone,
+                status=DEGRADED,
+                failures=base,
+                checked_at=time.time(),
+                detail=f"erro: {e}",
+                errored=True,
+            )
+
+        connected = response.get("message") == "Connected"
+        detail = response.get("message")
+        failures = 0 if connected else base + 1
+        status = HEALTHY if connected else DEAD if failures >= self.dead_after else DEGRADED
+        return SessionHealth(
+            session=user.id_session_wpp,
+            user_id=user.id,
+            phone=user.phone,
+            status=status,
+            failures=failures,
+            checked_at=time.time(),
+            detail=detail,
+        )
+
+    async def run_cycle(self) -> Dict[str, int]:
+        """
+        Verifica todas as sessões integradas. Retorna a contagem por status.
+        """
+        users = await UserRepository().get_whatsapp_integrated_users()
+        redis = get_async_redis()
+        previous = await self.states()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        step = min(self.spread, self.interval) / len(users) if users else 0
+
+        async def check(index: int, user) -> SessionHealth:
+            await asyncio.sleep(index * step)
+            async with semaphore:
+                return await self._check(user, previous.get(user.id_session_wpp))
+
+        results: List[SessionHealth] = await asyncio.gather(*(check(i, user) for i, user in enumerate(users)))
+        errored = sum(result.errored for result in results)
+        tripped = bool(results) and errored / len(results) >= self.breaker_ratio
+        if tripped:
+            # Falha geral das verificações: não dá para distinguir sessão caída de servidor fora do ar.
+            self.counters["breaker_trips"] += 1
+            logging.error(f"{errored} de {len(results)} verificações de sessão falharam; nenhuma sessão será desligada neste ciclo.")
+            for result in results:
+                if result.status == DEAD:
+                    result.status = DEGRADED
+        if results:
+            await redis.hset(self.STATE_KEY, mapping={result.session: result.to_json() for result in results})
+        self.counters["cycles"] += 1
+        self.counters["checked"] += len(results)
+        self.counters["errors"] += errored
+
+        dead = [result for result in results if result.status == DEAD]
+        if dead:
+            await self._disconnect(dead)
+
+        counts = {HEALTHY: 0, DEGRADED: 0, DEAD: 0}
+        for result in results:
+            counts[result.status] += 1
+        return counts
+
+    async def _disconnect(self, dead: List[SessionHealth]):
+        updated = await UserRepository().set_whatsapp_integration_bulk([result.user_id for result in dead], False)
+        self.counters["marked_dead"] += updated
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def agent_of(phone: str) -> Optional[str]:
+            async with semaphore:
+                return await get_onboarding_agent_id_async(phone)
+
+        agent_ids = [agent_id for agent_id in await asyncio.gather(*(agent_of(result.phone) for result in dead)) if agent_id]
+        notify_agents(agent_ids, DISCONNECTED_MESSAGE, self.notify_batch)
+        self.counters["notified"] += len(agent_ids)
+        logging.warning(f"{updated} sessões do WhatsApp desconectadas; {len(agent_ids)} agentes avisados.")
+
+    async def mark(self, session: str, user_id: str, phone: str, status: str, detail: Optional[str] = None):
+        """
+        Registra o status de uma sessão informado por um evento (ex.: `desconnectedMobile`).
+        """
+        health = SessionHealth(
+            session=session,
+            user_id=user_id,
+            phone=phone,
+            status=status,
+            failures=self.dead_after if status == DEAD else 0,
+            checked_at=time.time(),
+            detail=detail,
+        )
+        await get_async_redis().hset(self.STATE_KEY, session, health.to_json())
+
+    async def states(self) -> Dict[str, SessionHealth]:
+        raw = await get_async_redis().hgetall(self.STATE_KEY)
+        return {session: SessionHealth(**json.loads(data)) for session, data in raw.items()}
+
+    async def summary(self) -> dict:
+        """
+        Sessões agrupadas em healthy, degraded e dead, com a última verificação de cada uma.
+        """
+        groups = {HEALTHY: [], DEGRADED: [], DEAD: []}
+        for health in sorted((await self.states()).values(), key=lambda item: item.session):
+            groups.setdefault(health.status, []).append(asdict(health))
+        return {
+            "counts": {status: len(items) for status, items in groups.items()},
+            **groups,
+            "counters": self.counters,
+        }
+
+    async def acquire_cycle(self) -> bool:
+        """
+        Reserva o ciclo atual para este processo (o lock expira com o intervalo).
+        """
+        return bool(await get_async_redis().set(self.LOCK_KEY, os.getpid(), nx=True, px=int(self.interval * 1000)))
+
+
+session_health = SessionHealthMonitor()
+
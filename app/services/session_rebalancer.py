@@ -0,0 +1,94 @@
+import os
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Optional
+
+from dotenv import load_dotenv
+
+from app.services.session_router import session_router
+from app.services.user_service import UserRepository
+from app.services.whatsapp_service import AsyncWhatsAppService
+
+load_dotenv()
+
+REBALANCE_CONCURRENCY = int(os.getenv("WPP_REBALANCE_CONCURRENCY", "5"))
+
+
+async def move_session(user, source: Optional[str], target: str) -> bool:
+    """
+    Fecha a sessão no servidor antigo e a inicia no novo. Com o token store do
+    WPPConnect compartilhado entre os nós, a sessão é restaurada sem novo QR Code;
+    caso contrário, o monitor de sessões a marca como desconectada.
+
+    A atribuição só muda se a sessão iniciou no destino; se não iniciou, ela é
+    reaberta no servidor antigo. Retorna se a sessão foi movida.
+    """
+    if source in session_router.nodes:
+        try:
+            await AsyncWhatsAppService(user.id_session_wpp, token=user.token_wpp, base_url=session_router.url(source)).close_session()
+        except Exception as e:
+            logging.warning(f"Erro ao fechar a sessão {user.id_session_wpp} em {source}: {e}")
+
+    try:
+        await AsyncWhatsAppService(user.id_session_wpp, token=user.token_wpp, base_url=session_router.url(target)).start_session()
+    except Exception as e:
+        logging.error(f"Erro ao iniciar a sessão {user.id_session_wpp} em {target}; ela continua em {source}: {e}")
+        if source in session_router.nodes:
+            try:
+                await AsyncWhatsAppService(user.id_session_wpp, token=user.token_wpp, base_url=session_router.url(source)).start_session()
+            except Exception as e:
+                logging.warning(f"Erro ao reabrir a sessão {user.id_session_wpp} em {source}: {e}")
+        return False
+
+    await session_router.assign(user.id_session_wpp, target)
+    return True
+
+
+async def rebalance(node: Optional[str] = None, dry_run: bool = False) -> dict:
+    """
+    Move para o nó do anel as sessões atribuídas a outro nó (nós em drenagem,
+    removidos ou recém-adicionados). Com `node`, só as sessões que saem dele ou
+    vão para ele. `dry_run` só lista as mudanças.
+    """
+    users = await UserRepository().get_users_with_wpp_session()
+    draining = await session_router.draining()
+    moves = []
+    for user in users:
+        current = user.wpp_node or await session_router.node_for(user.id_session_wpp)
+        target = session_router.target_for(user.id_session_wpp, draining)
+        if target and current != target and (node is None or node in (current, target)):
+            moves.append((user, current, target))
+
+    plan = [{"session": user.id_session_wpp, "from": source, "to": target} for user, source, target in moves]
+    if dry_run or not moves:
+        return {"moved": 0, "sessions": len(users), "moves": plan}
+
+    semaphore = asyncio.Semaphore(REBALANCE_CONCURRENCY)
+
+    async def move(user, source, target) -> bool:
+        async with semaphore:
+            return await move_session(user, source, target)
+
+    results = await asyncio.gather(*(move(*item) for item in moves))
+
+    by_target = defaultdict(list)
+    failed = []
+    for (user, source, target), moved in zip(moves, results):
+        if moved:
+            by_target[target].append(user.id)
+        else:
+            failed.append({"session": user.id_session_wpp, "from": source, "to": target})
+    for target, user_ids in by_target.items():
+        await UserRepository().set_wpp_node_bulk(user_ids, target)
+
+    moved = len(moves) - len(failed)
+    logging.info(f"{moved} sessões do WhatsApp rebalanceadas; {len(failed)} falharam.")
+    return {"moved": moved, "sessions": len(users), "moves": plan, "failed": failed}
+
+
+async def warm_assignments() -> int:
+    """
+    Recarrega no Redis as atribuições gravadas nos usuários (inicialização).
+    """
+    return await session_router.warm(await UserRepository().get_users_with_wpp_session())
@@ -0,0 +1,233 @@
+import os
+import time
+import logging
+from typing import Dict, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+from app.utils.hash_ring import HashRing
+from app.utils.redis_connection import get_async_redis, get_sync_redis
+
+load_dotenv()
+
+
+def parse_nodes(spec: Optional[str], default_url: Optional[str]) -> Dict[str, str]:
+    """
+    Lê `WHATSAPP_SERVER_NODES` ("nome=url,nome=url" ou só as URLs). Sem a variável,
+    o único nó é "default", em `WHATSAPP_SERVER_BASE_URL`.
+    """
+    nodes = {}
+    for item in (spec or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, url = item.partition("=") if "=" in item else (item, "", item)
+        nodes[name.strip()] = url.strip().rstrip("/")
+    if not nodes and default_url:
+        nodes["default"] = default_url.rstrip("/")
+    return nodes
+
+
+class SessionRouter:
+    """
+    Distribui as sessões do WhatsApp entre os servidores WPPConnect de
+    `WHATSAPP_SERVER_NODES` com hash consistente.
+
+    A atribuição de cada sessão fica no hash `wpp:nodes:assignments` (a primeira
+    é gravada com HSETNX, então todos os processos concordam) e na coluna
+    `users.wpp_node`; uma vez atribuída, a sessão só muda de nó pelo
+    rebalanceamento. Nós em `wpp:nodes:draining` não recebem sessões novas.
+    Se todos os nós estiverem em drenagem, as sessões novas usam o anel completo.
+    A sessão "principal" fica em `WHATSAPP_PRINCIPAL_NODE` (padrão: o primeiro nó).
+
+    As consultas ficam em cache no processo por `WPP_NODE_CACHE_TTL` segundos.
+    Cada mudança de atribuição ou de drenagem incrementa `wpp:nodes:version`; os
+    processos conferem a versão a cada `WPP_NODE_VERSION_CHECK_SECONDS` e
+    descartam o cache quando ela muda.
+    """
+
+    ASSIGNMENTS_KEY = "wpp:nodes:assignments"
+    DRAINING_KEY = "wpp:nodes:draining"
+    VERSION_KEY = "wpp:nodes:version"
+
+    def __init__(self):
+        self.nodes = parse_nodes(os.getenv("WHATSAPP_SERVER_NODES"), os.getenv("WHATSAPP_SERVER_BASE_URL"))
+        self.principal_node = os.getenv("WHATSAPP_PRINCIPAL_NODE") or next(iter(self.nodes), None)
+        self.cache_ttl = float(os.getenv("WPP_NODE_CACHE_TTL", "30"))
+        self.ring = HashRing(self.nodes, vnodes=int(os.getenv("WPP_NODE_VNODES", "160")))
+        self._cache: Dict[str, Tuple[str, float]] = {}
+        self._draining: Tuple[Set[str], float] = (set(), 0.0)
+        self.version_check = float(os.getenv("WPP_NODE_VERSION_CHECK_SECONDS", "1"))
+        self._version: Tuple[Optional[str], float] = (None, 0.0)
+
+    def url(self, node: str) -> str:
+        return self.nodes[node]
+
+    def target_for(self, session: str, draining: Set[str]) -> Optional[str]:
+        """
+        Nó do anel para a sessão, ignorando os nós em drenagem.
+        """
+        if session == "principal":
+            return self.principal_node
+        return self.ring.node_for(session, exclude=draining)
+
+    def _initial_target(self, session: str, draining: Set[str]) -> str:
+        """
+        Nó da primeira atribuição. Com todos os nós em drenagem, usa o anel completo.
+        """
+        target = self.target_for(session, draining)
+        if target is None:
+            target = self.target_for(session, set())
+            if target is None:
+                raise ValueError("Nenhum servidor WPPConnect configurado (WHATSAPP_SERVER_NODES).")
+            logging.warning(f"Todos os servidores WPPConnect estão em drenagem; sessão {session} atribuída a {target}.")
+        return target
+
+    def _version_due(self) -> bool:
+        return self._version[1] <= time.monotonic()
+
+    def _apply_version(self, version: Optional[str]):
+        if version != self._version[0]:
+            self.forget()
+        self._version = (version, time.monotonic() + self.version_check)
+
+    def _cached(self, session: str) -> Optional[str]:
+        if session == "principal":
+            return self.principal_node
+        cached = self._cache.get(session)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        return None
+
+    def _remember(self, session: str, node: str) -> str:
+        self._cache[session] = (node, time.monotonic() + self.cache_ttl)
+        return node
+
+    def forget(self, session: str = None):
+        """
+        Descarta o cache do processo (de uma sessão ou de todas).
+        """
+        if session is None:
+            self._cache.clear()
+            self._draining = (set(), 0.0)
+        else:
+            self._cache.pop(session, None)
+
+    # Versão assíncrona
+
+    async def _check_version(self):
+        if self._version_due():
+            self._apply_version(await get_async_redis().get(self.VERSION_KEY))
+
+    async def _bump_version(self):
+        self._apply_version(str(await get_async_redis().incr(self.VERSION_KEY)))
+
+    async def draining(self) -> Set[str]:
+        await self._check_version()
+        nodes, expires_at = self._draining
+        if expires_at <= time.monotonic():
+            nodes = set(await get_async_redis().smembers(self.DRAINING_KEY))
+            self._draining = (nodes, time.monotonic() + self.cache_ttl)
+        return nodes
+
+    async def node_for(self, session: str) -> str:
+        """
+        Nó da sessão; na primeira consulta, atribui o nó do anel.
+        """
+        await self._check_version()
+        node = self._cached(session)
+        if node:
+            return node
+        redis = get_async_redis()
+        node = await redis.hget(self.ASSIGNMENTS_KEY, session)
+        if node not in self.nodes:
+            target = self._initial_target(session, await self.draining())
+            if node:
+                # Nó removido da configuração: a sessão vai para o nó do anel.
+                await redis.hset(self.ASSIGNMENTS_KEY, session, target)
+            elif not await redis.hsetnx(self.ASSIGNMENTS_KEY, session, target):
+                target = await redis.hget(self.ASSIGNMENTS_KEY, session)
+            node = target
+        return self._remember(session, node)
+
+    async def url_for(self, session: str) -> str:
+        return self.url(await self.node_for(session))
+
+    async def assign(self, session: str, node: str):
+        """
+        Grava a atribuição da sessão (rebalanceamento) e invalida o cache dos
+        demais processos, que passam a usar o nó novo em até `version_check` segundos.
+        """
+        await get_async_redis().hset(self.ASSIGNMENTS_KEY, session, node)
+        await self._bump_version()
+        self._remember(session, node)
+
+    async def drain(self, node: str):
+        if node not in self.nodes:
+            raise ValueError(f"Nó {node} não configurado.")
+        await get_async_redis().sadd(self.DRAINING_KEY, node)
+        await self._bump_version()
+
+    async def undrain(self, node: str):
+        if node not in self.nodes:
+            raise ValueError(f"Nó {node} não configurado.")
+        await get_async_redis().srem(self.DRAINING_KEY, node)
+        await self._bump_version()
+
+    async def warm(self, users) -> int:
+        """
+        Copia para o Redis as atribuições gravadas nos usuários que ainda não estão lá
+        (ex.: depois de limpar o Redis). Retorna quantas foram copiadas.
+        """
+        mapping = {user.id_session_wpp: user.wpp_node for user in users if user.id_session_wpp and user.wpp_node in self.nodes}
+        if not mapping:
+            return 0
+        redis = get_async_redis()
+        async with redis.pipeline(transaction=False) as pipe:
+            for session, node in mapping.items():
+                pipe.hsetnx(self.ASSIGNMENTS_KEY, session, node)
+            return sum(await pipe.execute())
+
+    async def stats(self) -> dict:
+        redis = get_async_redis()
+        assignments = await redis.hgetall(self.ASSIGNMENTS_KEY)
+        draining = set(await redis.smembers(self.DRAINING_KEY))
+        sessions = {node: 0 for node in self.nodes}
+        for node in assignments.values():
+            sessions[node] = sessions.get(node, 0) + 1
+        return {
+            "nodes": [
+                {"node": node, "url": self.nodes.get(node), "sessions": count, "draining": node in draining, "configured": node in self.nodes}
+                for node, count in sessions.items()
+            ],
+            "principal_node": self.principal_node,
+        }
+
+    # Versão síncrona (tasks do Celery)
+
+    def node_for_sync(self, session: str) -> str:
+        redis = get_sync_redis()
+        if self._version_due():
+            self._apply_version(redis.get(self.VERSION_KEY))
+        node = self._cached(session)
+        if node:
+            return node
+        node = redis.hget(self.ASSIGNMENTS_KEY, session)
+        if node not in self.nodes:
+            nodes, expires_at = self._draining
+            if expires_at <= time.monotonic():
+                nodes = set(redis.smembers(self.DRAINING_KEY))
+                self._draining = (nodes, time.monotonic() + self.cache_ttl)
+            target = self._initial_target(session, nodes)
+            if node:
+                redis.hset(self.ASSIGNMENTS_KEY, session, target)
+            elif not redis.hsetnx(self.ASSIGNMENTS_KEY, session, target):
+                target = redis.hget(self.ASSIGNMENTS_KEY, session)
+            node = target
+        return self._remember(session, node)
+
+    def url_for_sync(self, session: str) -> str:
+        return self.url(self.node_for_sync(session))
+
+
+session_router = SessionRouter()
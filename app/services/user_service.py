@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy.exc import IntegrityError
@@ -210,3 +210,78 @@ class UserRepository:
             except IntegrityError as e:
                 await db.rollback()
                 raise ValueError(f"Erro ao atualizar tokens: {e.orig}")
+
+    async def get_whatsapp_integrated_users(self):
+        """
+        Lista os usuários com a integração do WhatsApp ativa e sessão definida.
+        """
+        async with async_session() as db:
+            query = select(User).where(User.whatsapp_integration == True, User.id_session_wpp.isnot(None))
+            result = await db.execute(query)
+            return result.scalars().all()
+
+    async def set_whatsapp_integration_bulk(self, user_ids: List[str], value: bool) -> int:
+        """
+        Atualiza o `whatsapp_integration` de vários usuários em um único UPDATE.
+        Retorna a quantidade de usuários atualizados.
+        """
+        if not user_ids:
+            return 0
+        async with async_session() as db:
+            query = update(User).where(User.id.in_(user_ids)).values(whatsapp_integration=value)
+            result = await db.execute(query)
+            await db.commit()
+            return result.rowcount
+
+    async def get_users_with_wpp_session(self):
+        """
+        Lista os usuários com sessão pessoal do WhatsApp definida.
+        """
+        async with async_session() as db:
+            query = select(User).where(User.id_session_wpp.isnot(None))
+            result = await db.execute(query)
+            return result.scalars().all()
+
+    async def get_users_with_agents(self):
+        """
+        Lista os usuários com algum agente definido.
+        """
+        async with async_session() as db:
+            query = select(User).where(
+                User.id_main_agent.isnot(None) | User.id_onboarding_agent.isnot(None) | User.id_background_agent.isnot(None)
+            )
+            result = await db.execute(query)
+            return result.scalars().all()
+
+    async def set_wpp_node_bulk(self, user_ids: List[str], node: str) -> int:
+        """
+        Define o servidor WPPConnect de vários usuários em um único UPDATE.
+        """
+        if not user_ids:
+            return 0
+        async with async_session() as db:
+            query = update(User).where(User.id.in_(user_ids)).values(wpp_node=node)
+            result = await db.execute(query)
+            await db.commit()
+            return result.rowcount
+
+    async def get_users_by_phones(self, phones: List[str]):
+        """
+        Lista os usuários com os telefones informados.
+        """
+        if not phones:
+            return []
+        async with async_session() as db:
+            query = select(User).where(User.phone.in_(phones))
+            result = await db.execute(query)
+            return result.scalars().all()
+
+    async def set_wpp_token_by_session(self, session: str, token: str) -> int:
+        """
+        Atualiza o `token_wpp` do usuário dono da sessão do WhatsApp.
+        """
+        async with async_session() as db:
+            query = update(User).where(User.id_session_wpp == session).values(token_wpp=token)
+            result = await db.execute(query)
+            await db.commit()
+            return result.rowcount
@@ -0,0 +1,137 @@
+import os
+import math
+import time
+import hashlib
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+from app.utils.redis_connection import get_async_redis
+
+load_dotenv()
+
+
+class BloomFilter:
+    """
+    Bloom filter simples em memória (bytearray + double hashing com blake2b).
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class WebhookDeduplicator:
+    """
+    Descarta eventos reentregues pelo WPPConnect (timeouts e reconexões).
+
+    A chave do evento é o ID da mensagem (onmessage) ou sessão + status
+    (status-find). Um bloom filter em memória responde, sem ida ao Redis, pelos IDs
+    já processados neste processo; os demais passam por um `SET NX` com TTL no
+    Redis, que vale entre processos. O ID só entra no bloom filter depois que o
+    evento foi processado (`complete`), e `release` libera a chave quando o
+    processamento falha, permitindo que a reentrega seja processada.
+
+    O bloom filter tem duas gerações que giram a cada `WEBHOOK_DEDUP_TTL`, o que
+    limita a taxa de falso positivo (`WEBHOOK_DEDUP_BLOOM_ERROR_RATE`) e esquece
+    IDs antigos.
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv("WEBHOOK_DEDUP_ENABLED", "true").lower() == "true"
+        self.ttl = int(os.getenv("WEBHOOK_DEDUP_TTL", "86400"))
+        self.status_ttl = int(os.getenv("WEBHOOK_DEDUP_STATUS_TTL", "10"))
+        self.capacity = int(os.getenv("WEBHOOK_DEDUP_BLOOM_CAPACITY", "200000"))
+        self.error_rate = float(os.getenv("WEBHOOK_DEDUP_BLOOM_ERROR_RATE", "0.000001"))
+        self._current = BloomFilter(self.capacity, self.error_rate)
+        self._previous = BloomFilter(self.capacity, self.error_rate)
+        self._rotated_at = time.monotonic()
+        self.counters: Dict[str, int] = {"checked": 0, "duplicates": 0, "bloom_hits": 0, "redis_hits": 0}
+
+    @staticmethod
+    def event_key(payload: dict) -> Optional[str]:
+        """
+        Chave de deduplicação do evento, ou None se o evento não for deduplicável.
+        """
+        event = payload.get("event")
+        if event == "onmessage":
+            message_id = payload.get("id")
+            if isinstance(message_id, dict):
+                message_id = message_id.get("_serialized")
+            return f"msg:{message_id}" if message_id else None
+        if event == "status-find":
+            return f"status:{payload.get('session')}:{payload.get('status')}"
+        return None
+
+    def _redis_key(self, key: str) -> str:
+        return f"webhook:dedup:{key}"
+
+    def _rotate_if_needed(self):
+        if time.monotonic() - self._rotated_at >= self.ttl or self._current.count >= self.capacity:
+            self._previous = self._current
+            self._current = BloomFilter(self.capacity, self.error_rate)
+            self._rotated_at = time.monotonic()
+
+    async def is_duplicate(self, key: str) -> bool:
+        """
+        Verifica e reserva a chave. Retorna True se o evento já foi recebido.
+        """
+        self.counters["checked"] += 1
+        use_bloom = key.startswith("msg:")
+
+        if use_bloom:
+            self._rotate_if_needed()
+            if key in self._current or key in self._previous:
+                self.counters["duplicates"] += 1
+                self.counters["bloom_hits"] += 1
+                return True
+
+        ttl = self.ttl if use_bloom else self.status_ttl
+        reserved = await get_async_redis().set(self._redis_key(key), "1", nx=True, ex=ttl)
+        if not reserved:
+            self.counters["duplicates"] += 1
+            self.counters["redis_hits"] += 1
+            return True
+        return False
+
+    def complete(self, key: str):
+        """
+        Marca o evento como processado neste processo.
+        """
+        if key.startswith("msg:"):
+            self._current.add(key)
+
+    async def release(self, key: str):
+        """
+        Libera a chave após uma falha no processamento para aceitar a reentrega.
+        """
+        await get_async_redis().delete(self._redis_key(key))
+
+    def stats(self) -> dict:
+        checked = self.counters["checked"]
+        return {
+            **self.counters,
+            "hit_rate": round(self.counters["duplicates"] / checked, 4) if checked else 0.0,
+            "bloom_entries": self._current.count + self._previous.count,
+            "pid": os.getpid(),
+        }
+
+
+webhook_deduplicator = WebhookDeduplicator()
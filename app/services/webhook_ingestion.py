@@ -0,0 +1,94 @@
+import os
+import logging
+from typing import Optional, Tuple
+
+from app.services.webhook_service import WebhookService
+from app.services.webhook_stream import WebhookEventStream
+from app.services.webhook_dedup import webhook_deduplicator
+from app.services.rate_limiter import webhook_rate_limiter
+
+# "inline": processa o evento dentro da requisição (comportamento original).
+# "stream": publica o evento no Redis Stream e responde 202 imediatamente.
+INGESTION_MODE = os.getenv("WEBHOOK_INGESTION_MODE", "inline")
+
+event_stream = WebhookEventStream()
+
+
+async def claim_event(payload: dict) -> Tuple[bool, Optional[str]]:
+    """
+    Reserva a chave de deduplicação do evento antes do controle de admissão, para
+    que reentregas não consumam tokens. Retorna (duplicado, chave reservada).
+    """
+    if not webhook_deduplicator.enabled:
+        return False, None
+    dedup_key = webhook_deduplicator.event_key(payload)
+    if dedup_key and await webhook_deduplicator.is_duplicate(dedup_key):
+        return True, dedup_key
+    return False, dedup_key
+
+
+async def admit_event(payload: dict, dedup_key: Optional[str] = None) -> Optional[dict]:
+    """
+    Aplica o controle de admissão. Retorna None se o evento foi admitido, ou o
+    resultado da recusa: {"status": "deferred"} ou {"status": "shed"}.
+    Se o Redis estiver indisponível, o evento é admitido. Um evento adiado mantém
+    a chave de deduplicação reservada; um descartado a libera para aceitar a reentrega.
+    Enquanto o remetente tiver eventos adiados, os seguintes também são adiados
+    (sem consumir cota), para serem processados depois deles, na ordem.
+    """
+    if not webhook_rate_limiter.enabled:
+        return None
+
+    try:
+        if await webhook_rate_limiter.defer_behind(payload):
+            return {
+                "status": "deferred",
+                "event": payload.get("event"),
+                "bucket": webhook_rate_limiter.bucket_key(payload),
+                "retry_after_ms": 0,
+                "reason": "ordering",
+            }
+        decision = await webhook_rate_limiter.check(payload)
+    except Exception as e:
+        logging.error(f"Erro no controle de admissão do webhook, evento admitido: {e}")
+        return None
+
+    if decision.admitted:
+        return None
+
+    result = {
+        "event": payload.get("event"),
+        "priority": decision.priority,
+        "bucket": decision.bucket_key,
+        "retry_after_ms": decision.retry_after_ms,
+    }
+    if decision.policy == "defer" and await webhook_rate_limiter.defer(payload, decision.retry_after_ms):
+        return {"status": "deferred", **result}
+
+    logging.warning(f"Evento descartado pelo controle de admissão ({decision.bucket_key}).")
+    if dedup_key:
+        await webhook_deduplicator.release(dedup_key)
+    return {"status": "shed", **result}
+
+
+async def dispatch_event(payload: dict, dedup_key: Optional[str] = None) -> dict:
+    """
+    Processa o evento (inline) ou o publica no stream. `dedup_key` é a chave já
+    reservada por `claim_event`: é confirmada no sucesso e liberada na falha.
+    Usado pelo endpoint e pelo worker de eventos adiados.
+    """
+    event = payload.get("event")
+    try:
+        if INGESTION_MODE == "stream":
+            entry_id = await event_stream.publish(payload)
+            result = {"status": "accepted", "event": event, "id": entry_id}
+        else:
+            result = await WebhookService.process_event(payload)
+    except Exception:
+        if dedup_key:
+            await webhook_deduplicator.release(dedup_key)
+        raise
+
+    if dedup_key:
+        webhook_deduplicator.complete(dedup_key)
+    return result
@@ -1,23 +1,47 @@
 import asyncio
-import os
 from app.flows.create_agents_flow import CreateAgentsFlow
 from app.flows.google_integration_flow import GoogleIntegrationFlow
 from app.models.user import User
 from app.schemas.user import UserCreate
 from app.services.user_service import UserRepository
-from app.services.whatsapp_service import WhatsAppService
+from app.services.outbound_queue import async_queued_wpp
 from app.flows.whatsapp_integration_flow import WhatsappIntegrationFlow
 from app.utils.archival_memory_manager import background_agent_archival_memory_insert
-from .letta_service import send_user_message_to_agent, get_onboarding_agent_id
+from app.utils.integration_manager import whatsapp_session_status_manager
+from app.services.ingestion_filters import ingestion_filters
+from app.services.media_pipeline import media_pipeline
+from app.utils.webhook_parser import is_pipeline_media
+from .letta_service import send_coalesced_user_message_to_agent, get_onboarding_agent_id_async
 from dotenv import load_dotenv
 
 load_dotenv()
-token = os.getenv("PRINCIPAL_WPP_SESSION_TOKEN")
-wpp = WhatsAppService(session_name="principal", token=token)
 
 class WebhookService:
+    @staticmethod
+    async def process_event(payload: dict):
+        """
+        Encaminha o evento recebido do WPPConnect para o processamento adequado.
+        Usado tanto pelo endpoint (modo inline) quanto pelos consumidores do stream.
+        """
+        event = payload.get("event")
+
+        if event == "onmessage":
+            data = await WebhookService.process_onmessage_event(payload)
+            return {"status": "success", "event": "onmessage", "data": data}
+
+        if event == "status-find":
+            await whatsapp_session_status_manager(payload.get("session"), payload.get("status"))
+            return {"status": "success", "event": "status-find"}
+
+        return {"status": "ignored", "message": "Evento não processado."}
+
     @staticmethod
     async def process_onmessage_event(payload: dict):
+        # Filtros avaliados antes de qualquer consulta ao banco ou ao Letta.
+        dropped_by = await ingestion_filters.match(payload)
+        if dropped_by:
+            return {"status": "filtered", "rule": dropped_by}
+
         user_name = payload.get("notifyName")
         user_number = payload["sender"]["id"].replace("@c.us", "")
         message = payload.get("body")
@@ -25,7 +49,13 @@ class WebhookService:
         msg_type = payload.get("type")
         is_group = payload.get("isGroupMsg")
         group_id = payload.get("from")
+        timestamp = payload.get("t")
         
+        # Mídias das sessões pessoais são baixadas em segundo plano e anexadas à memória arquivística.
+        if is_pipeline_media(msg_type, session):
+            queued = await media_pipeline.submit(payload)
+            return {"status": "media_queued" if queued else "media_dropped", "type": msg_type, "session": session}
+
         if msg_type != "chat":
             return {"status": "ignored", "message": "Evento não processado."}
 
@@ -35,7 +65,7 @@ class WebhookService:
 
                 integration_status = user.integration_is_running
                 if integration_status is None:
-                    WebhookService.perform_action_based_on_message(message, user)
+                    await WebhookService.perform_action_based_on_message(message, user, timestamp)
                 elif integration_status == "whatsapp":
                     flow = WhatsappIntegrationFlow(user.id)
                     await flow.load_state()
@@ -54,7 +84,8 @@ class WebhookService:
                     phone=user_number,
                     name=user_name,
                     is_group=is_group,
-                    group_id=group_id
+                    group_id=group_id,
+                    timestamp=timestamp
                 )
 
             return {
@@ -76,17 +107,17 @@ class WebhookService:
             user = await user_repo.get_user_by_phone(phone=user_number)
             
             if user:
+                if not user.id_main_agent:
+                    await WebhookService.resume_agents_flow(user.id)
                 return user
 
-            wpp.send_message(
+            await async_queued_wpp.send_message(
                 user_number, 
                 f"Olá, *{user_name}*.\n\nComo é sua primeira vez por aqui, irei criar o seu perfil no sistema, *aguarde um momento*."
             )
             new_user = await user_repo.create_user(user=UserCreate(name=user_name, phone=user_number))
             
-            agents_flow = CreateAgentsFlow(new_user.id)
-            await agents_flow.load_state()
-            await agents_flow.restart()
+            await CreateAgentsFlow(new_user.id).run_once()
             return new_user
 
         except Exception as e:
@@ -95,7 +126,21 @@ class WebhookService:
 
 
     @staticmethod
-    def perform_action_based_on_message(message: str, user: User):
+    async def resume_agents_flow(user_id: str):
+        """
+        Retoma o provisionamento dos agentes interrompido (queda do processo ou erro),
+        a partir das etapas já concluídas. Se o flow já estiver rodando (outra
+        mensagem do mesmo usuário), não faz nada.
+        """
+        agents_flow = CreateAgentsFlow(user_id)
+        state = await agents_flow.flow_repo.get_flow_state(CreateAgentsFlow.FLOW_NAME, user_id)
+        if not state or state.get("flow_completed"):
+            return
+        await agents_flow.run_once()
+
+
+    @staticmethod
+    async def perform_action_based_on_message(message: str, user: User, timestamp: float = None):
         is_user_fully_integrated = all([
             user.id_main_agent,
             user.whatsapp_integration,
@@ -106,8 +151,8 @@ class WebhookService:
 
         agent_id = (
             user.id_main_agent if is_user_fully_integrated
-            else get_onboarding_agent_id(user.phone)
+            else user.id_onboarding_agent or await get_onboarding_agent_id_async(user.phone)
         )
         
-        send_user_message_to_agent(agent_id, message)
+        await send_coalesced_user_message_to_agent(agent_id, user.phone, message, timestamp)
 
@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import zlib
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from app.utils.redis_connection import get_async_redis
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+EventHandler = Callable[[dict], Awaitable[dict]]
+
+# Renova o lease somente se ele ainda pertencer ao mesmo dono.
+RENEW_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def partition_key(payload: dict) -> str:
+    """
+    Chave de particionamento do evento: o remetente da mensagem ou, para
+    eventos de sessão (ex.: status-find), o nome da sessão.
+    """
+    sender = payload.get("sender") or {}
+    return sender.get("id") or payload.get("session") or ""
+
+
+def shard_for(key: str, shard_count: int) -> int:
+    """
+    Shard de uma chave. Usa CRC32 (estável entre processos, ao contrário de hash()).
+    """
+    return zlib.crc32(key.encode("utf-8")) % shard_count
+
+
+class WebhookEventStream:
+    """
+    Fila de eventos do webhook baseada em Redis Streams, particionada por usuário.
+
+    Cada evento vai para o shard `crc32(sender.id) % WEBHOOK_STREAM_SHARDS`. Cada
+    shard é consumido por um único worker por vez (lease no Redis), de forma
+    sequencial, o que garante a ordem estrita das mensagens de um mesmo usuário;
+    shards diferentes são processados em paralelo, entre workers e processos.
+
+    O consumidor de um shard tem nome fixo (`shard-<n>`), então o worker que
+    assume um shard (ex.: após a queda do anterior) começa pelas entradas
+    pendentes, na ordem original. Uma entrada que falha é reprocessada no lugar
+    até `WEBHOOK_STREAM_MAX_DELIVERIES` vezes e então movida para o dead-letter.
+    """
+
+    def __init__(self, stream_key: Optional[str] = None, group: Optional[str] = None, shard_count: Optional[int] = None):
+        self.stream_key = stream_key or os.getenv("WEBHOOK_STREAM_KEY", "webhook:events")
+        self.group = group or os.getenv("WEBHOOK_STREAM_GROUP", "webhook-workers")
+        self.shard_count = shard_count or int(os.getenv("WEBHOOK_STREAM_SHARDS", "16"))
+        self.dead_letter_key = f"{self.stream_key}:dead"
+        self.maxlen = int(os.getenv("WEBHOOK_STREAM_MAXLEN", "100000"))
+        self.block_ms = int(os.getenv("WEBHOOK_STREAM_BLOCK_MS", "5000"))
+        self.batch_size = int(os.getenv("WEBHOOK_STREAM_BATCH_SIZE", "10"))
+        self.max_deliveries = int(os.getenv("WEBHOOK_STREAM_MAX_DELIVERIES", "5"))
+        self.lease_ms = int(os.getenv("WEBHOOK_SHARD_LEASE_MS", "30000"))
+        self.redis = get_async_redis()
+        self._groups_ready = set()
+
+    def shard_stream_key(self, shard: int) -> str:
+        return f"{self.stream_key}:{shard}"
+
+    def shard_lease_key(self, shard: int) -> str:
+        return f"{self.stream_key}:lease:{shard}"
+
+    def _processed_key(self, shard: int) -> str:
+        return f"{self.stream_key}:processed:{shard}"
+
+    async def publish(self, payload: dict) -> str:
+        """
+        Adiciona o evento ao shard do remetente e retorna o ID da entrada.
+        """
+        shard = shard_for(partition_key(payload), self.shard_count)
+        return await self.redis.xadd(
+            self.shard_stream_key(shard),
+            {"payload": json.dumps(payload)},
+            maxlen=self.maxlen,
+            approximate=True
+        )
+
+    async def ensure_group(self, shard: int):
+        """
+        Cria o consumer group (e o stream) do shard caso ainda não existam.
+        """
+        if shard in self._groups_ready:
+            return
+        try:
+            await self.redis.xgroup_create(self.shard_stream_key(shard), self.group, id="0", mkstream=True)
+        except Exception as e:
+            # BUSYGROUP: o grupo já existe
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._groups_ready.add(shard)
+
+    ####################################################################################################
+    # Leases dos shards
+
+    async def acquire_shard(self, shard: int, owner: str) -> bool:
+        return bool(await self.redis.set(self.shard_lease_key(shard), owner, nx=True, px=self.lease_ms))
+
+    async def renew_shard(self, shard: int, owner: str) -> bool:
+        return bool(await self.redis.eval(RENEW_LEASE_SCRIPT, 1, self.shard_lease_key(shard), owner, self.lease_ms))
+
+    async def release_shard(self, shard: int, owner: str):
+        await self.redis.eval(RELEASE_LEASE_SCRIPT, 1, self.shard_lease_key(shard), owner)
+
+    async def unowned_shards(self) -> List[int]:
+        """
+        Shards sem lease (nenhum processo os consome).
+        """
+        owners = await self.redis.mget([self.shard_lease_key(shard) for shard in range(self.shard_count)])
+        return [shard for shard, owner in enumerate(owners) if not owner]
+
+    ####################################################################################################
+    # Consumo
+
+    async def consume_shard(self, shard: int, handler: EventHandler, stop_event: asyncio.Event):
+        """
+        Consome um shard sequencialmente: primeiro as entradas pendentes (herdadas
+        de um dono anterior), depois as novas. Deve ser chamado apenas por quem
+        detém o lease do shard.
+        """
+        await self.ensure_group(shard)
+        key = self.shard_stream_key(shard)
+        consumer_name = f"shard-{shard}"
+        cursor = "0"
+
+        while not stop_event.is_set():
+            try:
+                response = await self.redis.xreadgroup(
+                    self.group,
+                    consumer_name,
+                    {key: cursor},
+                    count=self.batch_size,
+                    block=None if cursor == "0" else self.block_ms
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Erro ao ler o stream {key}: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            entries = [entry for _, stream_entries in response or [] for entry in stream_entries]
+            if cursor == "0" and not entries:
+                # Não há mais pendências: passa a ler apenas entradas novas.
+                cursor = ">"
+                continue
+
+            for entry_id, fields in entries:
+                await self._handle_entry(shard, entry_id, fields, handler, stop_event)
+
+    async def _handle_entry(self, shard: int, entry_id: str, fields: dict, handler: EventHandler, stop_event: asyncio.Event):
+        key = self.shard_stream_key(shard)
+        if not fields:
+            # Entrada removida pelo MAXLEN enquanto estava pendente.
+            await self.redis.xack(key, self.group, entry_id)
+            return
+
+        try:
+            payload = json.loads(fields["payload"])
+        except (KeyError, json.JSONDecodeError) as e:
+            logger.error(f"Entrada inválida no stream {key} ({entry_id}): {e}")
+            await self._dead_letter(shard, entry_id, fields)
+            return
+
+        # Reprocessa no lugar para não furar a ordem do usuário.
+        for delivery in range(1, self.max_deliveries + 1):
+            try:
+                await handler(payload)
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Erro ao processar evento {entry_id} do stream {key} (tentativa {delivery}/{self.max_deliveries}): {e}")
+                if delivery == self.max_deliveries or stop_event.is_set():
+                    if delivery == self.max_deliveries:
+                        await self._dead_letter(shard, entry_id, fields)
+                    return
+                await asyncio.sleep(min(2 ** delivery, 30))
+
+        await self.redis.xack(key, self.group, entry_id)
+        await self.redis.hset(self._processed_key(shard), mapping={"entry_id": entry_id, "at": int(time.time() * 1000)})
+
+    async def _dead_letter(self, shard: int, entry_id: str, fields: dict):
+        key = self.shard_stream_key(shard)
+        await self.redis.xadd(self.dead_letter_key, {**fields, "source": key, "source_id": entry_id}, maxlen=self.maxlen, approximate=True)
+        await self.redis.xack(key, self.group, entry_id)
+        logger.warning(f"Evento {entry_id} do stream {key} movido para {self.dead_letter_key}.")
+
+    ####################################################################################################
+    # Métricas
+
+    async def shard_metrics(self) -> List[Dict]:
+        """
+        Retorna, por shard: dono do lease, tamanho do stream, entradas ainda não
+        entregues (lag), pendentes sem ACK e a idade (ms) da entrada mais antiga
+        aguardando processamento.
+        """
+        now_ms = int(time.time() * 1000)
+        metrics = []
+        for shard in range(self.shard_count):
+            key = self.shard_stream_key(shard)
+            owner = await self.redis.get(self.shard_lease_key(shard))
+            processed = await self.redis.hgetall(self._processed_key(shard))
+            item = {
+                "shard": shard,
+                "owner": owner,
+                "length": 0,
+                "lag": 0,
+                "pending": 0,
+                "oldest_waiting_ms": 0,
+                "last_processed_at": int(processed["at"]) if processed.get("at") else None,
+            }
+
+            if not await self.redis.exists(key):
+                metrics.append(item)
+                continue
+
+            item["length"] = await self.redis.xlen(key)
+            groups = await self.redis.xinfo_groups(key)
+            group = next((g for g in groups if g["name"] == self.group), None)
+            if not group:
+                # Nenhum worker consumiu este shard ainda.
+                item["lag"] = item["length"]
+                first = await self.redis.xrange(key, count=1)
+                if first:
+                    item["oldest_waiting_ms"] = max(0, now_ms - int(first[0][0].split("-")[0]))
+            else:
+                item["pending"] = group.get("pending", 0)
+                last_delivered = group.get("last-delivered-id", "0-0")
+                undelivered = await self.redis.xrange(key, min=f"({last_delivered}", count=1)
+                lag = group.get("lag")
+                if lag is None:
+                    # Redis < 7 não informa o lag do grupo; conta até 1000 entradas.
+                    lag = len(await self.redis.xrange(key, min=f"({last_delivered}", count=1000)) if undelivered else 0
+                item["lag"] = lag
+
+                oldest = None
+                if item["pending"]:
+                    oldest = (await self.redis.xpending(key, self.group)).get("min")
+                elif undelivered:
+                    oldest = undelivered[0][0]
+                if oldest:
+                    item["oldest_waiting_ms"] = max(0, now_ms - int(oldest.split("-")[0]))
+
+            metrics.append(item)
+        return metrics
@@ -1,42 +1,117 @@
 import os
+import asyncio
+import mimetypes
+import logging
+from abc import ABC, abstractmethod
+from typing import Optional
+
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
-class WhatsAppService:
+from app.services.wpp_token_manager import wpp_tokens
+from app.services.session_router import session_router
+from app.utils.base64_stream import Base64JsonBody
+
+load_dotenv()
+
+# Pool de conexões HTTP com o WPPConnect, compartilhado por todas as instâncias do processo.
+HTTP_POOL_SIZE = int(os.getenv("WHATSAPP_HTTP_POOL_SIZE", "20"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("WHATSAPP_HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("WHATSAPP_HTTP_READ_TIMEOUT", "60"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("WHATSAPP_HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_RETRIES = int(os.getenv("WHATSAPP_HTTP_RETRIES", "3"))
+HTTP_RETRY_BACKOFF = float(os.getenv("WHATSAPP_HTTP_RETRY_BACKOFF", "0.5"))
+RETRY_STATUS_CODES = (502, 503, 504)
+
+_sync_session: Optional[requests.Session] = None
+_sync_session_pid: Optional[int] = None
+_async_client: Optional[httpx.AsyncClient] = None
+
+
+def get_sync_http_session() -> requests.Session:
+    """
+    Sessão `requests` com keep-alive compartilhada pelo processo (tasks do Celery).
+    Recriada após um fork para não compartilhar sockets com o processo pai.
+
+    Falhas de conexão são repetidas em qualquer método (a requisição não chegou a
+    ser enviada); erros de leitura e 502/503/504 só nos GETs, para não duplicar envios.
+    """
+    global _sync_session, _sync_session_pid
+    if _sync_session is None or _sync_session_pid != os.getpid():
+        retry = Retry(
+            total=HTTP_RETRIES,
+            connect=HTTP_RETRIES,
+            read=HTTP_RETRIES,
+            status=HTTP_RETRIES,
+            allowed_methods=frozenset({"GET"}),
+            status_forcelist=RETRY_STATUS_CODES,
+            backoff_factor=HTTP_RETRY_BACKOFF,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _sync_session, _sync_session_pid = session, os.getpid()
+    return _sync_session
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """
+    Cliente `httpx` assíncrono com keep-alive compartilhado pelo processo (FastAPI e workers).
+    """
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=HTTP_POOL_SIZE,
+                max_keepalive_connections=HTTP_POOL_SIZE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            transport=httpx.AsyncHTTPTransport(retries=HTTP_RETRIES),
+        )
+    return _async_client
+
+
+async def close_async_http_client():
+    """
+    Fecha o pool assíncrono do processo, se existir (shutdown).
+    """
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+class BaseWhatsAppService(ABC):
     """
     Serviço para integração com a WPPConnect API.
     Essa classe encapsula chamadas a alguns endpoints básicos
-    descritos na OpenAPI, usando requests.
+    descritos na OpenAPI. O transporte fica nas subclasses:
+    `WhatsAppService` (síncrona, tasks do Celery) e `AsyncWhatsAppService`
+    (assíncrona, código que roda no event loop), que devolve corrotinas.
     """
     load_dotenv(dotenv_path=".env", override=True)
     
-    def __init__(self, session_name: str, token: str = None):
+    def __init__(self, session_name: str, token: str = None, base_url: str = None):
         """
-        :param base_url: URL base do WPPConnect (ex: http://localhost:21465 ou outro endpoint).
         :param session_name: Nome da sessão, ex.: 'NERDWHATS_AMERICA'.
-        :param secret_key: Chave secreta usada em alguns endpoints (opcional,
-        pois alguns ambientes usam outra forma de autorização).
+        :param token: Token da sessão (opcional; gerado pelo `wpp_tokens` quando há secret_key).
+        :param base_url: URL do WPPConnect (opcional). Sem ela, o servidor da sessão
+        vem do `session_router` (hash consistente entre os nós de `WHATSAPP_SERVER_NODES`).
         """
-        self.base_url = os.getenv("WHATSAPP_SERVER_BASE_URL")
+        self.pinned_url = base_url
+        self.base_url = base_url
         self.session_name = session_name
         self.secret_key = os.getenv("WHATSAPP_SERVER_SECRET_KEY")
         self._token = token
 
-    def generate_token(self):
-        """
-        Gera o token de acesso (JWT) para uso nos endpoints que requerem bearerAuth.
-        Endpoint: POST /api/{session}/{secretkey}/generate-token
-        Atualiza self._token internamente.
-        """
-        if not self.secret_key:
-            raise ValueError("secret_key não definido.")
-
-        url = f"{self.base_url}/api/{self.session_name}/{self.secret_key}/generate-token"
-        response = requests.post(url)
-        response.raise_for_status()
-        data = response.json()
-        self._token = data.get("token")  
-        return self._token
+    def _url(self, endpoint: str) -> str:
+        return f"{self.base_url}/api/{self.session_name}/{endpoint}"
 
     def _get_headers(self):
         """
@@ -46,139 +121,124 @@ class WhatsAppService:
             return {}
         return {"Authorization": f"Bearer {self._token}"}
 
+    @abstractmethod
+    def _request(self, method: str, endpoint: str, payload: dict = None, authenticated: bool = True, body: Base64JsonBody = None):
+        """
+        Executa a requisição no WPPConnect (síncrona ou assíncrona, conforme a subclasse).
+        """
+
+    @abstractmethod
+    def generate_token(self):
+        """
+        Gera o token de acesso (JWT) para uso nos endpoints que requerem bearerAuth.
+        Endpoint: POST /api/{session}/{secretkey}/generate-token
+        Atualiza self._token internamente. A geração passa pelo `wpp_tokens`
+        (cache no Redis e single-flight), que também renova o token antes de
+        expirar e após um 401, repetindo a requisição uma vez.
+        """
+
     def get_qrcode_session(self):
         """
         Obtém o QR Code da sessão. 
         Endpoint: GET /api/{session}/qrcode-session
         """
-        url = f"{self.base_url}/api/{self.session_name}/qrcode-session"
-        resp = requests.get(url, headers=self._get_headers())
-        resp.raise_for_status()
-        return resp.json()
+        return self._request("GET", "qrcode-session")
 
     def start_session(self, wait_qr_code: bool = False):
         """
         Inicializa sessão.
         Endpoint: POST /api/{session}/start-session
         """
-        url = f"{self.base_url}/api/{self.session_name}/start-session"
         payload = {
             "webhook": os.getenv("WHATSAPP_SERVER_WEBHOOK_URL"),
             "waitQrCode": wait_qr_code
         }
-        resp = requests.post(url, json=payload, headers=self._get_headers())
-        resp.raise_for_status()
-        return resp.json()
+        return self._request("POST", "start-session", payload)
 
     def logout_session(self):
         """
         Faz logout e remove os dados de sessão.
         Endpoint: POST /api/{session}/logout-session
         """
-        url = f"{self.base_url}/api/{self.session_name}/logout-session"
-        resp = requests.post(url, headers=self._get_headers())
-        resp.raise_for_status()
-        return resp.json()
+        return self._request("POST", "logout-session")
 
     def close_session(self):
         """
         Fecha a sessão sem deletar dados (conforme a doc).
         Endpoint: POST /api/{session}/close-session
         """
-        url = f"{self.base_url}/api/{self.session_name}/close-session"
-        resp = requests.post(url, headers=self._get_headers())
-        resp.raise_for_status()
-        return resp.json()
+        return self._request("POST", "close-session")
 
     def status_session(self):
         """
         Verifica status da sessão.
         Endpoint: GET /api/{session}/status-session
         """
-        url = f"{self.base_url}/api/{self.session_name}/check-connection-session"
-        resp = requests.get(url, headers=self._get_headers())
-        resp.raise_for_status()
-        return resp.json()
+        return self._request("GET", "check-connection-session")
 
     def download_media(self, message_id: str):
         """
         Faz download de mídia relacionada a uma mensagem específica.
         Endpoint: POST /api/{session}/download-media
         """
-        url = f"{self.base_url}/api/{self.session_name}/download-media"
         payload = {"messageId": message_id}
-        resp = requests.post(url, json=payload, headers=self._get_headers())
-        resp.raise_for_status()
         # Dependendo da implementação, pode vir um base64 ou URL de download
-        return resp.json()
+        return self._request("POST", "download-media", payload)
 
     def send_message(self, phone: str, message: str, is_group: bool = False):
         """
         Envia mensagem de texto.
         Endpoint: POST /api/{session}/send-message
         """
-        url = f"{self.base_url}/api/{self.session_name}/send-message"
         payload = {
             "phone": phone,
             "isGroup": is_group,
             "message": message
         }
-        resp = requests.post(url, json=payload, headers=self._get_headers())
-        resp.raise_for_status()
-        return resp.json()
+        return self._request("POST", "send-message", payload)
 
     def edit_message(self, message_id: str, new_text: str):
         """
         Edita uma mensagem já enviada (se suportado pelo WA).
         Endpoint: POST /api/{session}/edit-message
         """
-        url = f"{self.base_url}/api/{self.session_name}/edit-message"
         payload = {
             "id": message_id,
             "newText": new_text
         }
-        resp = requests.post(url, json=payload, headers=self._get_headers())
-        resp.raise_for_status()
-        return resp.json()
+        return self._request("POST", "edit-message", payload)
 
     def send_image(self, phone: str, base64_str: str, filename: str, caption: str):
         """
         Envia imagem em base64.
         Endpoint: POST /api/{session}/send-image
         """
-        url = f"{self.base_url}/api/{self.session_name}/send-image"
         payload = {
             "phone": phone,
             "filename": filename,
             "caption": caption,
             "base64": base64_str
         }
-        resp = requests.post(url, json=payload, headers=self._get_headers())
-        resp.raise_for_status()
-        return resp.json()
+        return self._request("POST", "send-image", payload)
 
     def send_reply(self, phone: str, message_id: str, reply_text: str, is_group: bool = False):
         """
         Responde a uma mensagem específica.
         Endpoint: POST /api/{session}/send-reply
         """
-        url = f"{self.base_url}/api/{self.session_name}/send-reply"
         payload = {
             "phone": phone,
             "isGroup": is_group,
             "message": reply_text,
             "messageId": message_id
         }
-        resp = requests.post(url, json=payload, headers=self._get_headers())
-        resp.raise_for_status()
-        return resp.json()
+        return self._request("POST", "send-reply", payload)
 
     def send_file(self, phone: str, base64_str: str, filename: str, caption: str, is_group: bool = False):
         """
         Envia arquivo em base64.
         Endpoint: POST /api/{session}/send-file
         """
-        url = f"{self.base_url}/api/{self.session_name}/send-file"
         payload = {
             "phone": phone,
             "isGroup": is_group,
@@ -186,9 +246,7 @@ class WhatsAppService:
             "caption": caption,
             "base64": base64_str
         }
-        resp = requests.post(url, json=payload, headers=self._get_headers())
-        resp.raise_for_status()
-        return resp.json()
+        return self._request("POST", "send-file", payload)
 
     def send_file_base64(self, phone: str, base64_str: str, filename: str, caption: str,
                          is_group: bool = False):
@@ -197,7 +255,6 @@ class WhatsAppService:
         alguns ambientes usam esse separadamente).
         Endpoint: POST /api/{session}/send-file-base64
         """
-        url = f"{self.base_url}/api/{self.session_name}/send-file-base64"
         payload = {
             "phone": phone,
             "isGroup": is_group,
@@ -205,16 +262,13 @@ class WhatsAppService:
             "caption": caption,
             "base64": base64_str
         }
-        resp = requests.post(url, json=payload, headers=self._get_headers())
-        resp.raise_for_status()
-        return resp.json()
+        return self._request("POST", "send-file-base64", payload)
 
     def send_voice(self, phone: str, path_file: str, is_group: bool = False, quoted_message_id: str = None):
         """
         Envia mensagem de voz a partir de um caminho de arquivo local.
         Endpoint: POST /api/{session}/send-voice
         """
-        url = f"{self.base_url}/api/{self.session_name}/send-voice"
         payload = {
             "phone": phone,
             "isGroup": is_group,
@@ -222,25 +276,19 @@ class WhatsAppService:
         }
         if quoted_message_id:
             payload["quotedMessageId"] = quoted_message_id
-
-        resp = requests.post(url, json=payload, headers=self._get_headers())
-        resp.raise_for_status()
-        return resp.json()
+        return self._request("POST", "send-voice", payload)
 
     def send_voice_base64(self, phone: str, base64_ptt: str, is_group: bool = False):
         """
         Envia mensagem de voz em base64.
         Endpoint: POST /api/{session}/send-voice-base64
         """
-        url = f"{self.base_url}/api/{self.session_name}/send-voice-base64"
         payload = {
             "phone": phone,
             "isGroup": is_group,
             "base64Ptt": base64_ptt
         }
-        resp = requests.post(url, json=payload, headers=self._get_headers())
-        resp.raise_for_status()
-        return resp.json()
+        return self._request("POST", "send-voice-base64", payload)
 
     def delete_message(self, phone: str, message_id: str, is_group: bool = False,
                        only_local: bool = False, delete_media_in_device: bool = False):
@@ -249,7 +297,6 @@ class WhatsAppService:
         Pode deletar para todos ou apenas para quem deleta, dependendo dos parâmetros.
         Endpoint: POST /api/{session}/delete-message
         """
-        url = f"{self.base_url}/api/{self.session_name}/delete-message"
         payload = {
             "phone": phone,
             "isGroup": is_group,
@@ -257,6 +304,170 @@ class WhatsAppService:
             "onlyLocal": only_local,
             "deleteMediaInDevice": delete_media_in_device
         }
-        resp = requests.post(url, json=payload, headers=self._get_headers())
+        return self._request("POST", "delete-message", payload)
+
+
+    def _file_body(self, path: str, fields: dict, field: str = "base64", mimetype: str = None) -> Base64JsonBody:
+        mimetype = mimetype or mimetypes.guess_type(path)[0] or "application/octet-stream"
+        return Base64JsonBody(path, fields, field, mimetype=mimetype)
+
+    def send_file_from_path(self, phone: str, path: str, filename: str = None, caption: str = None,
+                            is_group: bool = False, mimetype: str = None):
+        """
+        Envia um arquivo do disco sem carregá-lo na memória: o corpo JSON é gerado
+        em streaming, com o base64 codificado em blocos a partir de um mmap.
+        Endpoint: POST /api/{session}/send-file
+        """
+        fields = {"phone": phone, "isGroup": is_group, "filename": filename or os.path.basename(path), "caption": caption}
+        return self._request("POST", "send-file", body=self._file_body(path, fields, mimetype=mimetype))
+
+    def send_file_base64_from_path(self, phone: str, path: str, filename: str = None, caption: str = None,
+                                   is_group: bool = False, mimetype: str = None):
+        """
+        Igual a `send_file_from_path`, pelo endpoint send-file-base64.
+        Endpoint: POST /api/{session}/send-file-base64
+        """
+        fields = {"phone": phone, "isGroup": is_group, "filename": filename or os.path.basename(path), "caption": caption}
+        return self._request("POST", "send-file-base64", body=self._file_body(path, fields, mimetype=mimetype))
+
+    def send_image_from_path(self, phone: str, path: str, filename: str = None, caption: str = None, mimetype: str = None):
+        """
+        Envia uma imagem do disco em streaming (mmap + base64 incremental).
+        Endpoint: POST /api/{session}/send-image
+        """
+        fields = {"phone": phone, "filename": filename or os.path.basename(path), "caption": caption}
+        return self._request("POST", "send-image", body=self._file_body(path, fields, mimetype=mimetype))
+
+    def send_voice_base64_from_path(self, phone: str, path: str, is_group: bool = False, mimetype: str = None):
+        """
+        Envia um áudio do disco como mensagem de voz, em streaming (mmap + base64 incremental).
+        Endpoint: POST /api/{session}/send-voice-base64
+        """
+        fields = {"phone": phone, "isGroup": is_group}
+        return self._request("POST", "send-voice-base64", body=self._file_body(path, fields, "base64Ptt", mimetype))
+
+
+class WhatsAppService(BaseWhatsAppService):
+    """
+    Cliente síncrono, usado pelas tasks do Celery. Usa a sessão `requests` do processo.
+    """
+
+    def _send(self, method: str, endpoint: str, payload: dict = None, authenticated: bool = True, body: Base64JsonBody = None):
+        self.base_url = self.pinned_url or session_router.url_for_sync(self.session_name)
+        headers = self._get_headers() if authenticated else {}
+        if body is not None:
+            headers = {**headers, "Content-Type": "application/json"}
+        resp = get_sync_http_session().request(
+            method,
+            self._url(endpoint),
+            json=payload,
+            data=body,
+            headers=headers,
+            timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+        )
         resp.raise_for_status()
         return resp.json()
+
+    def _request(self, method: str, endpoint: str, payload: dict = None, authenticated: bool = True, body: Base64JsonBody = None):
+        if not (authenticated and self.secret_key):
+            return self._send(method, endpoint, payload, authenticated, body)
+
+        self._token = wpp_tokens.get_token_sync(self.session_name, self._generate_raw_token, seed=self._token)
+        try:
+            return self._send(method, endpoint, payload, body=body)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 401:
+                raise
+            self._token = wpp_tokens.refresh_sync(self.session_name, self._generate_raw_token, stale=self._token)
+            return self._send(method, endpoint, payload, body=body)
+
+    def _generate_raw_token(self) -> str:
+        return self._send("POST", f"{self.secret_key}/generate-token", authenticated=False).get("token")
+
+    def generate_token(self):
+        if not self.secret_key:
+            raise ValueError("secret_key não definido.")
+        self._token = wpp_tokens.refresh_sync(self.session_name, self._generate_raw_token, stale=self._token)
+        return self._token
+
+
+class AsyncWhatsAppService(BaseWhatsAppService):
+    """
+    Cliente assíncrono, usado no FastAPI, nos flows e nos workers. Os métodos
+    devolvem corrotinas (`await wpp.send_message(...)`) e usam o cliente `httpx` do processo.
+    """
+
+    async def _send(self, method: str, endpoint: str, payload: dict = None, authenticated: bool = True, body: Base64JsonBody = None):
+        client = get_async_http_client()
+        self.base_url = self.pinned_url or await session_router.url_for(self.session_name)
+        attempt = 0
+        while True:
+            try:
+                headers = self._get_headers() if authenticated else {}
+                if body is not None:
+                    headers = {**headers, "Content-Type": "application/json", "Content-Length": str(len(body))}
+                resp = await client.request(
+                    method,
+                    self._url(endpoint),
+                    json=payload,
+                    content=body.aiter() if body is not None else None,
+                    headers=headers,
+                )
+                resp.raise_for_status()
+                return resp.json()
+            except (httpx.HTTPStatusError, httpx.ReadError, httpx.ReadTimeout) as e:
+                # Erros de leitura e 502/503/504 são repetidos apenas nos GETs, para não duplicar envios.
+                retryable = not isinstance(e, httpx.HTTPStatusError) or e.response.status_code in RETRY_STATUS_CODES
+                if method != "GET" or not retryable or attempt >= HTTP_RETRIES:
+                    raise
+                attempt += 1
+                logging.warning(f"Repetindo {method} {endpoint} ({attempt}/{HTTP_RETRIES}): {e}")
+                await asyncio.sleep(HTTP_RETRY_BACKOFF * 2 ** (attempt - 1))
+
+    async def _request(self, method: str, endpoint: str, payload: dict = None, authenticated: bool = True, body: Base64JsonBody = None):
+        if not (authenticated and self.secret_key):
+            return await self._send(method, endpoint, payload, authenticated, body)
+
+        self._token = await wpp_tokens.get_token(self.session_name, self._generate_raw_token, seed=self._token)
+        try:
+            return await self._send(method, endpoint, payload, body=body)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 401:
+                raise
+            self._token = await wpp_tokens.refresh(self.session_name, self._generate_raw_token, stale=self._token)
+            return await self._send(method, endpoint, payload, body=body)
+
+    async def download_media_stream(self, message_id: str, chunk_size: int = 256 * 1024):
+        """
+        Download de mídia em streaming: gera os pedaços do corpo JSON da resposta
+        sem carregá-lo na memória (decodificar com `Base64JsonFieldDecoder`).
+        Endpoint: POST /api/{session}/download-media
+        """
+        client = get_async_http_client()
+        self.base_url = self.pinned_url or await session_router.url_for(self.session_name)
+        if self.secret_key:
+            self._token = await wpp_tokens.get_token(self.session_name, self._generate_raw_token, seed=self._token)
+
+        for attempt in range(2):
+            async with client.stream("POST", self._url("download-media"), json={"messageId": message_id}, headers=self._get_headers()) as resp:
+                if resp.status_code == 401 and attempt == 0 and self.secret_key:
+                    self._token = await wpp_tokens.refresh(self.session_name, self._generate_raw_token, stale=self._token)
+                    continue
+                resp.raise_for_status()
+                async for chunk in resp.aiter_bytes(chunk_size):
+                    yield chunk
+                return
+
+    async def _generate_raw_token(self) -> str:
+        return (await self._send("POST", f"{self.secret_key}/generate-token", authenticated=False)).get("token")
+
+    async def generate_token(self):
+        if not self.secret_key:
+            raise ValueError("secret_key não definido.")
+        self._token = await wpp_tokens.refresh(self.session_name, self._generate_raw_token, stale=self._token)
+        return self._token
+
+
+# Instâncias da sessão principal compartilhadas pelo processo.
+wpp = WhatsAppService(session_name="principal", token=os.getenv("PRINCIPAL_WPP_SESSION_TOKEN"))
+async_wpp = AsyncWhatsAppService(session_name="principal", token=os.getenv("PRINCIPAL_WPP_SESSION_TOKEN"))
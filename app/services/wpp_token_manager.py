@@ -0,0 +1,275 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+import uuid
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+import jwt
+from dotenv import load_dotenv
+
+from app.services.user_service import UserRepository
+from app.utils.redis_connection import get_async_redis, get_sync_redis
+
+load_dotenv()
+
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class WppTokenManager:
+    """
+    Cache dos tokens das sessões do WPPConnect no Redis (`wpp:token:<sessão>`),
+    compartilhado por todos os processos.
+
+    O token é renovado `WPP_TOKEN_REFRESH_MARGIN` segundos antes de expirar. A
+    expiração vem do campo `exp` quando o token é um JWT; caso contrário, vale
+    `WPP_TOKEN_TTL` segundos a partir da geração. A renovação é single-flight:
+    um lock por sessão no processo e um lock no Redis entre processos; quem não
+    obtém o lock usa o token atual enquanto ele for válido ou espera o novo.
+
+    O gerador do token é recebido como parâmetro (o `generate-token` do
+    WhatsAppService), assim o gerenciador não depende do transporte HTTP. Cada
+    token renovado também é gravado em `users.token_wpp` da sessão.
+    """
+
+    def __init__(self):
+        self.ttl = int(os.getenv("WPP_TOKEN_TTL", "86400"))
+        self.refresh_margin = int(os.getenv("WPP_TOKEN_REFRESH_MARGIN", "3600"))
+        self.lock_ms = int(os.getenv("WPP_TOKEN_LOCK_MS", "10000"))
+        self.wait_seconds = float(os.getenv("WPP_TOKEN_WAIT_SECONDS", "10"))
+        self._local: Dict[str, Tuple[str, float]] = {}
+        self._async_locks: Dict[str, asyncio.Lock] = {}
+        self._thread_locks: Dict[str, threading.Lock] = {}
+        self.counters = {"refreshed": 0, "seeded": 0, "waited": 0, "persist_errors": 0}
+
+    @staticmethod
+    def _redis_key(session: str) -> str:
+        return f"wpp:token:{session}"
+
+    def _expires_at(self, token: str) -> float:
+        try:
+            exp = jwt.decode(token, options={"verify_signature": False}).get("exp")
+            if exp:
+                return float(exp)
+        except jwt.PyJWTError:
+            pass
+        return time.time() + self.ttl
+
+    def _fresh(self, expires_at: float) -> bool:
+        return time.time() < expires_at - self.refresh_margin
+
+    def _from_cache(self, session: str) -> Optional[str]:
+        cached = self._local.get(session)
+        if cached and self._fresh(cached[1]):
+            return cached[0]
+        return None
+
+    @staticmethod
+    def _parse(data: dict) -> Tuple[Optional[str], float]:
+        if not data or not data.get("token"):
+            return None, 0.0
+        return data["token"], float(data.get("expires_at", 0))
+
+    def _mapping(self, token: str) -> Tuple[dict, int]:
+        expires_at = self._expires_at(token)
+        return {"token": token, "expires_at": expires_at}, max(1, int(expires_at - time.time()))
+
+    # Decisões compartilhadas pelas versões síncrona e assíncrona (sem I/O)
+
+    def _remember(self, session: str, token: str, expires_at: float) -> str:
+        self._local[session] = (token, expires_at)
+        return token
+
+    def _fresh_from(self, session: str, data: dict) -> Tuple[Optional[str], Optional[str], float]:
+        """
+        A partir do hash do Redis: (token ainda fora da margem de renovação, token atual, expiração).
+        """
+        token, expires_at = self._parse(data)
+        if token and self._fresh(expires_at):
+            return self._remember(session, token, expires_at), token, expires_at
+        return None, token, expires_at
+
+    def _replacement_from(self, session: str, data: dict, stale: Optional[str]) -> Optional[str]:
+        """
+        Token válido que já substituiu o `stale` (renovado por outro processo), se houver.
+        """
+        token, expires_at = self._parse(data)
+        if token and token != stale and time.time() < expires_at:
+            return self._remember(session, token, expires_at)
+        return None
+
+    def _store(self, session: str, token: str, counter: str) -> Tuple[str, dict, int]:
+        """
+        Registra o token no processo e devolve o que gravar no Redis: (chave, hash, TTL).
+        """
+        mapping, ttl = self._mapping(token)
+        self._remember(session, token, mapping["expires_at"])
+        self.counters[counter] += 1
+        return self._redis_key(session), mapping, ttl
+
+    @staticmethod
+    def _usable(token: Optional[str], expires_at: float) -> Optional[str]:
+        return token if token and time.time() < expires_at else None
+
+    @staticmethod
+    def _persists(session: str) -> bool:
+        # A sessão principal não pertence a nenhum usuário.
+        return session != "principal"
+
+    def _wait_timeout(self, session: str) -> TimeoutError:
+        return TimeoutError(f"Tempo esgotado aguardando a renovação do token da sessão {session}.")
+
+    # Versão assíncrona (FastAPI, flows e workers)
+
+    async def get_token(self, session: str, generate: Callable[[], Awaitable[str]], seed: Optional[str] = None) -> str:
+        """
+        Token válido da sessão. `seed` é o token já conhecido (ex.: `users.token_wpp`),
+        usado quando ainda não há nada no Redis.
+        """
+        token = self._from_cache(session)
+        if token:
+            return token
+
+        redis = get_async_redis()
+        fresh, token, expires_at = self._fresh_from(session, await redis.hgetall(self._redis_key(session)))
+        if fresh:
+            return fresh
+
+        if not token and seed:
+            key, mapping, ttl = self._store(session, seed, "seeded")
+            await redis.hset(key, mapping=mapping)
+            await redis.expire(key, ttl)
+            return seed
+
+        # Perto de expirar (ou ausente): renova, mas sem derrubar quem ainda pode usar o atual.
+        return await self.refresh(session, generate, stale=token, usable=self._usable(token, expires_at))
+
+    async def refresh(self, session: str, generate: Callable[[], Awaitable[str]], stale: Optional[str] = None, usable: Optional[str] = None) -> str:
+        """
+        Gera um novo token para a sessão (single-flight). `stale` é o token que
+        falhou; se outro processo já o substituiu, o novo é reaproveitado. O token
+        gerado também é gravado em `users.token_wpp`.
+        """
+        lock = self._async_locks.setdefault(session, asyncio.Lock())
+        async with lock:
+            redis = get_async_redis()
+            key = self._redis_key(session)
+            token = self._replacement_from(session, await redis.hgetall(key), stale)
+            if token:
+                return token
+
+            lock_id = str(uuid.uuid4())
+            if await redis.set(f"{key}:lock", lock_id, nx=True, px=self.lock_ms):
+                try:
+                    token = await generate()
+                    key, mapping, ttl = self._store(session, token, "refreshed")
+                    await redis.hset(key, mapping=mapping)
+                    await redis.expire(key, ttl)
+                finally:
+                    await redis.eval(RELEASE_LOCK_SCRIPT, 1, f"{key}:lock", lock_id)
+                logging.info(f"Token da sessão {session} renovado.")
+                await self.persist(session, token)
+                return token
+
+            if usable:
+                return usable
+
+            # Outro processo está renovando: espera o token novo.
+            self.counters["waited"] += 1
+            deadline = time.monotonic() + self.wait_seconds
+            while time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+                token = self._replacement_from(session, await redis.hgetall(key), stale)
+                if token:
+                    return token
+            raise self._wait_timeout(session)
+
+    async def persist(self, session: str, token: str):
+        """
+        Grava o token renovado no usuário dono da sessão, para que ele não leia o antigo após reiniciar.
+        """
+        if not self._persists(session):
+            return
+        try:
+            await UserRepository().set_wpp_token_by_session(session, token)
+        except Exception as e:
+            self.counters["persist_errors"] += 1
+            logging.error(f"Erro ao gravar o token renovado da sessão {session}: {e}")
+
+    # Versão síncrona (tasks do Celery)
+
+    def get_token_sync(self, session: str, generate: Callable[[], str], seed: Optional[str] = None) -> str:
+        token = self._from_cache(session)
+        if token:
+            return token
+
+        redis = get_sync_redis()
+        fresh, token, expires_at = self._fresh_from(session, redis.hgetall(self._redis_key(session)))
+        if fresh:
+            return fresh
+
+        if not token and seed:
+            key, mapping, ttl = self._store(session, seed, "seeded")
+            redis.hset(key, mapping=mapping)
+            redis.expire(key, ttl)
+            return seed
+
+        return self.refresh_sync(session, generate, stale=token, usable=self._usable(token, expires_at))
+
+    def refresh_sync(self, session: str, generate: Callable[[], str], stale: Optional[str] = None, usable: Optional[str] = None) -> str:
+        lock = self._thread_locks.setdefault(session, threading.Lock())
+        with lock:
+            redis = get_sync_redis()
+            key = self._redis_key(session)
+            token = self._replacement_from(session, redis.hgetall(key), stale)
+            if token:
+                return token
+
+            lock_id = str(uuid.uuid4())
+            if redis.set(f"{key}:lock", lock_id, nx=True, px=self.lock_ms):
+                try:
+                    token = generate()
+                    key, mapping, ttl = self._store(session, token, "refreshed")
+                    redis.hset(key, mapping=mapping)
+                    redis.expire(key, ttl)
+                finally:
+                    redis.eval(RELEASE_LOCK_SCRIPT, 1, f"{key}:lock", lock_id)
+                logging.info(f"Token da sessão {session} renovado.")
+                self.persist_sync(session, token)
+                return token
+
+            if usable:
+                return usable
+
+            self.counters["waited"] += 1
+            deadline = time.monotonic() + self.wait_seconds
+            while time.monotonic() < deadline:
+                time.sleep(0.1)
+                token = self._replacement_from(session, redis.hgetall(key), stale)
+                if token:
+                    return token
+            raise self._wait_timeout(session)
+
+    def persist_sync(self, session: str, token: str):
+        """
+        Versão síncrona do `persist` (tasks do Celery, fora do event loop).
+        """
+        if not self._persists(session):
+            return
+        try:
+            asyncio.run(UserRepository().set_wpp_token_by_session(session, token))
+        except Exception as e:
+            self.counters["persist_errors"] += 1
+            logging.error(f"Erro ao gravar o token renovado da sessão {session}: {e}")
+
+    def stats(self) -> dict:
+        return {**self.counters, "sessions_cached": len(self._local), "pid": os.getpid()}
+
+
+wpp_tokens = WppTokenManager()
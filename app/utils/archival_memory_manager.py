@@ -1,60 +1,233 @@
 import re
 import time
+import asyncio
 import logging
-from app.services.letta_service import get_background_agent_id
+from app.services.letta_service import get_background_agent_id_async
 from app.services.user_service import UserRepository
-from app.utils.celery_imports import lc
+from app.services.letta_router import letta_router
 import pytz
 from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
 brazil_timezone = pytz.timezone("America/Sao_Paulo")
-current_time = datetime.now(brazil_timezone)
 
-async def background_agent_archival_memory_insert(session: str, message: str, origem: str, phone: str = None, name: str = None, is_group: bool = False, group_id: str = None):
+
+class ArchivalMemoryBuffer:
     """
-    Insere uma mensagem na memória arquivística do agente.
+    Buffer de inserções na memória arquivística dos agentes background.
+
+    As mensagens são agrupadas por sessão (um agente background por sessão) e
+    gravadas em lote quando o lote atinge `ARCHIVAL_BATCH_SIZE` mensagens ou
+    quando a mais antiga passa de `ARCHIVAL_FLUSH_SECONDS`. O lote agrupa só o
+    I/O (busca do agente e do cliente do nó): cada mensagem vira uma passagem
+    própria (um embedding por mensagem), gravadas em paralelo pelo cliente
+    assíncrono, no máximo `ARCHIVAL_WRITE_CONCURRENCY` chamadas ao mesmo tempo.
+    Mensagens que falham voltam ao buffer e são tentadas até
+    `ARCHIVAL_MAX_ATTEMPTS` vezes.
+
+    A memória é limitada: no máximo `ARCHIVAL_MAX_PENDING` mensagens aguardando
+    gravação. Quando o Letta fica lento e o limite é atingido, `add` espera por
+    espaço (back-pressure) por até `ARCHIVAL_ENQUEUE_TIMEOUT` segundos e então
+    descarta a mensagem.
+    """
+
+    def __init__(self):
+        self.batch_size = int(os.getenv("ARCHIVAL_BATCH_SIZE", "20"))
+        self.flush_seconds = float(os.getenv("ARCHIVAL_FLUSH_SECONDS", "5"))
+        self.max_pending = int(os.getenv("ARCHIVAL_MAX_PENDING", "5000"))
+        self.enqueue_timeout = float(os.getenv("ARCHIVAL_ENQUEUE_TIMEOUT", "10"))
+        self.max_attempts = int(os.getenv("ARCHIVAL_MAX_ATTEMPTS", "3"))
+        self.agent_cache_ttl = float(os.getenv("ARCHIVAL_AGENT_CACHE_TTL", "300"))
+        self._write_slots = asyncio.Semaphore(int(os.getenv("ARCHIVAL_WRITE_CONCURRENCY", "4")))
+        # Entradas: (texto, tentativas já feitas)
+        self._buffers: Dict[str, List[Tuple[str, int]]] = {}
+        self._first_added_at: Dict[str, float] = {}
+        self._agent_ids: Dict[str, Tuple[str, float]] = {}
+        self._pending = 0
+        self._space = asyncio.Condition()
+        self._flusher: Optional[asyncio.Task] = None
+        self._writes: set = set()
+        self.counters = {"buffered": 0, "written": 0, "batches": 0, "dropped": 0, "retried": 0, "failed": 0}
+
+    def _ensure_started(self):
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def add(self, session: str, text: str) -> bool:
+        """
+        Adiciona uma entrada ao buffer da sessão. Retorna False se a entrada foi
+        descartada por falta de espaço.
+        """
+        self._ensure_started()
+
+        async with self._space:
+            try:
+                await asyncio.wait_for(
+                    self._space.wait_for(lambda: self._pending < self.max_pending),
+                    timeout=self.enqueue_timeout
+                )
+            except asyncio.TimeoutError:
+                self.counters["dropped"] += 1
+                logging.error(f"Buffer da memória arquivística cheio, mensagem da sessão {session} descartada.")
+                return False
+            self._pending += 1
+
+        self._buffer(session, [(text, 0)])
+        self.counters["buffered"] += 1
+
+        if len(self._buffers[session]) >= self.batch_size:
+            self._start_write(session)
+        return True
+
+    def _buffer(self, session: str, items: List[Tuple[str, int]]):
+        self._buffers.setdefault(session, []).extend(items)
+        self._first_added_at.setdefault(session, time.monotonic())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds / 2)
+            now = time.monotonic()
+            for session, first_added_at in list(self._first_added_at.items()):
+                if now - first_added_at >= self.flush_seconds:
+                    self._start_write(session)
+
+    def _start_write(self, session: str):
+        items = self._buffers.pop(session, [])
+        self._first_added_at.pop(session, None)
+        if not items:
+            return
+        task = asyncio.create_task(self._write(session, items))
+        self._writes.add(task)
+        task.add_done_callback(self._writes.discard)
+
+    async def _write(self, session: str, items: List[Tuple[str, int]]):
+        self.counters["batches"] += 1
+        try:
+            agent_id = await self._get_agent_id(session)
+            if not agent_id:
+                raise ValueError(f"Agente background não encontrado para a sessão {session}.")
+            letta = await letta_router.client_for_agent(agent_id)
+            results = await asyncio.gather(
+                *(self._create(letta, agent_id, text) for text, _ in items),
+                return_exceptions=True
+            )
+        except Exception as e:
+            results = [e] * len(items)
+
+        retry, failed, error = [], 0, None
+        for (text, attempts), result in zip(items, results):
+            if not isinstance(result, Exception):
+                self.counters["written"] += 1
+            elif attempts + 1 < self.max_attempts:
+                retry.append((text, attempts + 1))
+            else:
+                failed += 1
+            if isinstance(result, Exception):
+                error = result
+
+        # As que falharam voltam ao buffer (continuam contando em `_pending`) e são
+        # regravadas no próximo flush da sessão.
+        if retry:
+            self.counters["retried"] += len(retry)
+            self._buffer(session, retry)
+            logging.warning(f"{len(retry)} mensagens voltaram ao buffer da memória arquivística (sessão {session}): {error}")
+        if failed:
+            self.counters["failed"] += failed
+            logging.error(f"Erro ao gravar {failed} mensagens na memória arquivística após {self.max_attempts} tentativas (sessão {session}): {error}")
+
+        async with self._space:
+            self._pending -= len(items) - len(retry)
+            self._space.notify_all()
+
+    async def _create(self, letta, agent_id: str, text: str):
+        async with self._write_slots:
+            await letta.agents.archival_memory.create(agent_id=agent_id, text=text)
+
+    async def _get_agent_id(self, session: str) -> Optional[str]:
+        cached = self._agent_ids.get(session)
+        if cached and time.monotonic() - cached[1] < self.agent_cache_ttl:
+            return cached[0]
+
+        user = await get_user_by_session(session)
+        if not user:
+            return None
+        agent_id = user.id_background_agent or await get_background_agent_id_async(user.phone)
+        if agent_id:
+            self._agent_ids[session] = (agent_id, time.monotonic())
+        return agent_id
+
+    async def close(self):
+        """
+        Grava tudo o que estiver no buffer e encerra o flusher (shutdown).
+        """
+        if self._flusher:
+            self._flusher.cancel()
+            self._flusher = None
+        # Grava até esvaziar o buffer (as que falham voltam a ele até `max_attempts`).
+        while self._buffers or self._writes:
+            for session in list(self._buffers):
+                self._start_write(session)
+            await asyncio.gather(*self._writes, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "pending": self._pending,
+            "sessions_buffered": len(self._buffers),
+            "max_pending": self.max_pending,
+        }
+
+
+archival_buffer = ArchivalMemoryBuffer()
+
+
+def format_archival_entry(message: str, origem: str, phone: str = None, name: str = None, is_group: bool = False, group_id: str = None, timestamp: float = None) -> str:
     """
-    
-    user = await get_user_by_session(session)
-    agent_id = get_background_agent_id(user.phone)
-    
+    Formata a mensagem como entrada da memória arquivística.
+    """
+    sent_at = datetime.fromtimestamp(timestamp, brazil_timezone) if timestamp else datetime.now(brazil_timezone)
+
     text = f"""\
 - Mensagem:         {message}
-- Data:             {current_time.strftime("%d/%m/%Y %H:%M:%S")}
+- Data:             {sent_at.strftime("%d/%m/%Y %H:%M:%S")}
 - Origem:           {origem}
 """
 
     if origem == "WhatsApp":
-      text += f"""\
+        text += f"""\
 - Contato:          {name if name else "Desconhecido"}
 - Número do contato: {phone if phone else "Desconhecido"}
 """
 
     if is_group:
-      text += f"""\
+        text += f"""\
 - Grupo ID:          {group_id}
 """
-    
-    try:
-        if phone != os.getenv("MAIN_WHATSAPP_NUMBER"):
-          lc.agents.archival_memory.create(agent_id=agent_id, text=text)
+    return text
 
-    except Exception as e:
-        logging.error(f"Erro ao enviar mensagem ao agente {agent_id}: {e}")
+
+async def background_agent_archival_memory_insert(session: str, message: str, origem: str, phone: str = None, name: str = None, is_group: bool = False, group_id: str = None, timestamp: float = None):
+    """
+    Insere uma mensagem na memória arquivística do agente.
+    A gravação é feita em lote pelo `archival_buffer`.
+    """
+    if phone == os.getenv("MAIN_WHATSAPP_NUMBER"):
+        return False
+
+    text = format_archival_entry(message, origem, phone, name, is_group, group_id, timestamp)
+    return await archival_buffer.add(session, text)
 
 
 async def get_user_by_session(session: str):
   """
-  Retorna o usuário a partir da sessão informada. 
+  Retorna o usuário a partir da sessão informada.
   """
-  
+
   numero = re.search(r'\d+', session).group()
   user_repo = UserRepository()
   user = await user_repo.get_user_by_phone(phone=numero)
   return user
-
-  
\ No newline at end of file
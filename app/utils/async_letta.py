@@ -0,0 +1,55 @@
+import os
+from typing import Dict, Optional, Tuple
+
+import httpx
+from dotenv import load_dotenv
+from letta_client import AsyncLetta
+
+from app.services.session_router import parse_nodes
+
+load_dotenv()
+
+# Pool de conexões do cliente assíncrono. O cliente síncrono (`lc`, em celery_imports)
+# fica restrito às tasks do Celery: no event loop, use sempre `get_async_letta()`.
+LETTA_HTTP_POOL_SIZE = int(os.getenv("LETTA_HTTP_POOL_SIZE", "20"))
+LETTA_HTTP_TIMEOUT = float(os.getenv("LETTA_HTTP_TIMEOUT", "60"))
+LETTA_HTTP_CONNECT_TIMEOUT = float(os.getenv("LETTA_HTTP_CONNECT_TIMEOUT", "5"))
+
+# Servidores Letta ("nome=url,nome=url"). Sem `LETTA_NODES`, o único nó é "default",
+# em `LETTA_AI_API_URL`. Os agentes existentes antes da divisão ficam em `LETTA_DEFAULT_NODE`.
+LETTA_NODES = parse_nodes(os.getenv("LETTA_NODES"), os.getenv("LETTA_AI_API_URL"))
+DEFAULT_LETTA_NODE = os.getenv("LETTA_DEFAULT_NODE") or next(iter(LETTA_NODES), None)
+
+# Nó → (cliente, pool de conexões); um pool por nó.
+_async_clients: Dict[str, Tuple[AsyncLetta, httpx.AsyncClient]] = {}
+
+
+def letta_node_url(node: Optional[str] = None) -> Optional[str]:
+    return LETTA_NODES.get(node or DEFAULT_LETTA_NODE)
+
+
+def get_async_letta(node: Optional[str] = None) -> AsyncLetta:
+    """
+    Cliente Letta assíncrono do nó (padrão: `DEFAULT_LETTA_NODE`), compartilhado
+    pelo processo (FastAPI, flows e workers). O pool de conexões é criado na
+    primeira chamada. Para os agentes de um usuário, use o `letta_router`.
+    """
+    node = node or DEFAULT_LETTA_NODE
+    client = _async_clients.get(node)
+    if client is None or client[1].is_closed:
+        http_client = httpx.AsyncClient(
+            headers={"x-bare-password": os.getenv("LETTA_AI_API_PASSWORD") or ""},
+            timeout=httpx.Timeout(LETTA_HTTP_TIMEOUT, connect=LETTA_HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=LETTA_HTTP_POOL_SIZE, max_keepalive_connections=LETTA_HTTP_POOL_SIZE),
+        )
+        client = _async_clients[node] = (AsyncLetta(base_url=letta_node_url(node), httpx_client=http_client), http_client)
+    return client[0]
+
+
+async def close_async_letta():
+    """
+    Fecha os pools dos clientes assíncronos, se existirem (shutdown).
+    """
+    for _, http_client in list(_async_clients.values()):
+        await http_client.aclose()
+    _async_clients.clear()
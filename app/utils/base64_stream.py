@@ -0,0 +1,168 @@
+import os
+import re
+import json
+import mmap
+import uuid
+import base64
+import asyncio
+from typing import AsyncIterator, Callable, Iterator, Optional
+
+# Campo com o conteúdo da mídia na resposta do `download-media` do WPPConnect.
+FIELD_PATTERN = re.compile(rb'"(base64|data)"\s*:\s*"')
+DATA_URL_PREFIX = b"data:"
+
+
+class Base64JsonFieldDecoder:
+    """
+    Extrai e decodifica em streaming o campo base64 de uma resposta JSON, sem
+    carregar o corpo inteiro na memória.
+
+    Os pedaços do corpo são passados para `feed`. Os bytes fora do campo base64
+    (o "esqueleto" do JSON, pequeno) são acumulados e lidos em `close`; o
+    conteúdo do campo é decodificado em blocos múltiplos de 4 caracteres e
+    entregue para `write`. Aceita o valor com prefixo data URL
+    (`data:<mimetype>;base64,`), cujo mimetype fica em `self.mimetype`.
+    """
+
+    def __init__(self, write: Callable[[bytes], None], max_skeleton_bytes: int = 64 * 1024):
+        self.write = write
+        self.max_skeleton_bytes = max_skeleton_bytes
+        self.skeleton = bytearray()
+        self.mimetype: Optional[str] = None
+        self.decoded_bytes = 0
+        self._in_payload = False
+        self._found = False
+        self._prefix: Optional[bytearray] = None
+        self._pending = b""
+
+    def feed(self, chunk: bytes):
+        while chunk:
+            if not self._in_payload:
+                start = len(self.skeleton)
+                self.skeleton += chunk
+                chunk = b""
+                if not self._found:
+                    match = FIELD_PATTERN.search(self.skeleton, max(0, start - 32))
+                    if match:
+                        chunk = bytes(self.skeleton[match.end():])
+                        del self.skeleton[match.end():]
+                        self._found = self._in_payload = True
+                        self._prefix = bytearray()
+                if len(self.skeleton) > self.max_skeleton_bytes:
+                    raise ValueError("Resposta sem campo base64 ou com metadados grandes demais.")
+                continue
+
+            # Dentro do valor: base64 não tem aspas, então a primeira aspa fecha o campo.
+            end = chunk.find(b'"')
+            data, chunk = (chunk, b"") if end < 0 else (chunk[:end], chunk[end:])
+            self._decode(data)
+            if end >= 0:
+                self._flush()
+                self._in_payload = False
+
+    def _decode(self, data: bytes):
+        # O JSON pode escapar "/" como "\/".
+        if b"\\" in data:
+            data = data.replace(b"\\", b"")
+
+        if self._prefix is not None:
+            self._prefix += data
+            prefix = bytes(self._prefix)
+            if len(prefix) < len(DATA_URL_PREFIX) and DATA_URL_PREFIX.startswith(prefix):
+                return
+            if prefix.startswith(DATA_URL_PREFIX):
+                comma = prefix.find(b",")
+                if comma < 0:
+                    if len(prefix) > 256:
+                        raise ValueError("Prefixo data URL inválido.")
+                    return
+                self.mimetype = prefix[len(DATA_URL_PREFIX):comma].split(b";")[0].decode() or None
+                prefix = prefix[comma + 1:]
+            self._prefix = None
+            data = prefix
+
+        buffer = self._pending + data
+        usable = len(buffer) - len(buffer) % 4
+        self._pending = buffer[usable:]
+        if usable:
+            decoded = base64.b64decode(buffer[:usable])
+            self.decoded_bytes += len(decoded)
+            self.write(decoded)
+
+    def _flush(self):
+        if self._prefix is not None:
+            # Valor curto demais para ter prefixo data URL: é base64 puro.
+            self._pending += bytes(self._prefix)
+            self._prefix = None
+        if self._pending:
+            decoded = base64.b64decode(self._pending + b"=" * (-len(self._pending) % 4))
+            self._pending = b""
+            self.decoded_bytes += len(decoded)
+            self.write(decoded)
+
+    def close(self) -> dict:
+        """
+        Finaliza a leitura e retorna os demais campos do JSON (o campo base64 vem vazio).
+        """
+        if self._in_payload:
+            raise ValueError("Resposta truncada no meio do campo base64.")
+        if not self._found:
+            raise ValueError("Resposta sem campo base64.")
+        return json.loads(bytes(self.skeleton))
+
+
+def iter_file_base64(path: str, chunk_size: int = 768 * 1024, mime_lines: bool = False) -> Iterator[bytes]:
+    """
+    Codifica o arquivo em base64 em blocos, lendo-o via mmap (sem carregá-lo
+    inteiro na memória). Com `mime_lines`, gera linhas de 76 caracteres (anexos de e-mail).
+    """
+    block = 57 * max(1, chunk_size // 57) if mime_lines else 3 * max(1, chunk_size // 3)
+    encode = base64.encodebytes if mime_lines else base64.b64encode
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if not size:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+            for offset in range(0, size, block):
+                with view[offset:offset + block] as piece:
+                    yield encode(piece)
+
+
+class Base64JsonBody:
+    """
+    Corpo JSON de uma requisição com um campo base64 gerado em streaming a partir
+    de um arquivo em disco. O tamanho é conhecido de antemão (Content-Length), e
+    o corpo pode ser iterado mais de uma vez (repetição após um 401).
+
+    Use a instância como iterável no `requests` e `aiter()` no `httpx.AsyncClient`.
+    """
+
+    def __init__(self, path: str, fields: dict, field: str, mimetype: Optional[str] = None, chunk_size: int = 768 * 1024):
+        self.path = path
+        self.chunk_size = chunk_size
+        placeholder = uuid.uuid4().hex
+        prefix, suffix = json.dumps({**fields, field: placeholder}).encode().split(placeholder.encode())
+        if mimetype:
+            prefix += f"data:{mimetype};base64,".encode()
+        self.prefix, self.suffix = prefix, suffix
+        size = os.path.getsize(path)
+        self.length = len(prefix) + 4 * ((size + 2) // 3) + len(suffix)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield self.prefix
+        yield from iter_file_base64(self.path, self.chunk_size)
+        yield self.suffix
+
+    async def aiter(self) -> AsyncIterator[bytes]:
+        chunks = iter(self)
+        try:
+            while True:
+                chunk = await asyncio.to_thread(next, chunks, None)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            chunks.close()
@@ -1,12 +1,12 @@
 import os
-import re
-import logging
+from typing import Dict, Optional
+
 from dotenv import load_dotenv
 from httpx import Client
 from letta_client import Letta, MessageCreate, AssistantMessage
 
 from app.services.user_service import UserRepository
-from app.services.whatsapp_service import WhatsAppService
+from app.utils.async_letta import DEFAULT_LETTA_NODE, letta_node_url
 
 # Carregar variáveis de ambiente
 load_dotenv()
@@ -14,38 +14,23 @@ load_dotenv()
 # Inicializar o cliente HTTPX personalizado
 custom_httpx_client = Client(headers={"x-bare-password": os.getenv("LETTA_AI_API_PASSWORD")})
 
-# Inicializar o cliente Letta
-lc = Letta(
-    base_url=os.getenv("LETTA_AI_API_URL"),
-    httpx_client=custom_httpx_client,
-)
-
-# Inicializar repositórios e serviços
-user_repo = UserRepository()
+# Clientes Letta síncronos por nó (`LETTA_NODES`)
+_clients: Dict[str, Letta] = {}
 
-wpp = WhatsAppService(session_name="principal", token=os.getenv("PRINCIPAL_WPP_SESSION_TOKEN"))
 
-def get_phone_tag(agent_id: str) -> str:
-    """
-    Recupera o número de telefone associado a um agente com base nas tags.
-    """
-    try:
-        agent = lc.agents.retrieve(agent_id)
-        tags = agent.tags
-        for tag in tags:
-            if re.search(r'\d+', tag):
-                return tag
-    except Exception as e:
-        logging.error(f"Erro ao recuperar agente {agent_id}: {e}")
-    return ""
-
-def get_agent_tags(agent_id: str) -> list:
+def get_letta(node: Optional[str] = None) -> Letta:
     """
-    Recupera as tags de um agente.
+    Cliente Letta síncrono do nó (padrão: `DEFAULT_LETTA_NODE`). Para os agentes
+    de um usuário, use `letta_router.client_for_agent_sync`.
     """
-    try:
-        agent = lc.agents.retrieve(agent_id)
-        return agent.tags
-    except Exception as e:
-        logging.error(f"Erro ao recuperar agente {agent_id}: {e}")
-    return []
+    node = node or DEFAULT_LETTA_NODE
+    if node not in _clients:
+        _clients[node] = Letta(base_url=letta_node_url(node), httpx_client=custom_httpx_client)
+    return _clients[node]
+
+
+# Inicializar o cliente Letta (nó padrão)
+lc = get_letta()
+
+# Inicializar repositórios e serviços
+user_repo = UserRepository()
@@ -0,0 +1,58 @@
+import bisect
+import hashlib
+from typing import Dict, Iterable, List, Optional
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Anel de hash consistente com nós virtuais. Adicionar ou remover um nó só
+    move as chaves que caíam nele (cerca de 1/N do total).
+
+    `weights` permite dar mais nós virtuais (e, portanto, mais chaves) a um nó.
+    """
+
+    def __init__(self, nodes: Iterable[str] = (), vnodes: int = 160, weights: Optional[Dict[str, float]] = None):
+        self.vnodes = vnodes
+        self.weights = weights or {}
+        self._ring: List[int] = []
+        self._owners: List[str] = []
+        self.nodes: List[str] = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node: str):
+        if node in self.nodes:
+            return
+        self.nodes.append(node)
+        for i in range(max(1, int(self.vnodes * self.weights.get(node, 1)))):
+            point = _hash(f"{node}#{i}")
+            index = bisect.bisect(self._ring, point)
+            self._ring.insert(index, point)
+            self._owners.insert(index, node)
+
+    def remove(self, node: str):
+        if node not in self.nodes:
+            return
+        self.nodes.remove(node)
+        kept = [(point, owner) for point, owner in zip(self._ring, self._owners) if owner != node]
+        self._ring = [point for point, _ in kept]
+        self._owners = [owner for _, owner in kept]
+
+    def node_for(self, key: str, exclude: Iterable[str] = ()) -> Optional[str]:
+        """
+        Nó responsável pela chave. Os nós em `exclude` (ex.: em drenagem) são
+        pulados, e a chave vai para o próximo nó do anel.
+        """
+        exclude = set(exclude)
+        if not self._ring or exclude.issuperset(self.nodes):
+            return None
+        index = bisect.bisect(self._ring, _hash(key)) % len(self._ring)
+        for offset in range(len(self._ring)):
+            owner = self._owners[(index + offset) % len(self._ring)]
+            if owner not in exclude:
+                return owner
+        return None
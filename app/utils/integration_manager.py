@@ -1,8 +1,8 @@
-import asyncio
 import re
 from app.schemas.user import UserBase
-from app.services.letta_service import get_onboarding_agent_id, send_user_message_to_agent
+from app.services.letta_service import get_onboarding_agent_id_async, send_user_message_to_agent
 from app.services.user_service import UserRepository
+from app.services.session_health import DEAD, session_health
 
 
 async def whatsapp_session_status_manager(session: str, status: str):
@@ -15,8 +15,8 @@ async def whatsapp_session_status_manager(session: str, status: str):
     user_repo = UserRepository()
     if status == "desconnectedMobile" and user.whatsapp_integration == True:
       await user_repo.update_user_by_id(user.id, UserBase(whatsapp_integration=False))
-      onboarding_agent_id = get_onboarding_agent_id(user.phone)
-      await asyncio.sleep(2)
+      await session_health.mark(session, user.id, user.phone, DEAD, detail=status)
+      onboarding_agent_id = await get_onboarding_agent_id_async(user.phone)
       send_user_message_to_agent(onboarding_agent_id, "SYSTEM MESSAGE: A integração com o WhatsApp do usuário falhou, pergunte-o se ele deseja integrar novamente.")
       done = True
   except Exception as e:
@@ -0,0 +1,65 @@
+import os
+from typing import Optional
+
+import redis
+import redis.asyncio as aioredis
+from dotenv import load_dotenv
+
+load_dotenv()
+
+_async_client: Optional[aioredis.Redis] = None
+_sync_client: Optional[redis.Redis] = None
+
+
+def construct_redis_url() -> str:
+    """
+    Constrói a URL de conexão com o Redis com base nas variáveis de ambiente.
+    """
+    host = os.getenv("REDIS_HOST", "localhost")
+    port = os.getenv("REDIS_PORT", "6379")
+    db = os.getenv("REDIS_DB", "0")
+    password = os.getenv("REDIS_PASSWORD", "")
+
+    if password:
+        return f"redis://:{password}@{host}:{port}/{db}"
+    else:
+        return f"redis://{host}:{port}/{db}"
+
+
+def get_async_redis() -> aioredis.Redis:
+    """
+    Retorna o cliente assíncrono do Redis compartilhado pelo processo.
+    O pool de conexões é criado na primeira chamada.
+    """
+    global _async_client
+    if _async_client is None:
+        _async_client = aioredis.from_url(
+            url=construct_redis_url(),
+            encoding="utf-8",
+            decode_responses=True
+        )
+    return _async_client
+
+
+def get_sync_redis() -> redis.Redis:
+    """
+    Retorna o cliente síncrono do Redis compartilhado pelo processo (uso nas tasks do Celery).
+    """
+    global _sync_client
+    if _sync_client is None:
+        _sync_client = redis.Redis.from_url(
+            url=construct_redis_url(),
+            encoding="utf-8",
+            decode_responses=True
+        )
+    return _sync_client
+
+
+async def close_async_redis():
+    """
+    Fecha o pool de conexões assíncrono do processo, se existir.
+    """
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
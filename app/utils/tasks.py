@@ -1,15 +1,16 @@
-import time
 import logging
 from celery import shared_task
 import os
-from letta_client import MessageCreate, AssistantMessage, ToolCallMessage
-from app.utils.celery_imports import lc, get_phone_tag, get_agent_tags
-from app.services.whatsapp_service import WhatsAppService
+from letta_client import MessageCreate
+from app.services.agent_directory import agent_directory
+from app.services.agent_mailbox import agent_mailbox
+from app.services.letta_router import letta_router
+from app.services.outbound_queue import queued_wpp
+from app.services.reply_streamer import ERROR_MESSAGE, reply_streamer
+from app.services.run_poller import run_poller
+from app.services.message_coalescer import MessageCoalescer
 import redis
 
-# Inicializar WhatsAppService
-wpp = WhatsAppService(session_name="principal", token=os.getenv("PRINCIPAL_WPP_SESSION_TOKEN"))
-
 # Configurar conexão com Redis usando redis-py (cliente síncrono)
 redis_client = redis.Redis(
     host=os.getenv("REDIS_HOST", "localhost"),
@@ -19,123 +20,126 @@ redis_client = redis.Redis(
     decode_responses=True  # Decodifica automaticamente as respostas para strings
 )
 
+coalescer = MessageCoalescer()
+
 @shared_task
-def send_message_task(agent_id: str, message: str):
+def send_message_task(agent_id: str, message: str, lease: str = None, attempt: int = 1):
     """
-    Tarefa Celery para enviar mensagem ao agente e iniciar o monitoramento da execução.
+    Tarefa Celery para enviar mensagem ao agente e entregar a resposta ao usuário.
+    Com `AGENT_MAILBOX_ENABLED`, o agente processa uma run de cada vez (`agent_mailbox`):
+    se ele já está ocupado, a mensagem aguarda e segue, unida às outras que chegarem,
+    quando a run atual terminar, em uma nova task com a mesma vez (`lease`).
+    Um envio que falha é refeito com a mesma mensagem, até `RUN_MAX_ATTEMPTS` tentativas.
     """
-    try:
-        response = lc.agents.messages.create_async(
-            agent_id=agent_id,
-            messages=[
-                MessageCreate(
-                    role="user",
-                    content=message,
-                )
-            ],
-        )
-
-        if not response.id:
-            logging.error("A resposta da API não contém um 'response.id'.")
-            phone = get_phone_tag(agent_id)
-            if phone:
-                wpp.send_message(phone, "Erro ao processar a mensagem: ID da resposta não encontrado.")
+    if lease and not agent_mailbox.renew(agent_id, lease):
+        # A vez expirou antes desta task: a mensagem volta para a caixa.
+        lease = None
+    if not lease and agent_mailbox.enabled:
+        lease, message = agent_mailbox.submit(agent_id, message)
+        if not lease:
             return
 
-        run_id = response.id
-        phone = get_phone_tag(agent_id)
+    try:
+        if deliver_message(agent_id, message, lease):
+            # O worker de runs entrega a resposta e passa a vez adiante no fim da run.
+            return
+    except Exception as e:
+        logging.error(f"Erro ao enviar mensagem ao agente {agent_id} (tentativa {attempt}): {e}")
+        if attempt < run_poller.max_attempts:
+            send_message_task.apply_async(
+                (agent_id, message),
+                {"lease": lease, "attempt": attempt + 1},
+                countdown=agent_mailbox.retry_delay * attempt,
+            )
+            return
+        phone = agent_directory.agent_info(agent_id).get("phone")
+        if phone:
+            queued_wpp.send_message(phone, ERROR_MESSAGE)
 
-        # Armazenar run_id e phone no Redis
-        redis_key = f"run:{run_id}"
-        redis_client.set(redis_key, phone, ex=3600)  # Expira em 1 hora
+    if lease:
+        pass_turn(agent_id, lease)
 
-        # Inicia a verificação do status da execução, com tentativa inicial 1.
-        check_run_status_task.delay(run_id, agent_id, timeout=30, poll_interval=1, attempt=1)
+def pass_turn(agent_id: str, lease: str):
+    """
+    Fim da run com a vez do agente: as mensagens que aguardavam seguem, unidas,
+    para uma nova task com a mesma vez (sem ocupar esta), ou o agente é liberado.
+    """
+    message = agent_mailbox.complete(agent_id, lease)
+    if message:
+        send_message_task.delay(agent_id, message, lease=lease)
 
-    except Exception as e:
-        logging.error(f"Erro ao enviar mensagem ao agente {agent_id}: {e}")
+def deliver_message(agent_id: str, message: str, lease: str = None) -> bool:
+    """
+    Envia a mensagem ao agente. Com `LETTA_STREAMING_ENABLED`, a resposta é entregue em
+    streaming (`reply_streamer`); se o stream não puder ser aberto, a execução é criada e
+    acompanhada pelo `run_poller`. Retorna True se a run ficou com o `run_poller`;
+    erros ao criar a execução são propagados para a task refazer o envio.
+    """
+    if reply_streamer.enabled:
+        info = agent_directory.agent_info(agent_id)
+        if info.get("phone"):
+            with agent_mailbox.heartbeat(agent_id, lease):
+                if reply_streamer.stream_reply(agent_id, message, info["phone"], info.get("role")):
+                    return False
+
+    response = letta_router.client_for_agent_sync(agent_id).agents.messages.create_async(
+        agent_id=agent_id,
+        messages=[
+            MessageCreate(
+                role="user",
+                content=message,
+            )
+        ],
+    )
+
+    phone = agent_directory.agent_info(agent_id).get("phone")
+    if not response.id:
+        logging.error("A resposta da API não contém um 'response.id'.")
+        if phone:
+            queued_wpp.send_message(phone, "Erro ao processar a mensagem: ID da resposta não encontrado.")
+        return False
+
+    # A run é acompanhada pelo worker de runs (`run_poller`), não por esta task.
+    run_poller.track(response.id, agent_id, phone, message, lease=lease)
+    return True
 
 @shared_task
-def check_run_status_task(run_id: str, agent_id: str, timeout: int = 30, poll_interval: int = 1, attempt: int = 1):
+def flush_coalesced_messages_task(phone: str, generation: int = None):
     """
-    Tarefa Celery para verificar o status da execução e enviar a resposta ao usuário.
-    Em caso de timeout, envia uma mensagem informando que a solicitação está demorando,
-    mas continua aguardando a finalização da execução original.
-    Para status 'failed', tenta novamente até 4 vezes.
+    Tarefa Celery que envia ao agente, como uma única mensagem, o lote de mensagens
+    acumulado para o usuário. Sem `generation`, envia imediatamente (lote cheio);
+    com `generation`, só envia se nenhuma mensagem nova chegou desde o agendamento.
     """
-    max_attempts = 4
-    timeout_notified = False
-
     try:
-        start_time = time.time()
-        phone = redis_client.get(f"run:{run_id}")  # Recupera o telefone do usuário
-
-        if not phone:
-            logging.error(f"Telefone do usuário não encontrado para run_id {run_id}.")
-            return
-
-        while True:
-            run = lc.runs.retrieve_run(run_id)
-            if run.status in ["completed", "failed"]:
-                break
-
-            # Se o tempo exceder o timeout e o usuário ainda não foi notificado, envia mensagem informativa
-            if time.time() - start_time > timeout and not timeout_notified:
-                wpp.send_message(
-                    phone,
-                    "Sua solicitação está demorando mais que o normal, estamos aguardando a finalização."
-                )
-                timeout_notified = True
-
-            time.sleep(poll_interval)
-
-        # Se a run falhou, tenta novamente (até o máximo de tentativas)
-        if run.status == "failed":
-            if attempt < max_attempts:
-                wpp.send_message(
-                    phone,
-                    f"A execução falhou. Tentando novamente (tentativa {attempt + 1}/{max_attempts})."
-                )
-                check_run_status_task.delay(run_id, agent_id, timeout, poll_interval, attempt + 1)
-            else:
-                logging.error(f"Execução final falhou para o agente {agent_id} após {attempt} tentativas.")
-                wpp.send_message(phone, "Erro ao processar a solicitação. Por favor, tente novamente mais tarde.")
+        batch = coalescer.pop_batch(redis_client, phone, generation)
+        if not batch:
             return
 
-        # Se a run foi completada, obtém as mensagens da execução
-        messages = lc.runs.list_run_messages(run_id)
-        assistant_message = next(
-            (msg.content for msg in messages if isinstance(msg, AssistantMessage)),
-            None
-        )
-
-        send_message = True
+        agent_id, items = batch
+        send_message_task(agent_id, coalescer.merge_messages(items))
 
-        tool_called = next(
-            (msg.tool_call.name for msg in messages if isinstance(msg, ToolCallMessage)),
-            None
-        )
-
-        if tool_called:
-            flagged_tools = any([
-                "start_whatsapp_integration" in tool_called,
-                "start_google_integration" in tool_called,
-                "verify_integrations_status" in tool_called,
-            ])
-            if flagged_tools:
-                send_message = False
-
-        agent_tags = get_agent_tags(agent_id)
-        if "background" in agent_tags:
-            send_message = False
-
-        if assistant_message:
-            if send_message:
-                wpp.send_message(phone, assistant_message)
-        else:
-            logging.error(f"A resposta do agente {agent_id} não contém 'assistant_message'. Estrutura: {messages}")
+    except Exception as e:
+        logging.error(f"Erro ao enviar lote de mensagens do usuário {phone}: {e}")
 
-        redis_client.delete(f"run:{run_id}")
+@shared_task
+def notify_agents_task(agent_ids: list, message: str):
+    """
+    Tarefa Celery que envia a mesma mensagem de sistema a um lote de agentes
+    (ex.: avisos do monitor de sessões do WhatsApp), uma task por agente, para
+    que um agente ocupado (ou uma resposta longa em streaming) não atrase os demais.
+    """
+    for agent_id in agent_ids:
+        send_message_task.delay(agent_id, message)
 
-    except Exception as e:
-        logging.error(f"Erro ao verificar o status da run {run_id} para o agente {agent_id}: {e}")
+@shared_task
+def check_run_status_task(run_id: str, agent_id: str, timeout: int = 30, poll_interval: int = 1, attempt: int = 1):
+    """
+    Mantida para as tasks já enfileiradas antes do `run_poller`: passa a run para o worker de runs.
+    Sem a mensagem original, uma falha dessa run não é refeita.
+    """
+    phone = redis_client.get(f"run:{run_id}")
+    if not phone:
+        logging.error(f"Telefone do usuário não encontrado para run_id {run_id}.")
+        return
+    run_poller.track(run_id, agent_id, phone, attempt=attempt)
+    redis_client.delete(f"run:{run_id}")
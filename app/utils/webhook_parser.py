@@ -0,0 +1,114 @@
+import os
+import re
+from typing import Optional
+
+import msgspec
+from dotenv import load_dotenv
+from fastapi import Request
+
+from app.schemas.webhook_event import EventHeader, OnMessageEvent, QrCodeEvent, StatusFindEvent
+
+load_dotenv()
+
+MAX_BODY_BYTES = int(os.getenv("WEBHOOK_MAX_BODY_BYTES", str(1024 * 1024)))
+# Bytes do início e do fim de um corpo acima do limite guardados para identificar o evento.
+PEEK_BYTES = int(os.getenv("WEBHOOK_PEEK_BYTES", str(64 * 1024)))
+HEADER_FIELD = re.compile(rb'"(event|type|session)"\s*:\s*"([^"\\]{1,64})"')
+PROCESSED_EVENTS = {"onmessage", "status-find", "qrcode"}
+PROCESSED_MESSAGE_TYPES = {"chat"}
+# Mídias passam pelo pipeline de download apenas nas sessões pessoais (memória arquivística).
+MEDIA_MESSAGE_TYPES = {"image", "video", "audio", "ptt", "document"}
+MEDIA_PIPELINE_ENABLED = os.getenv("MEDIA_PIPELINE_ENABLED", "true").lower() == "true"
+
+# Decoders pré-compilados: o do cabeçalho ignora os demais campos sem materializá-los.
+header_decoder = msgspec.json.Decoder(EventHeader)
+event_decoders = {
+    "onmessage": msgspec.json.Decoder(OnMessageEvent),
+    "status-find": msgspec.json.Decoder(StatusFindEvent),
+    "qrcode": msgspec.json.Decoder(QrCodeEvent),
+}
+
+
+class PayloadTooLarge(Exception):
+    def __init__(self, message: str, header: Optional[EventHeader] = None):
+        super().__init__(message)
+        # Cabeçalho extraído do início/fim do corpo (None se não foi possível identificar o evento).
+        self.header = header
+
+
+def peek_header(*parts: bytes) -> Optional[EventHeader]:
+    """
+    Procura `event`, `type` e `session` em trechos de um JSON incompleto (a primeira
+    ocorrência de cada campo vale). Retorna None se `event` não for encontrado.
+    """
+    fields = {}
+    for part in parts:
+        for match in HEADER_FIELD.finditer(part):
+            fields.setdefault(match.group(1).decode(), match.group(2).decode())
+    if "event" not in fields:
+        return None
+    return EventHeader(**fields)
+
+
+async def read_body_capped(request: Request, max_bytes: int = MAX_BODY_BYTES) -> bytes:
+    """
+    Lê o corpo da requisição em streaming. Acima de `max_bytes`, o restante é lido e
+    descartado, guardando só o início e o fim para identificar o evento (PayloadTooLarge.header).
+    """
+    content_length = request.headers.get("content-length")
+    oversized = bool(content_length and content_length.isdigit() and int(content_length) > max_bytes)
+
+    body = bytearray()
+    tail = b""
+    async for chunk in request.stream():
+        if not oversized:
+            body.extend(chunk)
+            oversized = len(body) > max_bytes
+            if oversized:
+                tail = bytes(body[-PEEK_BYTES:])
+                del body[PEEK_BYTES:]
+            continue
+        if len(body) < PEEK_BYTES:
+            body.extend(chunk[:PEEK_BYTES - len(body)])
+        tail = (tail + chunk)[-PEEK_BYTES:]
+
+    if oversized:
+        raise PayloadTooLarge(f"Corpo excede o limite de {max_bytes} bytes.", peek_header(bytes(body), tail))
+    return bytes(body)
+
+
+def decode_header(body: bytes) -> EventHeader:
+    """
+    Extrai `event`, `type` e `session` do corpo. Levanta msgspec.DecodeError se o JSON for inválido.
+    """
+    return header_decoder.decode(body)
+
+
+def is_ignorable(header: EventHeader) -> bool:
+    """
+    Indica se o evento pode ser descartado sem o decode completo.
+    """
+    if header.event not in PROCESSED_EVENTS:
+        return True
+    if header.event == "onmessage" and header.type not in PROCESSED_MESSAGE_TYPES:
+        return not is_pipeline_media(header.type, header.session)
+    return False
+
+
+def is_pipeline_media(msg_type: Optional[str], session: Optional[str]) -> bool:
+    """
+    Indica se a mensagem é uma mídia a ser baixada pelo pipeline de mídia.
+    """
+    return MEDIA_PIPELINE_ENABLED and msg_type in MEDIA_MESSAGE_TYPES and session != "principal"
+
+
+def decode_event(body: bytes, event: str) -> Optional[dict]:
+    """
+    Decodifica e valida o evento com o modelo tipado correspondente e retorna o
+    payload como dict (mesmo formato usado pelo WebhookService).
+    Levanta msgspec.ValidationError se o payload não corresponder ao modelo.
+    """
+    decoder = event_decoders.get(event)
+    if not decoder:
+        return None
+    return msgspec.to_builtins(decoder.decode(body))
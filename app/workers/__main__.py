@@ -0,0 +1,55 @@
+import signal
+import asyncio
+import logging
+
+from app.workers.webhook_consumer import run_webhook_consumers
+from app.workers.deferred_events import run_deferred_events
+from app.workers.outbound_sender import run_outbound_sender
+from app.workers.session_health import run_session_health
+from app.workers.connection_watches import run_connection_watches
+from app.workers.run_poller import run_run_poller
+from app.workers.agent_mailbox import run_agent_mailbox
+from app.workers.agent_pool import run_agent_pool
+from app.workers.agent_reconciler import run_agent_reconciler
+from app.workers.letta_migrations import run_letta_migrations
+from app.workers.media import run_media
+from app.utils.archival_memory_manager import archival_buffer
+from app.services.whatsapp_service import close_async_http_client
+from app.utils.async_letta import close_async_letta
+from app.services.media_pipeline import media_pipeline
+
+logging.basicConfig(level=logging.INFO)
+
+
+async def main():
+    """
+    Processo de workers assíncronos (consumidores do webhook, eventos adiados, fila de envio,
+    monitor de sessões do WhatsApp, esperas de conexão do WhatsApp, acompanhamento das runs do Letta, caixa dos agentes, reposição do pool de agentes, reconciliação e migração dos agentes, downloads e retenção das mídias).
+    Uso: python -m app.workers
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await asyncio.gather(
+        run_webhook_consumers(stop_event),
+        run_deferred_events(stop_event),
+        run_outbound_sender(stop_event),
+        run_session_health(stop_event),
+        run_connection_watches(stop_event),
+        run_run_poller(stop_event),
+        run_agent_mailbox(stop_event),
+        run_agent_pool(stop_event),
+        run_agent_reconciler(stop_event),
+        run_letta_migrations(stop_event),
+        run_media(stop_event),
+    )
+    await media_pipeline.close()
+    await archival_buffer.close()
+    await close_async_http_client()
+    await close_async_letta()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,33 @@
+import asyncio
+import logging
+
+from app.services.agent_mailbox import agent_mailbox
+from app.services.run_poller import SEND_MESSAGE_TASK
+from app.utils.celery_app import celery_app
+
+logger = logging.getLogger(__name__)
+
+
+async def run_agent_mailbox(stop_event: asyncio.Event):
+    """
+    Loop do worker da caixa dos agentes: a cada `AGENT_MAILBOX_SWEEP_INTERVAL`,
+    envia as mensagens que aguardam em caixas cuja vez se perdeu (task ou
+    processo que morreu antes de passá-la adiante).
+    """
+    if not agent_mailbox.enabled:
+        return
+    logger.info("Worker da caixa dos agentes iniciado.")
+    while not stop_event.is_set():
+        try:
+            for agent_id, lease, message in await agent_mailbox.sweep():
+                logger.warning(f"Caixa do agente {agent_id} sem vez: mensagens que aguardavam reenviadas.")
+                await asyncio.to_thread(celery_app.send_task, SEND_MESSAGE_TASK, args=[agent_id, message], kwargs={"lease": lease})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Erro ao verificar as caixas dos agentes: {e}")
+
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=agent_mailbox.sweep_interval)
+        except asyncio.TimeoutError:
+            pass
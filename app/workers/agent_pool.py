@@ -0,0 +1,31 @@
+import asyncio
+import logging
+
+from app.services.agent_pool import agent_pool
+
+logger = logging.getLogger(__name__)
+
+
+async def run_agent_pool(stop_event: asyncio.Event):
+    """
+    Loop de reposição do pool de agentes: a cada `AGENT_POOL_INTERVAL`, um processo
+    por vez cria os conjuntos que faltam para o pool chegar a `AGENT_POOL_SIZE`.
+    """
+    if not agent_pool.enabled:
+        return
+    logger.info("Reposição do pool de agentes iniciada.")
+    while not stop_event.is_set():
+        try:
+            if await agent_pool.acquire_replenish():
+                created = await agent_pool.replenish()
+                if created:
+                    logger.info(f"{created} conjunto(s) de agentes adicionados ao pool.")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Erro ao repor o pool de agentes: {e}")
+
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=agent_pool.interval)
+        except asyncio.TimeoutError:
+            pass
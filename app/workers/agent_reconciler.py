@@ -0,0 +1,29 @@
+import asyncio
+import logging
+
+from app.services.agent_reconciler import agent_reconciler
+
+logger = logging.getLogger(__name__)
+
+
+async def run_agent_reconciler(stop_event: asyncio.Event):
+    """
+    Loop da reconciliação de agentes: uma execução a cada `AGENT_RECONCILE_INTERVAL`,
+    por um processo de cada vez.
+    """
+    if not agent_reconciler.enabled:
+        return
+    logger.info("Reconciliação de agentes iniciada.")
+    while not stop_event.is_set():
+        try:
+            if await agent_reconciler.acquire_run():
+                await agent_reconciler.reconcile()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Erro na reconciliação de agentes: {e}")
+
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=agent_reconciler.interval)
+        except asyncio.TimeoutError:
+            pass
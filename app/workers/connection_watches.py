@@ -0,0 +1,57 @@
+import asyncio
+import logging
+from typing import Dict
+
+from app.flows.whatsapp_integration_flow import (
+    CONNECTION_WATCH_LEASE_MS,
+    claim_connection_watches,
+    renew_connection_watch,
+    run_connection_watch,
+)
+
+logger = logging.getLogger(__name__)
+
+
+async def run_connection_watches(stop_event: asyncio.Event, interval: float = 1.0):
+    """
+    Loop das esperas pela conexão do WhatsApp (etapa 3 da integração): reserva as
+    esperas pendentes, executa cada uma em uma task e renova a reserva enquanto
+    ela roda. Esperas de um processo que parou voltam a ficar disponíveis quando
+    a reserva expira e são retomadas até o prazo gravado no flow.
+    """
+    running: Dict[str, asyncio.Task] = {}
+    renew_every = CONNECTION_WATCH_LEASE_MS / 3000
+    last_renew = 0.0
+    logger.info("Worker das esperas de conexão do WhatsApp iniciado.")
+
+    while not stop_event.is_set():
+        try:
+            for member, task in list(running.items()):
+                if task.done():
+                    running.pop(member)
+                    if not task.cancelled() and task.exception():
+                        logger.error(f"Erro na espera de conexão {member}: {task.exception()}")
+
+            loop_time = asyncio.get_running_loop().time()
+            if loop_time - last_renew >= renew_every:
+                for member in running:
+                    await renew_connection_watch(member)
+                last_renew = loop_time
+
+            for member in await claim_connection_watches():
+                if member not in running:
+                    running[member] = asyncio.create_task(run_connection_watch(member))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Erro ao reservar as esperas de conexão do WhatsApp: {e}")
+
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+    # As esperas interrompidas voltam a ficar disponíveis quando a reserva expirar.
+    for task in running.values():
+        task.cancel()
+    await asyncio.gather(*running.values(), return_exceptions=True)
@@ -0,0 +1,49 @@
+import os
+import asyncio
+import logging
+
+from app.services.rate_limiter import webhook_rate_limiter
+from app.services.webhook_dedup import webhook_deduplicator
+from app.services.webhook_ingestion import dispatch_event
+
+logger = logging.getLogger(__name__)
+
+
+async def run_deferred_events(stop_event: asyncio.Event):
+    """
+    Reprocessa os eventos adiados pelo controle de admissão do webhook, remetente
+    por remetente e na ordem em que chegaram. O evento da frente de cada fila
+    vencida passa de novo pelo token bucket; se ainda não houver cota, a fila do
+    remetente é reagendada com o novo tempo de espera (os eventos seguintes
+    esperam atrás dele).
+
+    A chave de deduplicação continua reservada desde o recebimento, então o evento
+    não é verificado de novo.
+    """
+    interval = float(os.getenv("RATE_LIMIT_DEFERRED_POLL_SECONDS", "0.5"))
+    logger.info("Worker de eventos adiados do webhook iniciado.")
+
+    while not stop_event.is_set():
+        try:
+            for sender in await webhook_rate_limiter.claim_due():
+                payload = await webhook_rate_limiter.head(sender)
+                if payload is not None:
+                    decision = await webhook_rate_limiter.check(payload)
+                    if not decision.admitted:
+                        await webhook_rate_limiter.postpone(sender, decision.retry_after_ms)
+                        continue
+                    dedup_key = webhook_deduplicator.event_key(payload) if webhook_deduplicator.enabled else None
+                    try:
+                        await dispatch_event(payload, dedup_key)
+                    except Exception as e:
+                        logger.error(f"Erro ao processar evento adiado do webhook: {e}")
+                await webhook_rate_limiter.advance(sender)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Erro ao ler os eventos adiados do webhook: {e}")
+
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
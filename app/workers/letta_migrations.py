@@ -0,0 +1,27 @@
+import asyncio
+import logging
+
+from app.services.letta_migration import run_due_deletions, run_next_migration
+
+logger = logging.getLogger(__name__)
+
+
+async def run_letta_migrations(stop_event: asyncio.Event):
+    """
+    Loop das migrações de agentes entre servidores Letta: executa, uma de cada
+    vez, as migrações agendadas por `POST /agents/{user_id}/migrate`, e apaga os
+    agentes de origem cuja remoção já venceu.
+    """
+    logger.info("Worker de migrações entre servidores Letta iniciado.")
+    while not stop_event.is_set():
+        try:
+            await run_due_deletions()
+            await run_next_migration()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Erro ao executar a migração de agentes: {e}")
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
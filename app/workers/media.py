@@ -0,0 +1,34 @@
+import asyncio
+import logging
+
+from app.services.media_pipeline import media_pipeline
+from app.utils.webhook_parser import MEDIA_PIPELINE_ENABLED
+
+logger = logging.getLogger(__name__)
+
+
+async def run_media(stop_event: asyncio.Event):
+    """
+    Loop das mídias: inicia os downloads pendentes na fila do Redis (inclusive os
+    deixados por um processo que parou) e aplica a retenção do diretório a cada
+    `MEDIA_SWEEP_INTERVAL` segundos.
+    """
+    if not MEDIA_PIPELINE_ENABLED:
+        return
+    media_pipeline.start()
+    logger.info("Worker das mídias iniciado.")
+
+    while not stop_event.is_set():
+        try:
+            removed = await asyncio.to_thread(media_pipeline.sweep)
+            if removed["files"]:
+                logger.info(f"Retenção das mídias: {removed['files']} arquivos ({removed['bytes']} bytes) apagados.")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Erro na retenção das mídias: {e}")
+
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=media_pipeline.sweep_interval)
+        except asyncio.TimeoutError:
+            pass
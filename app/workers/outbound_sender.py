@@ -0,0 +1,31 @@
+import os
+import asyncio
+import logging
+from typing import Optional
+
+from app.services.outbound_queue import outbound_queue
+
+logger = logging.getLogger(__name__)
+
+
+async def run_outbound_sender(stop_event: asyncio.Event, poll_seconds: Optional[float] = None):
+    """
+    Loop do worker de envio: drena a fila enquanto houver destinatários prontos.
+    """
+    interval = poll_seconds or float(os.getenv("OUTBOUND_POLL_SECONDS", "0.2"))
+    logger.info("Worker da fila de envio do WhatsApp iniciado.")
+    while not stop_event.is_set():
+        try:
+            claimed = await outbound_queue.drain_once()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Erro ao drenar a fila de envio do WhatsApp: {e}")
+            claimed = 0
+
+        if claimed:
+            continue
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
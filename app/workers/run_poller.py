@@ -0,0 +1,31 @@
+import os
+import asyncio
+import logging
+from typing import Optional
+
+from app.services.run_poller import run_poller
+
+logger = logging.getLogger(__name__)
+
+
+async def run_run_poller(stop_event: asyncio.Event, idle_seconds: Optional[float] = None):
+    """
+    Loop do worker de runs do Letta: consulta as runs vencidas enquanto houver.
+    """
+    interval = idle_seconds or float(os.getenv("RUN_POLL_IDLE_SECONDS", "0.25"))
+    logger.info("Worker de runs do Letta iniciado.")
+    while not stop_event.is_set():
+        try:
+            claimed = await run_poller.poll_once()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Erro ao consultar as runs do Letta: {e}")
+            claimed = 0
+
+        if claimed:
+            continue
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
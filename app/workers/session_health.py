@@ -0,0 +1,28 @@
+import asyncio
+import logging
+
+from app.services.session_health import session_health
+
+logger = logging.getLogger(__name__)
+
+
+async def run_session_health(stop_event: asyncio.Event):
+    """
+    Loop do monitor de sessões do WhatsApp: um ciclo a cada `SESSION_HEALTH_INTERVAL`,
+    executado por um processo de cada vez.
+    """
+    logger.info("Monitor de sessões do WhatsApp iniciado.")
+    while not stop_event.is_set():
+        try:
+            if await session_health.acquire_cycle():
+                counts = await session_health.run_cycle()
+                logger.info(f"Sessões do WhatsApp verificadas: {counts}.")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Erro no monitor de sessões do WhatsApp: {e}")
+
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=session_health.interval)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,87 @@
+import os
+import time
+import random
+import socket
+import asyncio
+import logging
+from typing import Dict
+
+from app.services.webhook_service import WebhookService
+from app.services.webhook_stream import WebhookEventStream
+
+logger = logging.getLogger(__name__)
+
+# Intervalo mínimo entre os alertas de shards sem consumidor.
+UNOWNED_ALERT_INTERVAL = 60
+
+
+async def run_webhook_consumers(stop_event: asyncio.Event, worker_count: int = None):
+    """
+    Disputa os leases dos shards do stream de eventos do webhook e consome cada
+    shard obtido em uma task própria. `WEBHOOK_STREAM_WORKERS` (padrão: todos os
+    shards) limita quantos shards este processo consome ao mesmo tempo; os
+    demais ficam para outros processos. Shards sem dono são assumidos assim que
+    houver vaga, e, se este processo está cheio e ainda há shards sem consumidor,
+    um erro é registrado (os eventos desses remetentes ficam parados).
+    """
+    stream = WebhookEventStream()
+    count = worker_count or int(os.getenv("WEBHOOK_STREAM_WORKERS") or stream.shard_count)
+    owner = f"{socket.gethostname()}-{os.getpid()}"
+    renew_interval = stream.lease_ms / 1000 / 3
+    owned: Dict[int, asyncio.Task] = {}
+    last_alert = 0.0
+
+    logger.info(f"Consumidores do webhook iniciados ({owner}): até {count} de {stream.shard_count} shards.")
+    if count < stream.shard_count:
+        logger.warning(
+            f"WEBHOOK_STREAM_WORKERS={count} < WEBHOOK_STREAM_SHARDS={stream.shard_count}: são necessários "
+            f"ao menos {-(-stream.shard_count // count)} processos de workers para consumir todos os shards."
+        )
+
+    while not stop_event.is_set():
+        try:
+            # Renova os leases atuais e encerra os shards perdidos.
+            for shard, task in list(owned.items()):
+                if task.done() or not await stream.renew_shard(shard, owner):
+                    task.cancel()
+                    owned.pop(shard)
+                    logger.warning(f"Shard {shard} liberado por {owner}.")
+
+            # Tenta assumir shards livres, começando de um ponto aleatório para espalhar a carga.
+            if len(owned) < count:
+                offset = random.randrange(stream.shard_count)
+                for i in range(stream.shard_count):
+                    shard = (offset + i) % stream.shard_count
+                    if len(owned) >= count:
+                        break
+                    if shard in owned:
+                        continue
+                    if await stream.acquire_shard(shard, owner):
+                        owned[shard] = asyncio.create_task(
+                            stream.consume_shard(shard, WebhookService.process_event, stop_event)
+                        )
+                        logger.info(f"Shard {shard} assumido por {owner}.")
+
+            if len(owned) >= count and time.monotonic() - last_alert > UNOWNED_ALERT_INTERVAL:
+                unowned = await stream.unowned_shards()
+                if unowned:
+                    last_alert = time.monotonic()
+                    logger.error(
+                        f"{len(unowned)} shards do webhook sem consumidor ({unowned}): aumente "
+                        f"WEBHOOK_STREAM_WORKERS ou o número de processos de workers."
+                    )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Erro ao gerenciar os shards do webhook: {e}")
+
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=renew_interval)
+        except asyncio.TimeoutError:
+            pass
+
+    for shard, task in owned.items():
+        task.cancel()
+    await asyncio.gather(*owned.values(), return_exceptions=True)
+    for shard in owned:
+        await stream.release_shard(shard, owner)
@@ -0,0 +1,136 @@
+"""
+Benchmark de memória do download de mídia: caminho antigo (`resp.json()` + b64decode
+do corpo inteiro) contra o pipeline em streaming (`MediaPipeline.download`).
+
+Um servidor local simula o `download-media` do WPPConnect, respondendo um JSON com
+um vídeo de `--size-mb` MB em base64. Cada caminho roda em um processo separado,
+que informa o pico de RSS (ru_maxrss) e o RSS antes do download.
+
+Uso: uv run scripts/bench_media_download.py [--size-mb 50]
+"""
+import os
+import sys
+import json
+import time
+import base64
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+import http.server
+import multiprocessing
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+CHUNK = 3 * 64 * 1024
+
+
+class MediaHandler(http.server.BaseHTTPRequestHandler):
+    size_bytes = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        prefix = b'{"mimetype": "video/mp4", "base64": "'
+        suffix = b'"}'
+        b64_length = 4 * ((self.size_bytes + 2) // 3)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(prefix) + b64_length + len(suffix)))
+        self.end_headers()
+        self.wfile.write(prefix)
+        block = os.urandom(CHUNK)
+        remaining = self.size_bytes
+        while remaining > 0:
+            data = block[:min(CHUNK, remaining)]
+            self.wfile.write(base64.b64encode(data))
+            remaining -= len(data)
+        self.wfile.write(suffix)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port_queue, size_bytes: int):
+    MediaHandler.size_bytes = size_bytes
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), MediaHandler)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+def current_rss_mb() -> float:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def run_legacy(base_url: str, output_dir: str):
+    import requests
+    baseline = current_rss_mb()
+    start = time.perf_counter()
+    data = requests.post(f"{base_url}/api/bench/download-media", json={"messageId": "x"}).json()
+    content = base64.b64decode(data["base64"])
+    with open(os.path.join(output_dir, "legacy.mp4"), "wb") as target:
+        target.write(content)
+    return baseline, time.perf_counter() - start, len(content)
+
+
+def run_stream(base_url: str, output_dir: str):
+    os.environ["MEDIA_STORAGE_DIR"] = output_dir
+    from app.services.media_pipeline import MediaPipeline
+    from app.services.whatsapp_service import AsyncWhatsAppService, close_async_http_client
+
+    async def download():
+        client = AsyncWhatsAppService(session_name="bench")
+        client.base_url, client.secret_key = base_url, None
+        record = await MediaPipeline().download(client, "x", media_type="video")
+        await close_async_http_client()
+        return record
+
+    baseline = current_rss_mb()
+    start = time.perf_counter()
+    record = asyncio.run(download())
+    return baseline, time.perf_counter() - start, record.size
+
+
+def child(mode: str, base_url: str):
+    with tempfile.TemporaryDirectory() as output_dir:
+        runner = run_legacy if mode == "legacy" else run_stream
+        baseline, elapsed, size = runner(base_url, output_dir)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({"baseline_mb": baseline, "peak_mb": peak, "seconds": elapsed, "bytes": size}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=50)
+    parser.add_argument("--child", choices=["legacy", "stream"])
+    parser.add_argument("--base-url")
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.base_url)
+        return
+
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(port_queue, args.size_mb * 1024 * 1024), daemon=True)
+    server.start()
+    base_url = f"http://127.0.0.1:{port_queue.get()}"
+
+    print(f"{'caminho':<10}{'MB':>8}{'RSS antes (MB)':>18}{'pico RSS (MB)':>18}{'tempo (s)':>12}")
+    try:
+        for mode in ("legacy", "stream"):
+            output = subprocess.run(
+                [sys.executable, __file__, "--child", mode, "--base-url", base_url],
+                capture_output=True, text=True, check=True,
+            )
+            result = json.loads(output.stdout.strip().splitlines()[-1])
+            print(f"{mode:<10}{result['bytes'] / 1024 / 1024:>8.1f}{result['baseline_mb']:>18.1f}{result['peak_mb']:>18.1f}{result['seconds']:>12.2f}")
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
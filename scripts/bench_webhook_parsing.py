@@ -0,0 +1,135 @@
+"""
+Micro-benchmark do parsing do webhook: caminho antigo (json.loads do corpo inteiro)
+contra o caminho rápido (cabeçalho com msgspec + decode tipado só dos eventos processados).
+
+Os payloads reproduzem o formato dos eventos `onmessage` gravados do WPPConnect:
+uma mensagem de texto (chat) e uma mensagem de mídia (imagem com o base64 no `body`).
+
+Uso: uv run scripts/bench_webhook_parsing.py [--seconds 2] [--media-kb 512]
+"""
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.utils.webhook_parser import decode_event, decode_header, is_ignorable  # noqa: E402
+
+
+def build_payload(msg_type: str, body: str) -> bytes:
+    payload = {
+        "event": "onmessage",
+        "session": "principal",
+        "id": "false_5511999999999@c.us_3EB0C767D26A1C3F5E1A",
+        "body": body,
+        "type": msg_type,
+        "t": 1739200000,
+        "notifyName": "Fulano de Tal",
+        "from": "5511999999999@c.us",
+        "to": "5511888888888@c.us",
+        "self": "in",
+        "ack": 1,
+        "isNewMsg": True,
+        "star": False,
+        "kicNotified": False,
+        "recvFresh": True,
+        "isFromTemplate": False,
+        "broadcast": False,
+        "mentionedJidList": [],
+        "isVcardOverMmsDocument": False,
+        "isForwarded": False,
+        "labels": [],
+        "hasReaction": False,
+        "ephemeralOutOfSync": False,
+        "productHeaderImageRejected": False,
+        "lastPlaybackProgress": 0,
+        "isDynamicReplyButtonsMsg": False,
+        "isMdHistoryMsg": False,
+        "stickerSentTs": 0,
+        "isAvatar": False,
+        "requiresDirectConnection": False,
+        "pttForwardedFeaturesEnabled": True,
+        "isEphemeral": False,
+        "isStatusV3": False,
+        "links": [],
+        "chatId": "5511999999999@c.us",
+        "fromMe": False,
+        "sender": {
+            "id": "5511999999999@c.us",
+            "name": "Fulano de Tal",
+            "shortName": "Fulano",
+            "pushname": "Fulano",
+            "type": "in",
+            "isBusiness": False,
+            "isEnterprise": False,
+            "isSmb": False,
+            "labels": [],
+            "isContactSyncCompleted": 1,
+            "formattedName": "Fulano de Tal",
+            "isMe": False,
+            "isMyContact": True,
+            "isPSA": False,
+            "isUser": True,
+            "isWAContact": True,
+            "profilePicThumbObj": {"eurl": "https://pps.whatsapp.net/v/t61.24694-24/abc.jpg", "id": "5511999999999@c.us", "tag": "1700000000"},
+            "msgs": None,
+        },
+        "timestamp": 1739200000,
+        "content": body if msg_type == "chat" else "",
+        "isGroupMsg": False,
+        "isMedia": msg_type != "chat",
+        "isNotification": False,
+        "isPSA": False,
+        "mediaData": {} if msg_type == "chat" else {"type": msg_type, "mediaStage": "RESOLVED", "size": len(body)},
+    }
+    return json.dumps(payload).encode("utf-8")
+
+
+def legacy_path(body: bytes):
+    payload = json.loads(body.decode("utf-8"))
+    if payload.get("event") == "onmessage" and payload.get("type") == "chat":
+        return payload
+    return None
+
+
+def fast_path(body: bytes):
+    header = decode_header(body)
+    if is_ignorable(header):
+        return None
+    return decode_event(body, header.event)
+
+
+def run(func, body: bytes, seconds: float) -> float:
+    count = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(100):
+            func(body)
+        count += 100
+    return count / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=2.0)
+    parser.add_argument("--media-kb", type=int, default=512)
+    args = parser.parse_args()
+
+    media_body = "data:image/jpeg;base64," + base64.b64encode(os.urandom(args.media_kb * 1024)).decode()
+    payloads = {
+        "chat": build_payload("chat", "Oi! Você consegue marcar uma reunião amanhã às 10h?"),
+        "media": build_payload("image", media_body),
+    }
+
+    print(f"{'payload':<8}{'bytes':>12}{'json.loads (ops/s)':>22}{'fast path (ops/s)':>22}{'speedup':>10}")
+    for name, body in payloads.items():
+        legacy = run(legacy_path, body, args.seconds)
+        fast = run(fast_path, body, args.seconds)
+        print(f"{name:<8}{len(body):>12}{legacy:>22,.0f}{fast:>22,.0f}{fast / legacy:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
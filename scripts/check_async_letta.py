@@ -0,0 +1,121 @@
+"""
+Verificação estática: chamadas síncronas ao Letta dentro de corrotinas.
+
+Cada chamada bloqueia o event loop do uvicorn (ou do processo de workers) por
+uma ida e volta de rede. Os clientes síncronos (`lc` e `get_letta(nó)`) são só
+para as tasks do Celery; no event loop, use `get_async_letta()`, o
+`letta_router` e as versões `_async` dos helpers.
+
+São consideradas síncronas as chamadas a `lc.*` e `get_letta(...).*` e,
+transitivamente, as funções síncronas do projeto que as fazem (ex.:
+`get_onboarding_agent_id`, `letta_router.client_for_agent_sync`). Chamadas com `await` e funções passadas para
+`asyncio.to_thread` não são apontadas.
+
+Uso: uv run scripts/check_async_letta.py [caminhos...]  (padrão: app/)
+Sai com código 1 se encontrar alguma chamada.
+"""
+import os
+import ast
+import sys
+from typing import Dict, Iterator, List, Set, Tuple
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SYNC_CLIENTS = {"lc", "get_letta"}
+
+
+def iter_sources(paths: List[str]) -> Iterator[Tuple[str, ast.Module]]:
+    for base in paths:
+        files = [base] if base.endswith(".py") else (
+            os.path.join(directory, name)
+            for directory, _, names in os.walk(base)
+            for name in names if name.endswith(".py")
+        )
+        for path in files:
+            with open(path, encoding="utf-8") as file:
+                yield path, ast.parse(file.read(), filename=path)
+
+
+def call_name(node: ast.Call) -> Tuple[str, str]:
+    """
+    (raiz, nome) da chamada: `lc.agents.list()` → ("lc", "list"); `agent_info()` → ("agent_info", "agent_info").
+    """
+    func, name = node.func, None
+    while isinstance(func, (ast.Attribute, ast.Call)):
+        if isinstance(func, ast.Attribute):
+            name = name or func.attr
+            func = func.value
+        else:
+            func = func.func
+    root = func.id if isinstance(func, ast.Name) else ""
+    return root, name or root
+
+
+def own_calls(function: ast.AST) -> Iterator[Tuple[ast.Call, bool]]:
+    """
+    Chamadas do corpo da função (sem descer em funções aninhadas), indicando se têm `await`.
+    """
+    awaited: Set[int] = set()
+    stack = list(ast.iter_child_nodes(function))
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda, ast.ClassDef)):
+            continue
+        if isinstance(node, ast.Await) and isinstance(node.value, ast.Call):
+            awaited.add(id(node.value))
+        if isinstance(node, ast.Call):
+            yield node, id(node) in awaited
+        stack.extend(ast.iter_child_nodes(node))
+
+
+def is_sync_letta(node: ast.Call, tainted: Set[str]) -> bool:
+    root, name = call_name(node)
+    return root in SYNC_CLIENTS or name in tainted
+
+
+def find_blocking_calls(paths: List[str]) -> List[str]:
+    modules = list(iter_sources(paths))
+    sync_functions: Dict[str, List[ast.FunctionDef]] = {}
+    async_functions: List[Tuple[str, ast.AsyncFunctionDef]] = []
+    for path, tree in modules:
+        for node in ast.walk(tree):
+            if isinstance(node, ast.FunctionDef):
+                sync_functions.setdefault(node.name, []).append(node)
+            elif isinstance(node, ast.AsyncFunctionDef):
+                async_functions.append((path, node))
+
+    # Funções síncronas que chamam o Letta, direta ou indiretamente.
+    tainted: Set[str] = set()
+    changed = True
+    while changed:
+        changed = False
+        for name, functions in sync_functions.items():
+            if name in tainted:
+                continue
+            if any(is_sync_letta(call, tainted) for function in functions for call, _ in own_calls(function)):
+                tainted.add(name)
+                changed = True
+
+    problems = []
+    for path, function in async_functions:
+        for call, awaited in own_calls(function):
+            if not awaited and is_sync_letta(call, tainted):
+                root, name = call_name(call)
+                label = f"{root}...{name}" if root in SYNC_CLIENTS else name
+                problems.append(f"{os.path.relpath(path, ROOT)}:{call.lineno}: {label}() síncrono dentro de `async def {function.name}`")
+    return problems
+
+
+def main() -> int:
+    paths = sys.argv[1:] or [os.path.join(ROOT, "app")]
+    problems = find_blocking_calls(paths)
+    for problem in problems:
+        print(problem)
+    if problems:
+        print(f"\n{len(problems)} chamada(s) síncrona(s) ao Letta em corrotinas.")
+        return 1
+    print("Nenhuma chamada síncrona ao Letta em corrotinas.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())